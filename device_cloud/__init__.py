@@ -16,6 +16,8 @@ This module contains the Client class required for applications to connect and
 interact with the Wind River Helix Device Cloud 2.Next.
 """
 
+import sys
+
 from logging import CRITICAL as LOGCRITICAL
 from logging import ERROR as LOGERROR
 from logging import DEBUG as LOGDEBUG
@@ -26,11 +28,44 @@ from logging import WARNING as LOGWARNING
 from device_cloud._core.client import Client
 from device_cloud._core.handler import status_string
 
+# The asyncio client needs async/await syntax
+if sys.version_info >= (3, 5):
+    from device_cloud._core.async_client import AsyncClient
+
+# The gateway needs the selectors module
+if sys.version_info >= (3, 4):
+    from device_cloud._core.gateway import Gateway
+
+from device_cloud._core.constants import DEFAULT_CLOUD_TIME
 from device_cloud._core.constants import DEFAULT_CONFIG_DIR
 from device_cloud._core.constants import DEFAULT_CONFIG_FILE
+from device_cloud._core.constants import DEFAULT_HTTP_POOL_SIZE
+from device_cloud._core.constants import DEFAULT_JOURNAL_MAX_AGE
+from device_cloud._core.constants import DEFAULT_JOURNAL_MAX_BYTES
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
+from device_cloud._core.constants import DEFAULT_LINGER_MS
+from device_cloud._core.constants import DEFAULT_LOG_COMMANDS
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
+from device_cloud._core.constants import DEFAULT_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BYTES
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_COMMANDS
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PRIORITY_BURST
+from device_cloud._core.constants import DEFAULT_RECONNECT_DELAY
+from device_cloud._core.constants import DEFAULT_RECONNECT_MAX_DELAY
+from device_cloud._core.constants import DEFAULT_REPLY_MAX_BYTES
+from device_cloud._core.constants import DEFAULT_REPLY_TIMEOUT
+from device_cloud._core.constants import DEFAULT_STATS_INTERVAL
+from device_cloud._core.constants import DEFAULT_TELEMETRY_BUFFER
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_TOPIC_WIDTH
+
+from device_cloud._core.constants import QUEUE_POLICY_BLOCK
+from device_cloud._core.constants import QUEUE_POLICY_DROP_OLDEST
+from device_cloud._core.constants import QUEUE_POLICY_DROP_NEWEST
+from device_cloud._core.constants import QUEUE_POLICY_REJECT
 
 from device_cloud._core.constants import STATUS_SUCCESS
 from device_cloud._core.constants import STATUS_INVOKED
@@ -62,11 +97,35 @@ __all__ = ["Client",
            "osal"
            "ota_handler",
            "relay",
+           "DEFAULT_CLOUD_TIME",
            "DEFAULT_CONFIG_DIR",
            "DEFAULT_CONFIG_FILE",
+           "DEFAULT_HTTP_POOL_SIZE",
+           "DEFAULT_JOURNAL_MAX_AGE",
+           "DEFAULT_JOURNAL_MAX_BYTES",
            "DEFAULT_KEEP_ALIVE",
+           "DEFAULT_LINGER_MS",
+           "DEFAULT_LOG_COMMANDS",
            "DEFAULT_LOOP_TIME",
+           "DEFAULT_MAX_BATCH",
+           "DEFAULT_PUBLISH_MAX_BYTES",
+           "DEFAULT_PUBLISH_MAX_COMMANDS",
+           "DEFAULT_PUBLISH_QUEUE_POLICY",
+           "DEFAULT_PUBLISH_QUEUE_SIZE",
+           "DEFAULT_PUBLISH_QUEUE_TIMEOUT",
+           "DEFAULT_PRIORITY_BURST",
+           "DEFAULT_RECONNECT_DELAY",
+           "DEFAULT_RECONNECT_MAX_DELAY",
+           "DEFAULT_REPLY_MAX_BYTES",
+           "DEFAULT_REPLY_TIMEOUT",
+           "DEFAULT_STATS_INTERVAL",
+           "DEFAULT_TELEMETRY_BUFFER",
            "DEFAULT_THREAD_COUNT",
+           "DEFAULT_TOPIC_WIDTH",
+           "QUEUE_POLICY_BLOCK",
+           "QUEUE_POLICY_DROP_OLDEST",
+           "QUEUE_POLICY_DROP_NEWEST",
+           "QUEUE_POLICY_REJECT",
            "LOGCRITICAL",
            "LOGERROR",
            "LOGDEBUG",
@@ -93,3 +152,9 @@ __all__ = ["Client",
            "STATUS_TRY_AGAIN",
            "STATUS_NOT_SUPPORTED",
            "STATUS_FAILURE"]
+
+if sys.version_info >= (3, 5):
+    __all__.append("AsyncClient")
+
+if sys.version_info >= (3, 4):
+    __all__.append("Gateway")
@@ -0,0 +1,558 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the AsyncClient class for applications that run on an
+asyncio event loop. It requires Python 3.5 or newer, and paho-mqtt 1.5 or newer.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+
+import paho.mqtt.client as mqttlib
+
+from device_cloud._core import constants
+from device_cloud._core.client import Client
+from device_cloud._core.handler import Handler
+
+
+class AsyncHandler(Handler):
+    """
+    Handler driven by an asyncio event loop instead of its own threads. The
+    MQTT socket is read and written when the loop reports it is ready,
+    publishes are flushed by a task, and received messages are handled on the
+    loop. File transfers, and actions whose callbacks are not coroutine
+    functions, run in the loop's default executor.
+    """
+
+    def __init__(self, config, client):
+        super(AsyncHandler, self).__init__(config, client)
+
+        # Event loop the handler runs on, set when connecting
+        self.loop = None
+        self.loop_thread = None
+
+        # Set when publishes are queued, and when the last reply arrives
+        self.flush_event = None
+        self.replies_event = None
+
+        # Tasks for MQTT housekeeping and flushing publishes, and futures for
+        # actions and file transfers in progress
+        self.tasks = []
+        self.pending = set()
+
+        # Have MQTT report its socket so it can be watched by the loop
+        self.mqtt.on_socket_open = self.on_socket_open
+        self.mqtt.on_socket_close = self.on_socket_close
+        self.mqtt.on_socket_register_write = self.on_socket_register_write
+        self.mqtt.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def call_in_loop(self, function, *args):
+        """
+        Call a function now if on the event loop's thread, otherwise schedule
+        it on the loop
+        """
+
+        if threading.current_thread() is self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    async def connect_async(self, timeout=0):
+        """
+        Connect to MQTT on the running event loop
+        """
+
+        if not hasattr(mqttlib.Client, "on_socket_register_write"):
+            self.logger.error("AsyncClient requires paho-mqtt 1.5 or newer")
+            return constants.STATUS_NOT_SUPPORTED
+
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.current_thread()
+        self.flush_event = asyncio.Event()
+        self.replies_event = asyncio.Event()
+        self.to_quit = False
+
+        status = self.connect_setup()
+        if status == constants.STATUS_SUCCESS:
+            # Connecting resolves the host and does the TLS handshake, so it
+            # is done in the executor
+            result = -1
+            try:
+                result = await self.loop.run_in_executor(
+                    None, self.mqtt.connect, self.config.cloud.host,
+                    self.config.cloud.port, constants.MQTT_KEEP_ALIVE)
+            except Exception as error:
+                # socket.gaierror or ssl.SSLError
+                self.logger.error(str(error))
+
+            if result == 0:
+                self.logger.info("Connecting...")
+                self.tasks = [asyncio.ensure_future(self.misc_loop()),
+                              asyncio.ensure_future(self.flush_loop())]
+
+                # Wait for cloud connection
+                status = await self.wait_completion(self.connection, timeout)
+                if status is None:
+                    self.logger.error("Connection timed out")
+                    status = constants.STATUS_TIMED_OUT
+            else:
+                status = constants.STATUS_FAILURE
+
+        if self.state != constants.STATE_CONNECTED:
+            # Not connected. Stop the tasks.
+            self.logger.error("Failed to connect")
+            self.to_quit = True
+            self.state = constants.STATE_DISCONNECTED
+            await self.stop()
+            if status == constants.STATUS_SUCCESS:
+                status = constants.STATUS_FAILURE
+
+        return status
+
+    async def disconnect_async(self, wait_for_replies=False, timeout=0):
+        """
+        Send anything pending, stop the tasks and disconnect MQTT
+        """
+
+        end_time = None
+        if timeout:
+            end_time = self.loop.time() + timeout
+
+        def remaining():
+            if end_time is None:
+                return None
+            return max(end_time - self.loop.time(), 0)
+
+        # Publish any data that was queued before disconnecting, including any
+        # aggregation windows that have not ended yet
+        self.logger.info("Disconnecting...")
+        self.publish_aggregates(force=True)
+
+        # Wait for actions and file transfers in progress
+        if self.pending:
+            await asyncio.wait(list(self.pending), timeout=remaining())
+        self.handle_publish()
+
+        # Optionally wait for any outstanding replies.
+        if wait_for_replies and self.is_connected() and self.reply_tracker:
+            self.logger.info("Waiting for replies...")
+            self.replies_event.clear()
+            try:
+                await asyncio.wait_for(self.replies_event.wait(), remaining())
+            except asyncio.TimeoutError:
+                pass
+
+        self.to_quit = True
+        if self.is_connected():
+            # Writing the disconnect packet closes the socket
+            self.mqtt.disconnect()
+            self.mqtt.loop_write()
+        await self.stop()
+
+        return constants.STATUS_SUCCESS
+
+    def dispatch_work(self, work):
+        """
+        Handle work on the event loop, or start it in the executor if it
+        blocks
+        """
+
+        try:
+            if work.type == constants.WORK_MESSAGE:
+                self.handle_message(work.data)
+            elif work.type == constants.WORK_PUBLISH:
+                self.flush_wake()
+            elif work.type == constants.WORK_ACTION:
+                self.track(self.run_action(work.data))
+            elif work.type == constants.WORK_DOWNLOAD:
+                self.track(self.loop.run_in_executor(
+                    None, self.handle_file_download, work.data))
+            elif work.type == constants.WORK_UPLOAD:
+                self.track(self.loop.run_in_executor(
+                    None, self.handle_file_upload, work.data))
+        except Exception:
+            # Print traceback, but don't stop the loop
+            self.logger.exception("Exception:")
+
+    async def flush_loop(self):
+        """
+        Task that flushes publishes once they are queued, lingering for up to
+        linger_ms (or until max_batch publishes are waiting) so more
+        publishes can join the batch
+        """
+
+        linger = (self.config.linger_ms or 0) / 1000.0
+        max_batch = self.config.max_batch or 0
+
+        while not self.to_quit:
+            await self.flush_event.wait()
+            self.flush_event.clear()
+
+            # Wait for publishes, and for a connection if publishes are
+            # journaled
+            if (self.to_quit or not self.pending_publishes() or
+                    (self.journal and not self.is_connected())):
+                continue
+
+            # Give other publishes a chance to join this batch
+            end_time = self.loop.time() + linger
+            remaining = linger
+            while (remaining > 0 and not self.to_quit and
+                   not (max_batch and
+                        self.pending_publishes() >= max_batch)):
+                try:
+                    await asyncio.wait_for(self.flush_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                self.flush_event.clear()
+                remaining = end_time - self.loop.time()
+
+            try:
+                self.handle_publish()
+            except Exception:
+                # Print traceback, but don't stop the task
+                self.logger.exception("Exception:")
+
+    def flush_wake(self):
+        """
+        Wake the flush task to check for publishes
+        """
+
+        if self.loop is None:
+            return super(AsyncHandler, self).flush_wake()
+        self.call_in_loop(self.flush_event.set)
+
+    def handle_message(self, mqtt_message):
+        """
+        Handle messages received from Cloud, noting when the last reply
+        arrives
+        """
+
+        status = super(AsyncHandler, self).handle_message(mqtt_message)
+        if self.replies_event is not None and not self.reply_tracker:
+            self.replies_event.set()
+        return status
+
+    async def misc_loop(self):
+        """
+        Task for MQTT keep alives and reconnecting, and for checking timeouts
+        """
+
+        while not self.to_quit:
+            await asyncio.sleep(self.config.loop_time)
+            try:
+                # If disconnected, attempt to reestablish connection once the
+                # backoff delay has passed
+                if self.state == constants.STATE_DISCONNECTED:
+                    if self.reconnect_due():
+                        try:
+                            result = await self.loop.run_in_executor(
+                                None, self.mqtt.reconnect)
+                        except Exception:
+                            result = None
+                        self.reconnect_result(result)
+                    elif self.to_quit:
+                        self.flush_event.set()
+                        break
+                else:
+                    self.mqtt.loop_misc()
+
+                # Check for overdue replies, ended aggregation windows and
+                # round trip times that are due
+                self.handle_periodic()
+                if not self.reply_tracker:
+                    self.replies_event.set()
+            except Exception:
+                # Print traceback, but don't stop the task
+                self.logger.exception("Exception:")
+
+    def mqtt_read(self):
+        """
+        Read from the MQTT socket once the loop reports it is readable
+        """
+
+        self.mqtt.loop_read()
+
+    def mqtt_write(self):
+        """
+        Write to the MQTT socket once the loop reports it is writable
+        """
+
+        self.mqtt.loop_write()
+
+    def on_socket_close(self, mqtt, userdata, sock):
+        """
+        Callback when the MQTT socket is about to be closed
+        """
+
+        self.call_in_loop(self.loop.remove_reader, sock)
+        self.call_in_loop(self.loop.remove_writer, sock)
+
+    def on_socket_open(self, mqtt, userdata, sock):
+        """
+        Callback when the MQTT socket is opened
+        """
+
+        self.call_in_loop(self.loop.add_reader, sock, self.mqtt_read)
+
+    def on_socket_register_write(self, mqtt, userdata, sock):
+        """
+        Callback when MQTT has data to write
+        """
+
+        self.call_in_loop(self.loop.add_writer, sock, self.mqtt_write)
+
+    def on_socket_unregister_write(self, mqtt, userdata, sock):
+        """
+        Callback when MQTT has nothing left to write
+        """
+
+        self.call_in_loop(self.loop.remove_writer, sock)
+
+    def queue_work(self, work):
+        """
+        Handle work on the event loop once connected
+        """
+
+        if self.loop is None:
+            return super(AsyncHandler, self).queue_work(work)
+        self.call_in_loop(self.dispatch_work, work)
+        return constants.STATUS_SUCCESS
+
+    async def run_action(self, action_request):
+        """
+        Execute an action and send its result. Coroutine function callbacks
+        are awaited on the loop, anything else runs in the executor.
+        """
+
+        action_result = None
+        error = None
+        action = self.callbacks.get(action_request.name)
+
+        try:
+            if action and asyncio.iscoroutinefunction(action.callback):
+                action_result = await action.execute(action_request)
+            else:
+                action_result = await self.loop.run_in_executor(
+                    None, self.callbacks.execute_action, action_request)
+        except Exception as action_error:
+            # Error with action execution. Might not have been registered.
+            error = action_error
+            if action_request.name in self.callbacks:
+                self.logger.exception("Exception:")
+
+        return self.action_result(action_request, action_result, error)
+
+    async def stop(self):
+        """
+        Cancel the handler's tasks
+        """
+
+        tasks = self.tasks
+        self.tasks = []
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def track(self, future):
+        """
+        Keep track of an action or file transfer until it is finished
+        """
+
+        future = asyncio.ensure_future(future)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+    async def wait_completion(self, completion, timeout=0):
+        """
+        Wait on the loop for a Completion to finish, for up to timeout seconds
+        (0 waits forever). Returns its status, or None if it has not finished.
+        """
+
+        loop = self.loop or asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def resolve():
+            if not future.done():
+                future.set_result(completion.status)
+
+        completion.add_callback(lambda _: loop.call_soon_threadsafe(resolve))
+        try:
+            return await asyncio.wait_for(future, timeout or None)
+        except asyncio.TimeoutError:
+            return None
+
+
+class AsyncClient(Client):
+    """
+    Client for apps running on an asyncio event loop, without threads of its
+    own. connect, disconnect, file_download, file_upload and
+    telemetry_publish are coroutines. The other methods are the same as
+    Client's, and do not block unless the "block" publish queue policy is used.
+    Action callbacks can be coroutine functions.
+    """
+
+    handler_class = AsyncHandler
+
+    async def connect(self, timeout=0):
+        """
+        Connect the Client to the Cloud, on the running event loop
+
+        Parameters:
+          timeout             (number) Maximum time to try to connect
+
+        Returns:
+          STATUS_FAILURE               Failed to connect to Cloud
+          STATUS_NOT_SUPPORTED         paho-mqtt is older than 1.5
+          STATUS_SUCCESS               Successfully connected to Cloud
+          STATUS_TIMED_OUT             Connection attempt timed out
+        """
+
+        return await self.handler.connect_async(timeout)
+
+    async def disconnect(self, wait_for_replies=False, timeout=0):
+        """
+        End Client connection to the Cloud
+
+        Parameters:
+          wait_for_replies      (bool) When True, wait for any pending replies
+                                       to be received or time out before
+                                       disconnecting
+          timeout             (number) Maximum time to wait before returning
+
+        Returns:
+          STATUS_SUCCESS               Successfully disconnected
+        """
+
+        return await self.handler.disconnect_async(
+            wait_for_replies=wait_for_replies, timeout=timeout)
+
+    async def file_download(self, file_name, download_dest, blocking=True,
+                            callback=None, timeout=0, file_global=False):
+        """
+        Download a file from the Cloud to the device (C2D)
+
+        Parameters:
+          file_name           (string) File in Cloud to download
+          download_dest       (string) Destination for downloaded file
+          blocking              (bool) Wait for file transfer to complete
+                                       before returning. Otherwise return
+                                       once it is requested.
+          callback              (func) Function to be executed as soon as file
+                                       transfer is complete. It will be passed
+                                       (client, file_name, status).
+          timeout             (number) If blocking, maximum time to wait
+                                       before returning
+          file_global                  Flag that indicates whether or not the
+                                       file to download is in the global file
+                                       store or the thing's file store
+
+        Returns:
+          STATUS_FAILURE               Failed to download file.
+          STATUS_NOT_FOUND             Could not find download directory to
+                                       download file to.
+          STATUS_SUCCESS               File download successful
+          STATUS_TIMED_OUT             Wait for file transfer timed out. File
+                                       transfer is still in progress.
+        """
+
+        status, completion = self.handler.start_download(
+            file_name, download_dest, callback=callback,
+            file_global=file_global)
+        return await self._wait_transfer(status, completion, blocking, timeout)
+
+    async def file_upload(self, file_path, upload_name=None, blocking=True,
+                          callback=None, timeout=0, file_global=False):
+        """
+        Upload a file from the device to the Cloud (D2C)
+
+        Parameters:
+          file_path           (string) Absolute path for file to upload.
+          upload_name         (string) Name for file uploaded in Cloud.
+                                       Default is the file name on the device.
+          blocking              (bool) Wait for file transfer to complete
+                                       before returning. Otherwise return
+                                       once it is requested.
+          callback              (func) Function to be executed as soon as file
+                                       transfer is complete. It will be passed
+                                       (client, file_name, status).
+          timeout             (number) If blocking, maximum time to wait
+                                       before returning
+          file_global                  Flag that indicates whether or not the
+                                       file should be uploaded to the global
+                                       file store or the thing's file store
+
+        Returns:
+          STATUS_FAILURE               Failed to upload file.
+          STATUS_NOT_FOUND             Could not find find to upload in upload
+                                       directory.
+          STATUS_SUCCESS               File upload successful
+          STATUS_TIMED_OUT             Wait for file transfer timed out. File
+                                       transfer is still in progress.
+        """
+
+        loop = asyncio.get_event_loop()
+        if upload_name == "upload":
+            result = []
+            for fn in os.listdir(file_path):
+                result.append(await self.file_upload(
+                    file_path + os.sep + fn, fn, blocking, callback, timeout,
+                    file_global))
+            if not result:
+                return constants.STATUS_NOT_FOUND
+            return max(result)
+
+        # Checksumming the file blocks, so the upload is requested in the
+        # executor
+        status, completion = await loop.run_in_executor(
+            None, functools.partial(self.handler.start_upload, file_path,
+                                    upload_name=upload_name,
+                                    callback=callback,
+                                    file_global=file_global))
+        return await self._wait_transfer(status, completion, blocking, timeout)
+
+    async def telemetry_publish(self, telemetry_name, value, timestamp=None):
+        """
+        Publish telemetry to the Cloud. Waits in the executor for room in a
+        full publish queue if the "block" policy is used.
+
+        Parameters:
+          telemetry_name      (string) Name of property to publish to
+          value               (number) Value to publish
+
+        Returns:
+          STATUS_SUCCESS               Telemetry has been queued for publishing
+        """
+
+        publish = super(AsyncClient, self).telemetry_publish
+        if self.handler.queue_policy == constants.QUEUE_POLICY_BLOCK:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                None, publish, telemetry_name, value, timestamp)
+        return publish(telemetry_name, value, timestamp)
+
+    async def _wait_transfer(self, status, completion, blocking, timeout):
+        """
+        Wait for a requested file transfer to finish
+        """
+
+        if status == constants.STATUS_SUCCESS and blocking:
+            status = await self.handler.wait_completion(completion, timeout)
+            if status is None:
+                status = constants.STATUS_TIMED_OUT
+        return status
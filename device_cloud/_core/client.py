@@ -20,14 +20,35 @@ import json
 import os
 import uuid
 
+from device_cloud._core.constants import DEFAULT_CLOUD_TIME
 from device_cloud._core.constants import DEFAULT_CONFIG_DIR
 from device_cloud._core.constants import DEFAULT_CONFIG_FILE
+from device_cloud._core.constants import DEFAULT_HTTP_POOL_SIZE
+from device_cloud._core.constants import DEFAULT_JOURNAL_MAX_AGE
+from device_cloud._core.constants import DEFAULT_JOURNAL_MAX_BYTES
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_BYTES
+from device_cloud._core.constants import DEFAULT_LINGER_MS
+from device_cloud._core.constants import DEFAULT_LOG_COMMANDS
+from device_cloud._core.constants import DEFAULT_MAX_BATCH
+from device_cloud._core.constants import DEFAULT_PUBLISH_MAX_COMMANDS
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PRIORITY_BURST
+from device_cloud._core.constants import DEFAULT_RECONNECT_DELAY
+from device_cloud._core.constants import DEFAULT_RECONNECT_MAX_DELAY
+from device_cloud._core.constants import DEFAULT_REPLY_MAX_BYTES
+from device_cloud._core.constants import DEFAULT_REPLY_TIMEOUT
+from device_cloud._core.constants import DEFAULT_STATS_INTERVAL
+from device_cloud._core.constants import DEFAULT_TELEMETRY_BUFFER
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_TOPIC_WIDTH
+from device_cloud._core.constants import STATUS_BAD_PARAMETER
 from device_cloud._core.constants import STATUS_SUCCESS
-from device_cloud._core.constants import WORK_PUBLISH
 from device_cloud._core.constants import STATUS_NOT_FOUND
+from device_cloud._core.constants import STATUS_NOT_SUPPORTED
 from device_cloud._core import defs
 from device_cloud._core.handler import Handler
 
@@ -45,6 +66,9 @@ class Client(object):
         warning(message)
     """
 
+    # Class of the handler that does the Client's work
+    handler_class = Handler
+
     def __init__(self, app_id, kwargs=None):
         """
         Start configuration of client. Configuration file location and name can
@@ -159,14 +183,34 @@ class Client(object):
         # Final precedence config defaults
         config_defaults = {
             "keep_alive":DEFAULT_KEEP_ALIVE,
+            "reconnect_delay":DEFAULT_RECONNECT_DELAY,
+            "reconnect_max_delay":DEFAULT_RECONNECT_MAX_DELAY,
             "loop_time":DEFAULT_LOOP_TIME,
             "thread_count":DEFAULT_THREAD_COUNT,
+            "http_pool_size":DEFAULT_HTTP_POOL_SIZE,
+            "log_commands":DEFAULT_LOG_COMMANDS,
+            "cloud_time":DEFAULT_CLOUD_TIME,
+            "telemetry_buffer":DEFAULT_TELEMETRY_BUFFER,
+            "publish_max_commands":DEFAULT_PUBLISH_MAX_COMMANDS,
+            "publish_max_bytes":DEFAULT_PUBLISH_MAX_BYTES,
+            "linger_ms":DEFAULT_LINGER_MS,
+            "max_batch":DEFAULT_MAX_BATCH,
+            "publish_queue_size":DEFAULT_PUBLISH_QUEUE_SIZE,
+            "publish_queue_policy":DEFAULT_PUBLISH_QUEUE_POLICY,
+            "publish_queue_timeout":DEFAULT_PUBLISH_QUEUE_TIMEOUT,
+            "priority_burst":DEFAULT_PRIORITY_BURST,
+            "reply_timeout":DEFAULT_REPLY_TIMEOUT,
+            "reply_max_bytes":DEFAULT_REPLY_MAX_BYTES,
+            "topic_width":DEFAULT_TOPIC_WIDTH,
+            "stats_interval":DEFAULT_STATS_INTERVAL,
+            "publish_journal_max_bytes":DEFAULT_JOURNAL_MAX_BYTES,
+            "publish_journal_max_age":DEFAULT_JOURNAL_MAX_AGE,
             "ca_bundle_file":certifi.where()
         }
         self.config.update(config_defaults, False)
 
         # Initialize handler
-        self.handler = Handler(self.config, self)
+        self.handler = self.handler_class(self.config, self)
 
         # Access logger functions
         self.critical = self.handler.logger.critical
@@ -288,9 +332,7 @@ class Client(object):
         """
 
         alarm = defs.PublishAlarm(alarm_name, state, message)
-        self.handler.queue_publish(alarm)
-        work = defs.Work(WORK_PUBLISH, None)
-        return self.handler.queue_work(work)
+        return self.handler.queue_publish(alarm)
 
     def attribute_publish(self, attribute_name, value):
         """
@@ -498,6 +540,146 @@ class Client(object):
                                         accuracy=accuracy, fix_type=fix_type)
         return self.handler.queue_publish(location)
 
+    def publish_coalesce(self, name, depth=1):
+        """
+        Only send the newest values of an attribute or telemetry each time
+        pending publishes are flushed. Alarms, events and locations are never
+        coalesced.
+
+        Parameters:
+          name                (string) Name of attribute or telemetry to
+                                       coalesce. "*" applies to all attributes
+                                       and telemetry not set individually.
+          depth                  (int) Number of newest values to keep. None
+                                       stops coalescing this name.
+
+        Returns:
+          STATUS_BAD_PARAMETER         Depth is not a positive number
+          STATUS_SUCCESS               Coalescing updated
+        """
+
+        if depth is not None and depth < 1:
+            return STATUS_BAD_PARAMETER
+        self.handler.lock.acquire()
+        try:
+            if depth is None:
+                self.handler.coalescer.pop(name, None)
+            else:
+                self.handler.coalescer[name] = depth
+        finally:
+            self.handler.lock.release()
+        return STATUS_SUCCESS
+
+    def stats(self):
+        """
+        Get statistics about the Client's traffic with the Cloud, to tell time
+        spent waiting on the device apart from time waiting for the Cloud
+
+        Returns:
+          dict                         "commands": for each TR50 command type,
+                                       the number sent, replied to, failed
+                                       and timed out, and round trip time
+                                       percentiles in seconds ("rtt").
+                                       "publish": totals of publish flushes.
+                                       "publish_queue": size, and publishes
+                                       dropped or rejected.
+                                       "latency": waits in each queue lane.
+                                       "reconnect": reconnection circuit
+                                       breaker state, attempts, failures,
+                                       reconnections, current delay and time
+                                       taken to reconnect.
+                                       "replies": replies pending, timed out
+                                       and given up on.
+                                       "tls": TLS handshakes, how many
+                                       resumed a session and how long they
+                                       took, once TLS has been used.
+                                       "http": HTTPS requests sent by file
+                                       transfers, connections opened for
+                                       them and requests that reused an
+                                       open connection, once a transfer has
+                                       been made.
+        """
+
+        return self.handler.stats()
+
+    def telemetry_aggregate(self, telemetry_name, window, stats=None):
+        """
+        Aggregate telemetry on the device instead of publishing every value.
+        Values published to the property are buffered for each window, and
+        when the window ends the stats of the window are published to
+        "{telemetry_name}.{stat}" with the time the window started.
+
+        Parameters:
+          telemetry_name      (string) Name of property to aggregate
+          window              (number) Length of each window in seconds. None
+                                       stops aggregating the property and
+                                       publishes its current window.
+          stats                 (list) Stats to publish for each window, any of
+                                       "min", "max", "mean", "count" and
+                                       "last". Default is all of them.
+
+        Returns:
+          STATUS_BAD_PARAMETER         Invalid window or stats
+          STATUS_NOT_FOUND             Property is not being aggregated
+          STATUS_SUCCESS               Aggregation updated
+        """
+
+        status = STATUS_SUCCESS
+        try:
+            if window is None:
+                self.handler.aggregator.remove_property(telemetry_name)
+                self.handler.publish_aggregates()
+            else:
+                self.handler.aggregator.add_property(telemetry_name, window,
+                                                     stats)
+        except KeyError:
+            status = STATUS_NOT_FOUND
+        except ValueError as error:
+            self.error(str(error))
+            status = STATUS_BAD_PARAMETER
+        return status
+
+    def telemetry_deadband(self, telemetry_name, absolute=None, percent=None,
+                           heartbeat=None):
+        """
+        Only publish telemetry when it changes significantly. Values that stay
+        within the band around the last published value are dropped before
+        they are queued.
+
+        Parameters:
+          telemetry_name      (string) Name of property to filter. "*" applies
+                                       to all properties without their own
+                                       filter.
+          absolute            (number) Publish when the value moves more than
+                                       this amount
+          percent             (number) Publish when the value moves more than
+                                       this percentage of the last published
+                                       value
+          heartbeat           (number) Publish anyway when nothing has been
+                                       published for this many seconds
+
+        If no options are given, the filter is removed.
+
+        Returns:
+          STATUS_BAD_PARAMETER         Negative band or heartbeat
+          STATUS_NOT_FOUND             No filter to remove
+          STATUS_SUCCESS               Filter updated
+        """
+
+        status = STATUS_SUCCESS
+        try:
+            if absolute is None and percent is None and heartbeat is None:
+                self.handler.deadband.remove_filter(telemetry_name)
+            else:
+                self.handler.deadband.add_filter(telemetry_name, absolute,
+                                                 percent, heartbeat)
+        except KeyError:
+            status = STATUS_NOT_FOUND
+        except ValueError as error:
+            self.error(str(error))
+            status = STATUS_BAD_PARAMETER
+        return status
+
     def telemetry_publish(self, telemetry_name, value, timestamp=None):
         """
         Publish telemetry to the Cloud
@@ -510,6 +692,102 @@ class Client(object):
           STATUS_SUCCESS               Telemetry has been queued for publishing
         """
 
+        # Samples are timed by the publish clock, which may follow the Cloud's
+        if timestamp is None:
+            sample_time = self.handler.clock.now()
+        else:
+            sample_time = defs.epoch_seconds(timestamp)
+        if telemetry_name in self.handler.aggregator:
+            if self.handler.aggregator.add_sample(telemetry_name, value,
+                                                  sample_time):
+                return STATUS_SUCCESS
+            self.warning("Cannot aggregate non-numeric value of \"%s\", "
+                         "publishing it instead", telemetry_name)
+
+        # Drop values that have not changed enough to be worth publishing
+        if not self.handler.deadband.check(telemetry_name, value, sample_time):
+            return STATUS_SUCCESS
+
+        # Numbers are buffered in arrays if the telemetry buffer is enabled
+        if self.handler.telemetry_buffer is not None:
+            status = self.handler.buffer_telemetry(telemetry_name, value,
+                                                   sample_time)
+            if status != STATUS_NOT_SUPPORTED:
+                return status
+
         telem = defs.PublishTelemetry(telemetry_name, value, timestamp)
         return self.handler.queue_publish(telem)
 
+    def telemetry_publish_many(self, telemetry_name, values, timestamps=None):
+        """
+        Publish many samples of telemetry to the Cloud at once. The samples are
+        queued together and encoded straight into publish commands, which is
+        much cheaper than calling telemetry_publish for every sample. Samples
+        are not coalesced.
+
+        Parameters:
+          telemetry_name      (string) Name of property to publish to
+          values            (sequence) Values to publish. Lists, array.array
+                                       and NumPy arrays are accepted.
+          timestamps        (sequence) Optional time of each value, as
+                                       datetimes or seconds since the epoch.
+                                       Default is the time of this call for
+                                       every value.
+
+        Returns:
+          STATUS_BAD_PARAMETER         Number of values and timestamps differ
+          STATUS_SUCCESS               Telemetry has been queued for publishing
+        """
+
+        # Convert arrays to lists of plain numbers that can be encoded
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+        if hasattr(timestamps, "tolist"):
+            timestamps = timestamps.tolist()
+        if timestamps is not None and len(timestamps) != len(values):
+            self.error("Number of values and timestamps do not match")
+            return STATUS_BAD_PARAMETER
+        if not len(values):
+            return STATUS_SUCCESS
+
+        # Samples without times are timed by the publish clock
+        now = self.handler.clock.now()
+
+        # Aggregated samples are buffered instead. Values that are not numbers
+        # are published as they are.
+        if telemetry_name in self.handler.aggregator:
+            add_sample = self.handler.aggregator.add_sample
+            if timestamps is None:
+                values = [x for x in values if not
+                          add_sample(telemetry_name, x, now)]
+            else:
+                samples = [(value, timestamp) for value, timestamp in
+                           zip(values, timestamps) if not
+                           add_sample(telemetry_name, value,
+                                      defs.epoch_seconds(timestamp))]
+                values = [x[0] for x in samples]
+                timestamps = [x[1] for x in samples]
+            if not values:
+                return STATUS_SUCCESS
+            self.warning("Cannot aggregate %d non-numeric values of \"%s\", "
+                         "publishing them instead", len(values),
+                         telemetry_name)
+
+        # Drop values that have not changed enough to be worth publishing
+        if self.handler.deadband.filters:
+            check = self.handler.deadband.check
+            if timestamps is None:
+                values = [x for x in values if check(telemetry_name, x, now)]
+            else:
+                samples = [(value, timestamp) for value, timestamp in
+                           zip(values, timestamps) if
+                           check(telemetry_name, value,
+                                 defs.epoch_seconds(timestamp))]
+                values = [x[0] for x in samples]
+                timestamps = [x[1] for x in samples]
+            if not values:
+                return STATUS_SUCCESS
+
+        telem = defs.PublishTelemetryBulk(telemetry_name, values, timestamps)
+        return self.handler.queue_publish(telem)
+
@@ -0,0 +1,206 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the JSON codec used for messages to and from the Cloud.
+The fastest installed JSON library (orjson, ujson or rapidjson) is used, falling
+back to the standard library json module.
+"""
+
+import json
+import re
+import sys
+
+# C string escaping used by the json module, when available
+try:
+    from json.encoder import c_encode_basestring_ascii as encode_string
+except ImportError:
+    encode_string = None
+if not encode_string:
+    from json.encoder import encode_basestring_ascii as encode_string
+
+if sys.version_info.major == 2:
+    STRING_TYPES = (str, unicode)
+else:
+    STRING_TYPES = (str,)
+
+# Fast JSON libraries are optional modules. Like the json module, they escape
+# non-ASCII characters.
+BACKENDS = {}
+try:
+    import orjson
+
+    def _orjson_dumps(obj):
+        data = orjson.dumps(obj)
+        if not data.isascii():
+            # orjson cannot escape non-ASCII characters
+            raise ValueError("Non-ASCII characters are not escaped")
+        return data.decode("ascii")
+    BACKENDS["orjson"] = (_orjson_dumps, orjson.loads)
+except ImportError:
+    pass
+try:
+    import ujson
+    BACKENDS["ujson"] = (lambda obj: ujson.dumps(obj, ensure_ascii=True,
+                                                 escape_forward_slashes=False),
+                         ujson.loads)
+except ImportError:
+    pass
+try:
+    import rapidjson
+    BACKENDS["rapidjson"] = (lambda obj: rapidjson.dumps(obj,
+                                                         ensure_ascii=True),
+                             rapidjson.loads)
+except ImportError:
+    pass
+_encoder = json.JSONEncoder(separators=(",", ":"))
+BACKENDS["json"] = (_encoder.encode, json.loads)
+
+# Backends in order of preference
+PREFERENCE = ["orjson", "ujson", "rapidjson", "json"]
+
+INFINITY = float("inf")
+
+# Numbers a fast backend may write differently from the json module: floats
+# in exponent notation, below 1e-4 or above 1e16 (which the json module writes
+# in exponent notation), NaN and Infinity. Numbers follow a colon, comma or
+# bracket, so this only matches inside strings that look like JSON.
+INEXACT_NUMBER = re.compile(
+    r"(?:^|[:,\[])(?:-?(?:[0-9.]+[eE]|0\.0000|[0-9]{17,}\.)|NaN|-?Inf)")
+
+# orjson writes NaN and Infinity as null
+NULL = re.compile(r"(?:^|[:,\[])null")
+
+# Name of the backend in use
+name = None
+_dumps = None
+_loads = None
+
+
+def available():
+    """
+    Get the names of the installed backends, in order of preference
+    """
+
+    return [x for x in PREFERENCE if x in BACKENDS]
+
+
+def dumps(obj):
+    """
+    Encode an object as compact JSON, exactly as the json module would. Anything
+    a fast backend cannot encode the same way (such as integers over 64 bits,
+    floats in exponent notation or NaN) is encoded by the json module instead.
+    """
+
+    if name != "json":
+        data = _dumps_fast(obj)
+        if data is not None:
+            return data
+    return _encoder.encode(obj)
+
+
+def dumps_value(value):
+    """
+    Encode a single value exactly as dumps would encode it inside a dict or
+    list. Plain strings and numbers are encoded the way the json module
+    encodes them whichever backend is in use, skipping its encoder machinery.
+    """
+
+    value_type = type(value)
+    if value_type in STRING_TYPES:
+        return encode_string(value)
+    if value_type is float:
+        if value != value or value in (INFINITY, -INFINITY):
+            return json.dumps(value)
+        return float.__repr__(value)
+    if value_type is int:
+        return str(value)
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if name == "json":
+        return _encoder.encode(value)
+    data = _dumps_fast(value)
+    if data is None:
+        data = _encoder.encode(value)
+    return data
+
+
+def dumps_pretty(obj):
+    """
+    Encode an object as indented JSON with sorted keys, for logging
+    """
+
+    return json.dumps(obj, indent=2, sort_keys=True)
+
+
+def loads(data):
+    """
+    Decode JSON from a string, or from UTF-8 encoded bytes without making a
+    string copy first if the backend supports it
+    """
+
+    if (name == "json" and sys.version_info.major == 3 and
+            isinstance(data, (bytes, bytearray))):
+        data = data.decode("utf-8")
+    return _loads(data)
+
+
+def _dumps_fast(obj):
+    """
+    Encode with a fast backend, or return None if the result could differ from
+    the json module's: floats the json module writes in exponent notation,
+    NaN, Infinity or an unescaped DEL character.
+    """
+
+    try:
+        data = _dumps(obj)
+    except (OverflowError, TypeError, ValueError):
+        return None
+    if "\x7f" in data or INEXACT_NUMBER.search(data):
+        return None
+    if NULL.search(data) and not _finite(obj):
+        return None
+    return data
+
+
+def _finite(obj):
+    """
+    Check that a float, and every float in a dict, list or tuple, is finite
+    """
+
+    if isinstance(obj, float):
+        return obj - obj == 0.0
+    if isinstance(obj, dict):
+        return all(_finite(x) for x in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return all(_finite(x) for x in obj)
+    return True
+
+
+def use(backend=None):
+    """
+    Select a backend by name, or the most preferred installed backend if no
+    name is given. Raises KeyError if the backend is not installed.
+    """
+
+    global name, _dumps, _loads
+    if backend is None:
+        backend = available()[0]
+    _dumps, _loads = BACKENDS[backend]
+    name = backend
+    return name
+
+
+use()
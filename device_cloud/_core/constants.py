@@ -25,10 +25,78 @@ DEFAULT_CONFIG_FILE = "{}-connect.cfg"
 # Number of seconds to attempt to reconnect if disconnected
 # 0 means retry forever
 DEFAULT_KEEP_ALIVE = 0
+# Default number of seconds the first reconnection attempt is delayed by, at
+# most. The delay doubles for each failed attempt, and a random part of it is
+# used so devices don't all retry at once.
+DEFAULT_RECONNECT_DELAY = 1
+# Default maximum number of seconds between reconnection attempts
+DEFAULT_RECONNECT_MAX_DELAY = 120
 # Default loop time for MQTT in seconds
 DEFAULT_LOOP_TIME = 1
 # Default number of worker threads
 DEFAULT_THREAD_COUNT = 3
+# Default number of milliseconds to wait for more publishes once one is queued,
+# so they can be sent together
+DEFAULT_LINGER_MS = 5
+# Default number of queued publishes that are flushed without waiting for the
+# linger time to end
+# 0 means no limit
+DEFAULT_MAX_BATCH = 500
+# Default maximum number of HTTPS connections kept open for reuse by file
+# transfers
+DEFAULT_HTTP_POOL_SIZE = 4
+# Default for logging each command that is sent. Disabling this skips
+# building descriptions of publishes.
+DEFAULT_LOG_COMMANDS = True
+# Default for timing publishes by the Cloud's clock, using the offset from it
+# measured with diag.time when connecting
+DEFAULT_CLOUD_TIME = False
+# Default maximum number of commands sent in a single publish request
+# 0 means no limit
+DEFAULT_PUBLISH_MAX_COMMANDS = 500
+# Default maximum size in bytes of a single publish request
+# 0 means no limit
+DEFAULT_PUBLISH_MAX_BYTES = 131072
+# Default maximum number of publishes waiting to be sent
+# 0 means no limit
+DEFAULT_PUBLISH_QUEUE_SIZE = 0
+# Default policy when the publish queue is full
+DEFAULT_PUBLISH_QUEUE_POLICY = "reject"
+# Default number of seconds to wait for room in a full publish queue, when
+# using the "block" policy
+# 0 means wait forever
+DEFAULT_PUBLISH_QUEUE_TIMEOUT = 0
+# Default number of priority items served in a row before one bulk item is
+# served, if any are waiting
+DEFAULT_PRIORITY_BURST = 8
+# Default for buffering numeric telemetry in arrays instead of queuing a
+# publish for every sample. Not used when publishes are journaled.
+DEFAULT_TELEMETRY_BUFFER = False
+# Default number of seconds to wait for a reply to a sent command before
+# giving up on it
+# 0 means wait forever
+DEFAULT_REPLY_TIMEOUT = 300
+# Default maximum size in bytes of sent commands waiting for replies. The
+# oldest are given up on when over the limit.
+# 0 means no limit
+DEFAULT_REPLY_MAX_BYTES = 4194304
+# Default number of digits in the topic numbers requests are sent on. Topic
+# numbers are reused once all of their commands are replied to.
+DEFAULT_TOPIC_WIDTH = 4
+# Default number of seconds between publishing round trip times of commands
+# as telemetry
+# 0 means never
+DEFAULT_STATS_INTERVAL = 0
+# Default maximum size in bytes of the publish journal
+# 0 means no limit
+DEFAULT_JOURNAL_MAX_BYTES = 16777216
+# Default maximum age in seconds of publishes in the publish journal
+# 0 means no limit
+DEFAULT_JOURNAL_MAX_AGE = 604800
+
+
+# Number of seconds between MQTT keep alives
+MQTT_KEEP_ALIVE = 60
 
 
 # PORTS THAT REQUIRE SSL CONNECTIONS
@@ -39,6 +107,48 @@ SECURE_PORTS = [
 ]
 
 
+# POLICIES FOR A FULL PUBLISH QUEUE
+
+# Wait for room in the queue, returning STATUS_TIMED_OUT on timeout
+QUEUE_POLICY_BLOCK = "block"
+# Drop the oldest publish in the queue to make room
+QUEUE_POLICY_DROP_OLDEST = "drop_oldest"
+# Drop the new publish
+QUEUE_POLICY_DROP_NEWEST = "drop_newest"
+# Refuse the new publish, returning STATUS_FULL
+QUEUE_POLICY_REJECT = "reject"
+
+QUEUE_POLICIES = [
+    QUEUE_POLICY_BLOCK,
+    QUEUE_POLICY_DROP_OLDEST,
+    QUEUE_POLICY_DROP_NEWEST,
+    QUEUE_POLICY_REJECT
+]
+
+
+# QUEUE LANES
+
+# Alarms, action acknowledgements and control traffic
+LANE_PRIORITY = "priority"
+# Telemetry, logs and file transfers
+LANE_BULK = "bulk"
+
+LANES = [
+    LANE_PRIORITY,
+    LANE_BULK
+]
+
+
+# RECONNECTION CIRCUIT BREAKER STATES
+
+# Connected
+BREAKER_CLOSED = "closed"
+# Disconnected, waiting for the next reconnection attempt
+BREAKER_OPEN = "open"
+# Reconnection attempt in progress
+BREAKER_HALF_OPEN = "half_open"
+
+
 # CONNECTION STATES
 
 # Not connected to Cloud
@@ -126,6 +236,9 @@ LOG_TIME_FORMAT = "%b %d %H:%M:%S"
 # Time format supported by Cloud
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
+# Values that can be derived from each window of aggregated telemetry
+AGGREGATE_STATS = ("min", "max", "mean", "count", "last")
+
 
 # TYPES OF WORK
 
@@ -139,3 +252,11 @@ WORK_ACTION = 2
 WORK_DOWNLOAD = 3
 # Upload a file
 WORK_UPLOAD = 4
+# Reconnect MQTT
+WORK_RECONNECT = 5
+
+# Publish types sent in the priority lane
+PRIORITY_PUBLISH_TYPES = ("PublishAlarm",)
+# Work types handled in the priority lane
+PRIORITY_WORK_TYPES = (WORK_MESSAGE, WORK_PUBLISH, WORK_ACTION,
+                       WORK_RECONNECT)
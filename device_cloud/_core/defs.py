@@ -15,13 +15,28 @@
 This module defines several helper classes for use in the device_cloud handler
 """
 
+import calendar
+import heapq
 import inspect
-import json
+import math
+import random
 import subprocess
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections import deque
 from datetime import datetime
 
+from device_cloud._core import codec
 from device_cloud._core import constants
 
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
 class Action(object):
     """
     Holds information associating an action and a callback
@@ -42,8 +57,12 @@ class Action(object):
         Execute callback
         """
 
-        # Determine the callback prototype that we have
-        signature = inspect.getargspec(self.callback)
+        # Determine the callback prototype that we have. getargspec was removed
+        # in Python 3.11.
+        getargspec = getattr(inspect, "getargspec", None)
+        if not getargspec:
+            getargspec = inspect.getfullargspec
+        signature = getargspec(self.callback)
         args = []
         arglen = len(signature.args)
 
@@ -171,6 +190,146 @@ class Callbacks(dict):
             del self[action_name]
 
 
+class Clock(object):
+    """
+    Records publish times as seconds since the epoch, and formats them in the
+    Cloud's time format only when they are sent. The formatted date and time
+    of the last second formatted is reused. An offset can be added so recorded
+    times follow the Cloud's clock. Each handler has its own clock, so clients
+    connected to different Clouds keep their own offsets.
+    """
+
+    def __init__(self):
+        # Seconds to add to the local time
+        self.offset = 0.0
+        self.prefix_format, self.suffix = constants.TIME_FORMAT.split("%f")
+        self.cached = (None, None)
+
+    def format(self, seconds):
+        """
+        Format seconds since the epoch in the Cloud's time format
+        """
+
+        whole = int(math.floor(seconds))
+        micro = int(round((seconds - whole) * 1000000))
+        if micro >= 1000000:
+            whole += 1
+            micro -= 1000000
+
+        # Only one cached second, replaced in a single assignment so threads
+        # can share it
+        cached = self.cached
+        if cached[0] != whole:
+            cached = (whole, time.strftime(self.prefix_format,
+                                           time.gmtime(whole)))
+            self.cached = cached
+        return "{}{:06d}{}".format(cached[1], micro, self.suffix)
+
+    def now(self):
+        """
+        Get the current time in seconds since the epoch
+        """
+
+        return time.time() + self.offset
+
+
+class CommandDump(object):
+    """
+    Pretty prints a command only if it is converted to a string, so it costs
+    nothing when the log record it is passed to is discarded. The command can
+    be already encoded.
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def __str__(self):
+        command = self.command
+        if not isinstance(command, dict):
+            command = codec.loads(command)
+        return codec.dumps_pretty(command)
+
+
+class Completion(object):
+    """
+    Result of something that finishes later, such as a reply to a sent
+    command, a file transfer or a connection. Waiters are woken through a
+    condition variable as soon as it is finished.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.status = None
+        self.result = None
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """
+        Call callback with this completion once it is finished, or now if it
+        already is
+        """
+
+        self.condition.acquire()
+        try:
+            if self.status is None:
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.condition.release()
+        callback(self)
+
+    def done(self):
+        """
+        Check whether this has finished
+        """
+
+        return self.status is not None
+
+    def finish(self, status, result=None):
+        """
+        Finish with a status and an optional result, such as the reply to a
+        command. Returns False if this had already finished.
+        """
+
+        self.condition.acquire()
+        try:
+            if self.status is not None:
+                return False
+            self.status = status
+            self.result = result
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait until this has finished, for up to timeout seconds (None or 0
+        waits forever). Returns the status, or None if it has not finished.
+        """
+
+        end_time = None
+        if timeout:
+            end_time = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while self.status is None:
+                if end_time is None:
+                    self.condition.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            return self.status
+        finally:
+            self.condition.release()
+
+
 class Config(dict):
     """
     Holds all configuration information about the Client
@@ -190,7 +349,7 @@ class Config(dict):
         self.__setitem__(attr, value)
 
     def __str__(self):
-        return json.dumps(self, indent=2, sort_keys=True)
+        return codec.dumps_pretty(self)
 
     def update(self, other, overwrite=True):
         # Update self with values from other dict
@@ -218,9 +377,23 @@ class Config(dict):
                     self[key] = value
 
 
+class Description(object):
+    """
+    Message description that is only formatted if it is converted to a string
+    """
+
+    def __init__(self, fmt, *args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+
 class FileTransfer(object):
     """
-    Holds information about pending file transfers
+    Holds information about pending file transfers. The transfer's completion
+    is finished when its status is first set.
     """
 
     def __init__(self, file_name, file_path, client, callback=None,
@@ -231,7 +404,19 @@ class FileTransfer(object):
         self.callback = callback
         self.file_id = file_id
         self.file_checksum = file_checksum
-        self.status = None
+        self.completion = Completion()
+
+    @property
+    def status(self):
+        """
+        Status of the transfer, None until it has finished
+        """
+
+        return self.completion.status
+
+    @status.setter
+    def status(self, status):
+        self.completion.finish(status)
 
     def finish(self):
         """
@@ -241,59 +426,352 @@ class FileTransfer(object):
             self.callback(self.client, self.file_name, self.status)
 
 
+class Histogram(object):
+    """
+    Histogram of durations in seconds. Bucket bounds grow by a fixed ratio,
+    so percentiles are accurate to within that ratio at any scale while the
+    memory used stays the same however many values are added.
+    """
+
+    # Upper bound of the first bucket, the growth of each bucket's upper
+    # bound over the last, and the number of buckets (up to about 4 minutes)
+    MINIMUM = 0.0001
+    RATIO = 1.05
+    BUCKETS = 300
+    LOG_RATIO = math.log(RATIO)
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        Add a duration
+        """
+
+        index = 0
+        if value > self.MINIMUM:
+            index = min(int(math.ceil(math.log(value / self.MINIMUM) /
+                                      self.LOG_RATIO)), self.BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Get the duration that percent of the durations added are no longer
+        than, rounded up to the bucket bound
+        """
+
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(self.count * percent / 100.0)), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if index == self.BUCKETS - 1:
+                    # The last bucket has no upper bound
+                    break
+                return min(self.MINIMUM * self.RATIO ** index, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Get the count, mean, median, 95th and 99th percentiles and maximum
+        """
+
+        return {"count":self.count,
+                "mean":self.total / self.count if self.count else 0.0,
+                "p50":self.percentile(50),
+                "p95":self.percentile(95),
+                "p99":self.percentile(99),
+                "max":self.max}
+
+
+class LaneQueue(queue.Queue):
+    """
+    Queue that serves items in the priority lane before items in the bulk lane.
+    After burst priority items in a row, one bulk item is served if any are
+    waiting so the bulk lane is never starved. Records how long items wait in
+    each lane.
+    """
+
+    def __init__(self, maxsize=0, lane=None, burst=0):
+        # Function returning the lane of an item
+        self.lane = lane or (lambda item: constants.LANE_BULK)
+        self.burst = burst or constants.DEFAULT_PRIORITY_BURST
+        self.latency = dict((x, {"count":0, "total":0.0, "max":0.0})
+                            for x in constants.LANES)
+        queue.Queue.__init__(self, maxsize)
+
+    def latency_stats(self):
+        """
+        Get the number of items served from each lane, and their average and
+        longest waits in seconds
+        """
+
+        self.mutex.acquire()
+        try:
+            stats = {}
+            for lane, latency in self.latency.items():
+                stats[lane] = {"count":latency["count"],
+                               "max":latency["max"],
+                               "mean":(latency["total"] / latency["count"]
+                                       if latency["count"] else 0.0)}
+            return stats
+        finally:
+            self.mutex.release()
+
+    # Queue storage hooks, called by Queue with the mutex held
+
+    def _init(self, maxsize):
+        self.lanes = dict((x, deque()) for x in constants.LANES)
+        self.run = 0
+
+    def _qsize(self):
+        return sum(len(x) for x in self.lanes.values())
+
+    def _put(self, item):
+        self.lanes[self.lane(item)].append((time.time(), item))
+
+    def _get(self):
+        priority = self.lanes[constants.LANE_PRIORITY]
+        bulk = self.lanes[constants.LANE_BULK]
+        if priority and (self.run < self.burst or not bulk):
+            lane = constants.LANE_PRIORITY
+            self.run += 1
+        else:
+            lane = constants.LANE_BULK
+            self.run = 0
+        queued, item = self.lanes[lane].popleft()
+        self._record(lane, queued)
+        return item
+
+    def _discard(self):
+        """
+        Remove the oldest bulk item, or the oldest priority item if there are
+        no bulk items, to make room
+        """
+
+        bulk = self.lanes[constants.LANE_BULK]
+        if bulk:
+            bulk.popleft()
+        else:
+            self.lanes[constants.LANE_PRIORITY].popleft()
+
+    def _record(self, lane, queued):
+        """
+        Record the time an item waited in a lane
+        """
+
+        wait = max(time.time() - queued, 0.0)
+        latency = self.latency[lane]
+        latency["count"] += 1
+        latency["total"] += wait
+        if wait > latency["max"]:
+            latency["max"] = wait
+
+
 class Message(object):
     """
     Holds received messages in their json format
     """
 
+    __slots__ = ("topic", "json")
+
     def __init__(self, topic, json_msg):
         self.topic = topic
         self.json = json_msg
 
     def __str__(self):
-        return json.dumps(self.json, indent=2, sort_keys=True)
+        return codec.dumps_pretty(self.json)
 
 
 
 class OutMessage(object):
     """
-    Hold sent messages and their timestamps so that their replies can be handled
+    Hold sent messages and their timestamps so that their replies can be handled.
+    The command is either a dict, or a string already encoded by one of the
+    tr50.encode_* functions along with its command type. A timeout in seconds
+    overrides the default time to wait for a reply (0 waits forever), and
+    on_timeout is called with the message if no reply arrives in time. Any
+    completion is finished with the reply.
     """
 
+    __slots__ = ("command", "description", "timestamp", "data", "out_id",
+                 "journal_id", "command_type", "timeout", "on_timeout",
+                 "deadline", "size", "completion")
+
     def __init__(self, command, description, timestamp=None, data=None,
-                 out_id=None):
+                 out_id=None, journal_id=None, command_type=None,
+                 timeout=None, on_timeout=None):
         self.command = command
         self.description = description
         self.timestamp = timestamp
         self.data = data
         self.out_id = out_id
+        self.journal_id = journal_id
+        if command_type is None:
+            command_type = command.get("command")
+        self.command_type = command_type
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.deadline = None
+        self.size = 0
+        self.completion = None
 
     def __str__(self):
-        return self.description
+        if self.description is None:
+            return str(self.command_type)
+        return str(self.description)
 
 
-class OutTracker(dict):
+class OutTracker(OrderedDict):
     """
-    Holds all sent messages that are waiting for a reply
+    Holds all sent messages that are waiting for a reply, in the order they
+    were sent. Messages that have not been replied to by their deadline are
+    removed by expire(), using a heap of deadlines. If the messages tracked
+    are larger than max_bytes in total, the oldest are removed as well. Each
+    topic number stays allocated until all of its messages are removed.
     """
 
-    def __init__(self):
+    def __init__(self, timeout=0, max_bytes=0, topic_width=4):
         super(OutTracker, self).__init__()
-        self.mid_tracker = {}
-
-    def add_message(self, message):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.deadlines = []
+        self.sequence = 0
+
+        # Topic numbers, with the number of messages tracked for each
+        self.topics = TopicAllocator(topic_width)
+        self.topic_counts = {}
+
+        # Topics of MIDs that have not been published yet, in the order they
+        # were sent, with the time they were sent. MIDs are published by the
+        # MQTT thread, and QoS 0 MIDs can be published before they are added.
+        self.mid_tracker = OrderedDict()
+        self.mid_published = OrderedDict()
+        self.mid_lock = threading.Lock()
+
+        # Totals for messages removed without a reply
+        self.timed_out = 0
+        self.evicted = 0
+
+    def add_message(self, message, now=None):
         """
-        Add a message
+        Add a message. Returns the oldest messages that had to be removed to
+        stay under max_bytes.
         """
 
+        if now is None:
+            now = time.time()
+        timeout = message.timeout
+        if timeout is None:
+            timeout = self.timeout
+        if timeout:
+            message.deadline = now + timeout
+            self.sequence += 1
+            heapq.heappush(self.deadlines, (message.deadline, self.sequence,
+                                            message.out_id))
         self[message.out_id] = message
+        self.size += message.size
+        topic = message.out_id.rpartition("-")[0]
+        self.topic_counts[topic] = self.topic_counts.get(topic, 0) + 1
+
+        evicted = []
+        while self.max_bytes and self.size > self.max_bytes and len(self) > 1:
+            evicted.append(self._remove(next(iter(self))))
+        self.evicted += len(evicted)
+        return evicted
 
-    def add_mid(self, mid, topic):
+    def add_mid(self, mid, topic, now=None):
         """
         Add an MID with the topic it will send on
         """
 
-        self.mid_tracker[mid] = topic
+        if now is None:
+            now = time.time()
+        self.mid_lock.acquire()
+        try:
+            if self.mid_published.pop(mid, None) is None:
+                self.mid_tracker[mid] = (topic, now)
+        finally:
+            self.mid_lock.release()
+
+    def expire(self, now=None):
+        """
+        Remove messages that are past their deadline, and MIDs that were not
+        published within the default timeout. Returns the expired messages.
+        """
+
+        if now is None:
+            now = time.time()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, out_id = heapq.heappop(self.deadlines)
+
+            # Entries for messages that were replied to are left in the heap
+            message = self.get(out_id)
+            if message is not None and message.deadline == deadline:
+                expired.append(self._remove(out_id))
+        self.timed_out += len(expired)
+
+        if self.timeout:
+            oldest = now - self.timeout
+            self.mid_lock.acquire()
+            try:
+                while self.mid_tracker:
+                    mid = next(iter(self.mid_tracker))
+                    if self.mid_tracker[mid][1] > oldest:
+                        break
+                    del self.mid_tracker[mid]
+                while self.mid_published:
+                    mid = next(iter(self.mid_published))
+                    if self.mid_published[mid] > oldest:
+                        break
+                    del self.mid_published[mid]
+            finally:
+                self.mid_lock.release()
+
+        # Drop heap entries of replied messages once they make up most of it
+        if len(self.deadlines) > 64 and len(self.deadlines) > 2 * len(self):
+            self.deadlines = [x for x in self.deadlines if
+                              x[2] in self and self[x[2]].deadline == x[0]]
+            heapq.heapify(self.deadlines)
+        return expired
+
+    def new_topic(self):
+        """
+        Allocate a topic number for a request. If every topic number is in
+        use, the oldest messages are removed until one is released. Returns
+        the topic number and the messages that were removed.
+        """
+
+        evicted = []
+        topic = self.topics.allocate()
+        while topic is None and self:
+            evicted.append(self._remove(next(iter(self))))
+            topic = self.topics.allocate()
+        self.evicted += len(evicted)
+        if topic is None:
+            raise RuntimeError("No topic numbers available")
+        return topic, evicted
+
+    def next_deadline(self):
+        """
+        Earliest deadline of the messages tracked, or None if none have one.
+        May be the deadline of a message that was already replied to.
+        """
+
+        if self.deadlines:
+            return self.deadlines[0][0]
+        return None
 
     def pop_message(self, topic_num, cmd_num):
         """
@@ -301,29 +779,59 @@ class OutTracker(dict):
         """
 
         out_id = "{}-{}".format(topic_num, cmd_num)
-        try:
-            message = self.pop(out_id)
-        except KeyError:
+        if out_id not in self:
             raise KeyError("Message {} not found. May be a duplicate "
                            "reply".format(out_id))
-        return message
+        return self._remove(out_id)
 
     def pop_mid(self, mid):
         """
-        Retrieve the topic an MID is sending on
+        Retrieve the topic an MID is sending on. Returns None for unknown MIDs.
+        """
+
+        self.mid_lock.acquire()
+        try:
+            entry = self.mid_tracker.pop(mid, None)
+            if entry is None:
+                self.mid_published[mid] = time.time()
+                return None
+        finally:
+            self.mid_lock.release()
+        return entry[0]
+
+    def _remove(self, out_id):
+        """
+        Remove a message and stop counting its size
         """
 
-        return self.mid_tracker.pop(mid)
+        message = self.pop(out_id)
+        self.size -= message.size
+        topic = out_id.rpartition("-")[0]
+        count = self.topic_counts[topic] - 1
+        if count:
+            self.topic_counts[topic] = count
+        else:
+            del self.topic_counts[topic]
+            self.topics.release(topic)
+        return message
 
 
 class Publish(object):
     """
-    Super Class for holding information about a pending publish
+    Super Class for holding information about a pending publish. Publishes
+    use slots so that large backlogs of them stay small.
     """
 
+    __slots__ = ("timestamp", "journal_id")
+
+    # Name of the publish class, set by each subclass
+    type = "Publish"
+
     def __init__(self):
-        self.timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
-        self.type = self.__class__.__name__
+        # Seconds since the epoch, formatted when the publish is sent. Set by
+        # the handler's clock when the publish is queued if not given.
+        self.timestamp = None
+        self.journal_id = None
 
 
 class PublishAlarm(Publish):
@@ -331,6 +839,9 @@ class PublishAlarm(Publish):
     Holds information about an alarm
     """
 
+    __slots__ = ("name", "state", "message")
+    type = "PublishAlarm"
+
     def __init__(self, name, state, message=None):
         super(PublishAlarm, self).__init__()
         self.name = name
@@ -343,17 +854,75 @@ class PublishAttribute(Publish):
     Holds information about an attribute that is to be published
     """
 
+    __slots__ = ("name", "value")
+    type = "PublishAttribute"
+
     def __init__(self, name, value):
         super(PublishAttribute, self).__init__()
         self.name = name
         self.value = value
 
 
+class PublishCoalescer(dict):
+    """
+    Dict of attribute and telemetry names to the number of newest values of
+    each to keep when flushing pending publishes. The name "*" applies to any
+    attribute or telemetry not named on its own.
+    """
+
+    # Publish types that can be coalesced. Alarms, locations and logs are
+    # always sent in full.
+    coalesce_types = ("PublishAttribute", "PublishTelemetry")
+
+    def __init__(self, depths=None):
+        super(PublishCoalescer, self).__init__()
+        if depths:
+            self.update(depths)
+
+    def depth(self, name):
+        """
+        Number of values to keep for a name, or None to keep all of them
+        """
+
+        depth = self.get(name)
+        if depth is None:
+            depth = self.get("*")
+        return depth
+
+    def filter(self, publishes):
+        """
+        Return a list of publishes keeping only the newest values of each
+        coalesced attribute and telemetry, in their original order
+        """
+
+        if not self:
+            return publishes
+
+        kept = []
+        counts = {}
+        for pub in reversed(publishes):
+            if pub.type in self.coalesce_types:
+                depth = self.depth(pub.name)
+                if depth is not None:
+                    key = (pub.type, pub.name)
+                    count = counts.get(key, 0)
+                    counts[key] = count + 1
+                    if count >= depth:
+                        continue
+            kept.append(pub)
+        kept.reverse()
+        return kept
+
+
 class PublishLocation(Publish):
     """
     Holds location information
     """
 
+    __slots__ = ("latitude", "longitude", "heading", "altitude", "speed",
+                 "accuracy", "fix_type")
+    type = "PublishLocation"
+
     def __init__(self, latitude, longitude, heading=None, altitude=None,
                  speed=None, accuracy=None, fix_type=None):
         super(PublishLocation, self).__init__()
@@ -386,31 +955,779 @@ class PublishLog(Publish):
     Holds a log message to be sent to the Cloud
     """
 
+    __slots__ = ("message",)
+    type = "PublishLog"
+
     def __init__(self, message):
         super(PublishLog, self).__init__()
         self.message = message
 
 
+class PublishQueue(LaneQueue):
+    """
+    Queue of pending publishes with a policy for what to do when it is full.
+    Alarms are served before other publishes, and bulk publishes are dropped
+    first to make room.
+    """
+
+    def __init__(self, maxsize=0, burst=0):
+        # Publishes dropped to make room, or because there was no room
+        self.dropped = 0
+        # Publishes refused because there was no room
+        self.rejected = 0
+        LaneQueue.__init__(self, maxsize, lane=publish_lane, burst=burst)
+
+    def put_policy(self, item, policy, timeout=0):
+        """
+        Put a publish in the queue, applying a policy if the queue is full.
+        A timeout of 0 blocks forever.
+        """
+
+        status = constants.STATUS_SUCCESS
+        if policy == constants.QUEUE_POLICY_BLOCK:
+            try:
+                self.put(item, True, timeout or None)
+            except queue.Full:
+                self.rejected += 1
+                status = constants.STATUS_TIMED_OUT
+
+        elif policy == constants.QUEUE_POLICY_DROP_OLDEST:
+            self.mutex.acquire()
+            try:
+                if 0 < self.maxsize <= self._qsize():
+                    self._discard()
+                    self.dropped += 1
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+            finally:
+                self.mutex.release()
+
+        else:
+            try:
+                self.put_nowait(item)
+            except queue.Full:
+                if policy == constants.QUEUE_POLICY_DROP_NEWEST:
+                    self.dropped += 1
+                else:
+                    self.rejected += 1
+                    status = constants.STATUS_FULL
+
+        return status
+
+
 class PublishTelemetry(Publish):
     """
     Holds information about telemetry that is to be published
     """
 
+    __slots__ = ("name", "value")
+    type = "PublishTelemetry"
+
     def __init__(self, name, value, timestamp=None):
         super(PublishTelemetry, self).__init__()
-        if type(timestamp) is datetime:
-            self.timestamp = timestamp.strftime(constants.TIME_FORMAT)
+        if timestamp is not None:
+            self.timestamp = epoch_seconds(timestamp)
         self.name = name
         self.value = value
 
 
+class PublishTelemetryBulk(Publish):
+    """
+    Holds many samples of one telemetry property that are to be published
+    """
+
+    __slots__ = ("name", "values", "timestamps")
+    type = "PublishTelemetryBulk"
+
+    def __init__(self, name, values, timestamps=None):
+        super(PublishTelemetryBulk, self).__init__()
+        self.name = name
+        self.values = values
+        if timestamps is not None and not isinstance(timestamps, array):
+            # Datetimes are kept as seconds so they can be journaled
+            timestamps = [epoch_seconds(x) for x in timestamps]
+        self.timestamps = timestamps
+
+    def __len__(self):
+        return len(self.values)
+
+    def samples(self, clock):
+        """
+        Generate (value, timestamp) pairs for each sample, formatting the
+        timestamps that were given as datetimes or seconds since the epoch
+        with clock
+        """
+
+        if self.timestamps is None:
+            timestamp = format_timestamp(self.timestamp, clock)
+            for value in self.values:
+                yield value, timestamp
+        else:
+            for value, timestamp in zip(self.values, self.timestamps):
+                yield value, format_timestamp(timestamp, clock)
+
+
+class ReconnectBackoff(object):
+    """
+    Schedules reconnection attempts with exponential backoff and full jitter,
+    so devices that lose their connection at the same time spread their
+    attempts out instead of retrying in lockstep. The delay before each
+    attempt is random, up to base seconds doubled for every failed attempt in
+    a row, but no more than maximum seconds. Works as a circuit breaker:
+    closed while connected, open while waiting for the next attempt and half
+    open while an attempt is in progress.
+    """
+
+    def __init__(self, base, maximum):
+        self.base = base
+        self.maximum = maximum
+        self.state = constants.BREAKER_CLOSED
+        self.failures = 0
+        self.delay = 0.0
+        self.next_attempt = None
+        self.disconnected_time = None
+
+        # Totals for attempts, failed attempts and reconnections, and the
+        # times taken to reconnect
+        self.attempts = 0
+        self.failed = 0
+        self.reconnects = 0
+        self.reconnect_times = Histogram()
+
+    def attempt(self, now=None):
+        """
+        Check whether an attempt is due. If it is, the breaker is half open
+        until the attempt succeeds or fails.
+        """
+
+        if now is None:
+            now = time.time()
+        if (self.state != constants.BREAKER_OPEN or
+                now < self.next_attempt):
+            return False
+        self.state = constants.BREAKER_HALF_OPEN
+        self.attempts += 1
+        return True
+
+    def disconnected(self, now=None):
+        """
+        Note that the connection was lost, or that an attempt in progress
+        ended without connecting
+        """
+
+        if now is None:
+            now = time.time()
+        if self.state == constants.BREAKER_CLOSED:
+            self.disconnected_time = now
+            self.failures = 0
+            self._schedule(now)
+        elif self.state == constants.BREAKER_HALF_OPEN:
+            self.failure(now)
+
+    def failure(self, now=None):
+        """
+        Note that an attempt failed, and schedule the next one with a longer
+        delay
+        """
+
+        if self.state != constants.BREAKER_HALF_OPEN:
+            return
+        if now is None:
+            now = time.time()
+        self.failed += 1
+        self.failures += 1
+        self._schedule(now)
+
+    def remaining(self, now=None):
+        """
+        Get the number of seconds until the next attempt is due. None if no
+        attempt is scheduled.
+        """
+
+        if self.state != constants.BREAKER_OPEN:
+            return None
+        if now is None:
+            now = time.time()
+        return max(self.next_attempt - now, 0.0)
+
+    def stats(self):
+        """
+        Get the breaker state, attempt counts, current delay and times taken
+        to reconnect
+        """
+
+        return {"state":self.state,
+                "attempts":self.attempts,
+                "failures":self.failed,
+                "reconnects":self.reconnects,
+                "delay":self.delay,
+                "time_to_reconnect":self.reconnect_times.summary()}
+
+    def success(self, now=None):
+        """
+        Note that the connection was made
+        """
+
+        if now is None:
+            now = time.time()
+        if self.disconnected_time is not None:
+            self.reconnects += 1
+            self.reconnect_times.add(now - self.disconnected_time)
+        self.state = constants.BREAKER_CLOSED
+        self.failures = 0
+        self.delay = 0.0
+        self.next_attempt = None
+        self.disconnected_time = None
+
+    def _schedule(self, now):
+        """
+        Open the breaker until a random time within the current delay
+        """
+
+        ceiling = min(self.maximum, self.base * 2 ** min(self.failures, 32))
+        self.delay = random.uniform(0, ceiling)
+        self.next_attempt = now + self.delay
+        self.state = constants.BREAKER_OPEN
+
+
+class TelemetryAggregator(object):
+    """
+    Buffers numeric telemetry samples per property over fixed time windows and
+    produces telemetry publishes of values derived from each window when it
+    ends. Windows are aligned to multiples of their length since the epoch and
+    derived values are published with the time the window started, as
+    "{name}.{stat}" for each stat.
+    """
+
+    def __init__(self, properties=None):
+        # Property name -> (window length in seconds, stats to publish)
+        self.properties = {}
+        # Property name -> [window start, count, total, min, max, last]
+        self.windows = {}
+        # Publishes for windows that have ended but not been collected yet
+        self.finished = []
+        self.lock = threading.Lock()
+        if properties:
+            for name, options in properties.items():
+                self.add_property(name, options.get("window"),
+                                  options.get("stats"))
+
+    def __contains__(self, name):
+        return name in self.properties
+
+    def add_property(self, name, window, stats=None):
+        """
+        Start aggregating a property over windows of a number of seconds
+        """
+
+        if not window or window <= 0:
+            raise ValueError("Aggregation window must be greater than 0")
+        if not stats:
+            stats = constants.AGGREGATE_STATS
+        for stat in stats:
+            if stat not in constants.AGGREGATE_STATS:
+                raise ValueError("Unknown aggregation stat \"{}\"".format(stat))
+        self.lock.acquire()
+        try:
+            self.properties[name] = (window, tuple(stats))
+        finally:
+            self.lock.release()
+
+    def add_sample(self, name, value, timestamp=None):
+        """
+        Add a sample to the window it belongs to. Returns False if the property
+        is not being aggregated, or the value is not a number.
+        """
+
+        if not is_number(value):
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+        self.lock.acquire()
+        try:
+            if name not in self.properties:
+                return False
+            window = self.properties[name][0]
+            start = timestamp - (timestamp % window)
+            state = self.windows.get(name)
+            if state and state[0] != start:
+                # Sample is for a different window, close the current one
+                self._finish(name, state)
+                state = None
+            if state:
+                state[1] += 1
+                state[2] += value
+                state[3] = min(state[3], value)
+                state[4] = max(state[4], value)
+                state[5] = value
+            else:
+                self.windows[name] = [start, 1, value, value, value, value]
+        finally:
+            self.lock.release()
+        return True
+
+    def expire(self, now=None, force=False):
+        """
+        Close any windows that have ended, or all windows if force is set, and
+        return the publishes for all closed windows
+        """
+
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            for name, state in list(self.windows.items()):
+                if force or state[0] + self.properties[name][0] <= now:
+                    self._finish(name, state)
+            finished = self.finished
+            self.finished = []
+        finally:
+            self.lock.release()
+        return finished
+
+    def next_expiry(self, now=None):
+        """
+        Time by which expire() has to be called next: when the earliest open
+        window ends, or the latest a window opened after now could end. None
+        if no properties are aggregated.
+        """
+
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            ends = [state[0] + self.properties[name][0] for name, state in
+                    self.windows.items()]
+            ends.extend(now + self.properties[name][0] for name in
+                        self.properties if name not in self.windows)
+        finally:
+            self.lock.release()
+        return min(ends) if ends else None
+
+    def remove_property(self, name):
+        """
+        Stop aggregating a property, closing its current window
+        """
+
+        self.lock.acquire()
+        try:
+            state = self.windows.get(name)
+            if state:
+                self._finish(name, state)
+            del self.properties[name]
+        finally:
+            self.lock.release()
+
+    def _finish(self, name, state):
+        """
+        Create publishes for a window and stop tracking it. Lock must be held.
+        """
+
+        del self.windows[name]
+        start, count, total, minimum, maximum, last = state
+        values = {"min":minimum, "max":maximum, "mean":float(total) / count,
+                  "count":count, "last":last}
+        for stat in self.properties[name][1]:
+            self.finished.append(PublishTelemetry("{}.{}".format(name, stat),
+                                                  values[stat],
+                                                  timestamp=start))
+
+
+class TelemetryBuffer(object):
+    """
+    Columnar buffer of numeric telemetry waiting to be published. The values and
+    times of each property are appended to arrays, so a buffered sample costs
+    16 bytes instead of a publish object. A property's values are kept as
+    integers until a float is added, then as floats, so its samples stay in
+    order. Holds at most maxsize samples (0 means no limit), applying a
+    publish queue policy when full.
+    """
+
+    # Array type codes for the value types that can be buffered
+    TYPECODES = {float:"d", int:"q" if sys.version_info.major == 3 else "l"}
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.columns = {}
+        self.count = 0
+        # Samples dropped to make room, or because there was no room
+        self.dropped = 0
+        # Samples refused because the buffer was full
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, name, value, timestamp=None,
+            policy=constants.QUEUE_POLICY_REJECT, timeout=0):
+        """
+        Buffer a sample, timed now if no timestamp (seconds since the epoch) is
+        given. Returns STATUS_NOT_SUPPORTED if the value cannot be buffered, so
+        it has to be queued as a publish. A full buffer is handled like a full
+        publish queue with the same policy and timeout (0 waits forever).
+        """
+
+        typecode = self.TYPECODES.get(type(value))
+        if not typecode:
+            return constants.STATUS_NOT_SUPPORTED
+        if timestamp is None:
+            timestamp = time.time()
+
+        self.lock.acquire()
+        try:
+            if self.maxsize and self.count >= self.maxsize:
+                status = self._make_room(policy, timeout)
+                if status is not None:
+                    return status
+            column = self.columns.get(name)
+            if column is None:
+                column = (array(typecode), array("d"))
+                self.columns[name] = column
+            try:
+                column[0].append(value)
+            except (OverflowError, TypeError):
+                if column[0].typecode == "d":
+                    return constants.STATUS_NOT_SUPPORTED
+                # A float, or an integer too large for the array. Keep the
+                # property's values as floats from now on.
+                column = (array("d", column[0]), column[1])
+                self.columns[name] = column
+                try:
+                    column[0].append(value)
+                except OverflowError:
+                    return constants.STATUS_NOT_SUPPORTED
+            column[1].append(timestamp)
+            self.count += 1
+        finally:
+            self.lock.release()
+        return constants.STATUS_SUCCESS
+
+    def drain(self, coalescer=None):
+        """
+        Take everything in the buffer, as one publish for each property.
+        Properties coalesced by coalescer keep only their newest values.
+        """
+
+        self.lock.acquire()
+        try:
+            columns = self.columns
+            self.columns = {}
+            self.count = 0
+            self.not_full.notify_all()
+        finally:
+            self.lock.release()
+
+        publishes = []
+        for name, (values, timestamps) in columns.items():
+            depth = coalescer.depth(name) if coalescer else None
+            if depth is not None and len(values) > depth:
+                values = values[-depth:]
+                timestamps = timestamps[-depth:]
+            publishes.append(PublishTelemetryBulk(name, values, timestamps))
+        return publishes
+
+    def pop(self, name):
+        """
+        Take the samples buffered for one property, as a publish, or None if
+        there are none
+        """
+
+        self.lock.acquire()
+        try:
+            column = self.columns.pop(name, None)
+            if column is None:
+                return None
+            self.count -= len(column[0])
+            self.not_full.notify_all()
+        finally:
+            self.lock.release()
+        return PublishTelemetryBulk(name, column[0], column[1])
+
+    def _make_room(self, policy, timeout):
+        """
+        Apply policy to the full buffer. Returns the status of the sample being
+        added if it is not to be buffered, or None once there is room. Lock
+        must be held.
+        """
+
+        if policy == constants.QUEUE_POLICY_BLOCK:
+            end_time = time.time() + timeout if timeout else None
+            while self.maxsize and self.count >= self.maxsize:
+                remaining = None
+                if end_time is not None:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return constants.STATUS_TIMED_OUT
+                self.not_full.wait(remaining)
+            return None
+
+        if policy == constants.QUEUE_POLICY_DROP_OLDEST:
+            # Drop the oldest sample of any property
+            name, column = min(self.columns.items(),
+                               key=lambda item: item[1][1][0])
+            del column[0][0]
+            del column[1][0]
+            if not column[0]:
+                del self.columns[name]
+            self.count -= 1
+            self.dropped += 1
+            return None
+
+        if policy == constants.QUEUE_POLICY_DROP_NEWEST:
+            self.dropped += 1
+            return constants.STATUS_SUCCESS
+
+        self.rejected += 1
+        return constants.STATUS_FULL
+
+
+class TelemetryDeadband(object):
+    """
+    Report-by-exception filter for telemetry. A value is only published when it
+    has moved beyond the band around the last published value of the
+    property, or when the property has been silent for longer than its
+    heartbeat. The name "*" applies to any property without its own filter.
+    """
+
+    def __init__(self, filters=None):
+        # Property name -> (absolute band, percent band, heartbeat seconds)
+        self.filters = {}
+        # Property name -> (last published value, time it was published)
+        self.last = {}
+        # Number of values dropped by the filter
+        self.dropped = 0
+        self.lock = threading.Lock()
+        if filters:
+            for name, options in filters.items():
+                self.add_filter(name, options.get("absolute"),
+                                options.get("percent"),
+                                options.get("heartbeat"))
+
+    def add_filter(self, name, absolute=None, percent=None, heartbeat=None):
+        """
+        Filter a property by an absolute change, a percent change of the last
+        published value, or both. A heartbeat publishes the value anyway when
+        nothing has been published for that many seconds.
+        """
+
+        for option in (absolute, percent, heartbeat):
+            if option is not None and option < 0:
+                raise ValueError("Deadband options cannot be negative")
+        self.lock.acquire()
+        try:
+            self.filters[name] = (absolute, percent, heartbeat)
+        finally:
+            self.lock.release()
+
+    def check(self, name, value, timestamp=None):
+        """
+        Return True if a value should be published, tracking it as the last
+        published value of the property
+        """
+
+        if not self.filters:
+            return True
+        band = self.filters.get(name) or self.filters.get("*")
+        if not band:
+            return True
+        if timestamp is None:
+            timestamp = time.time()
+
+        self.lock.acquire()
+        try:
+            last = self.last.get(name)
+            if last is None or self._outside(value, last, band, timestamp):
+                self.last[name] = (value, timestamp)
+                return True
+            self.dropped += 1
+            return False
+        finally:
+            self.lock.release()
+
+    def remove_filter(self, name):
+        """
+        Stop filtering a property
+        """
+
+        self.lock.acquire()
+        try:
+            del self.filters[name]
+            self.last.pop(name, None)
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def _outside(value, last, band, timestamp):
+        """
+        Check a value against the band around the last published value
+        """
+
+        last_value, last_time = last
+        absolute, percent, heartbeat = band
+        if heartbeat is not None and timestamp - last_time >= heartbeat:
+            return True
+        try:
+            delta = abs(value - last_value)
+        except TypeError:
+            # Not a number, publish on any change
+            return value != last_value
+        if absolute is None and percent is None:
+            return delta != 0
+        if absolute is not None and delta > absolute:
+            return True
+        if percent is not None and delta > abs(last_value) * percent / 100.0:
+            return True
+        return False
+
+
+class TopicAllocator(object):
+    """
+    Allocates the topic numbers requests are sent on, zero padded to width
+    digits. Unused numbers are handed out first, then released numbers are
+    reused, the longest released first. Both take constant time.
+    """
+
+    def __init__(self, width=4):
+        self.width = width
+        self.limit = 10 ** width - 1
+        self.format = "{{:0>{}}}".format(width).format
+        self.counter = 1
+        self.free = deque()
+        self.in_use = set()
+
+    def __len__(self):
+        return len(self.in_use)
+
+    def allocate(self):
+        """
+        Get a topic number that is not in use, or None if all of them are
+        """
+
+        if self.counter <= self.limit:
+            topic = self.format(self.counter)
+            self.counter += 1
+        elif self.free:
+            topic = self.free.popleft()
+        else:
+            return None
+        self.in_use.add(topic)
+        return topic
+
+    def release(self, topic):
+        """
+        Return a topic number so it can be reused
+        """
+
+        if topic in self.in_use:
+            self.in_use.discard(topic)
+            self.free.append(topic)
+
+
 class Work(object):
     """
     Holds information about work that needs to be completed
     """
 
+    __slots__ = ("type", "data")
+
     def __init__(self, work_type, data):
         self.type = work_type
         self.data = data
 
 
+# Publish classes by type name
+PUBLISH_TYPES = dict((x.__name__, x) for x in (PublishAlarm, PublishAttribute,
+                                              PublishLocation, PublishLog,
+                                              PublishTelemetry,
+                                              PublishTelemetryBulk))
+
+# Types of numbers that can be aggregated
+if sys.version_info.major == 2:
+    NUMBER_TYPES = (int, long, float)
+else:
+    NUMBER_TYPES = (int, float)
+
+def epoch_seconds(timestamp):
+    """
+    Convert a datetime to seconds since the epoch. Naive datetimes are taken
+    to be in UTC. Anything else is returned unchanged.
+    """
+
+    if isinstance(timestamp, datetime):
+        return (calendar.timegm(timestamp.utctimetuple()) +
+                timestamp.microsecond / 1e6)
+    return timestamp
+
+def format_timestamp(timestamp, clock):
+    """
+    Format a timestamp given as seconds since the epoch (with clock) or a
+    datetime in the Cloud's time format. Strings are assumed to be formatted
+    already.
+    """
+
+    if timestamp is None or isinstance(timestamp, codec.STRING_TYPES):
+        return timestamp
+    if isinstance(timestamp, datetime):
+        if timestamp.utcoffset() is not None:
+            timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+        return timestamp.strftime(constants.TIME_FORMAT)
+    return clock.format(timestamp)
+
+def is_number(value):
+    """
+    Check whether a value is a number that can be aggregated. Booleans are not
+    counted as numbers.
+    """
+
+    return (isinstance(value, NUMBER_TYPES) and
+            not isinstance(value, bool))
+
+def publish_from_dict(data):
+    """
+    Recreate a publish from a dict created by publish_to_dict
+    """
+
+    pub_class = PUBLISH_TYPES[data["type"]]
+    pub = pub_class.__new__(pub_class)
+    pub.journal_id = None
+    for key, value in data.items():
+        if key != "type":
+            setattr(pub, key, value)
+    return pub
+
+def publish_to_dict(pub):
+    """
+    Create a dict holding everything about a publish, so it can be stored
+    """
+
+    data = {"type":pub.type}
+    for pub_class in type(pub).__mro__:
+        for key in getattr(pub_class, "__slots__", ()):
+            if key != "journal_id" and hasattr(pub, key):
+                value = getattr(pub, key)
+                if isinstance(value, array):
+                    value = value.tolist()
+                data[key] = value
+    return data
+
+def publish_lane(pub):
+    """
+    Get the queue lane a publish is sent in
+    """
+
+    if pub.type in constants.PRIORITY_PUBLISH_TYPES:
+        return constants.LANE_PRIORITY
+    return constants.LANE_BULK
+
+def work_lane(work):
+    """
+    Get the queue lane a piece of work is handled in
+    """
+
+    if work.type in constants.PRIORITY_WORK_TYPES:
+        return constants.LANE_PRIORITY
+    return constants.LANE_BULK
@@ -0,0 +1,807 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the Gateway class for hosting many things, each with its
+own Client and MQTT connection, on one set of threads. It requires Python 3.4
+or newer, and paho-mqtt 1.5 or newer.
+"""
+
+import selectors
+import socket
+import threading
+from collections import OrderedDict
+from collections import deque
+from time import time
+
+import paho.mqtt.client as mqttlib
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core import tls
+from device_cloud._core.client import Client
+from device_cloud._core.handler import Handler
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class GatewayHandler(Handler):
+    """
+    Handler whose MQTT connection, work and publishes are handled by the
+    shared threads of a Gateway instead of threads of its own. Callbacks,
+    reply tracking and publish queues stay separate for each thing.
+    """
+
+    def __init__(self, config, client):
+        self.gateway = client.gateway
+        super(GatewayHandler, self).__init__(config, client)
+
+        # Finished when the MQTT socket is closed after disconnecting
+        self.closed = None
+
+        # Have MQTT report its socket so it can be watched by the gateway
+        self.mqtt.on_socket_open = self.on_socket_open
+        self.mqtt.on_socket_close = self.on_socket_close
+        self.mqtt.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def connect(self, timeout=0):
+        """
+        Connect to MQTT, with the connection handled by the gateway's threads
+        """
+
+        status = self.connect_start()
+        if status == constants.STATUS_SUCCESS:
+            status = self.connect_finish(timeout)
+        return status
+
+    def connect_finish(self, timeout=0):
+        """
+        Wait for a connection started by connect_start
+        """
+
+        status = constants.STATUS_FAILURE
+        self.connection.wait(timeout)
+
+        # Still connecting, timed out
+        if self.state == constants.STATE_CONNECTING:
+            self.logger.error("Connection timed out")
+            status = constants.STATUS_TIMED_OUT
+
+        if self.state == constants.STATE_CONNECTED:
+            status = constants.STATUS_SUCCESS
+        else:
+            self.logger.error("Failed to connect")
+            self.stop()
+        return status
+
+    def connect_start(self):
+        """
+        Start connecting to MQTT without waiting for the Cloud to accept the
+        connection
+        """
+
+        if not hasattr(mqttlib.Client, "on_socket_register_write"):
+            self.logger.error("Gateway requires paho-mqtt 1.5 or newer")
+            return constants.STATUS_NOT_SUPPORTED
+
+        self.to_quit = False
+        status = self.connect_setup()
+        if status == constants.STATUS_SUCCESS:
+            self.gateway.start()
+            result = -1
+            try:
+                result = self.mqtt.connect(self.config.cloud.host,
+                                           self.config.cloud.port,
+                                           constants.MQTT_KEEP_ALIVE)
+            except Exception as error:
+                # socket.gaierror or ssl.SSLError
+                self.logger.error(str(error))
+            if result == 0:
+                self.logger.info("Connecting...")
+                self.gateway.attach(self)
+            else:
+                status = constants.STATUS_FAILURE
+
+        if status != constants.STATUS_SUCCESS:
+            self.logger.error("Failed to connect")
+            self.to_quit = True
+            self.state = constants.STATE_DISCONNECTED
+        return status
+
+    def create_tls_context(self, ca_bundle_file):
+        """
+        Use the gateway's TLS context, so the certificate bundle is loaded
+        once for every thing
+        """
+
+        return self.gateway.get_tls_context(ca_bundle_file)
+
+    def disconnect(self, wait_for_replies=False, timeout=0):
+        """
+        Send anything pending and close the MQTT connection
+        """
+
+        end_time = None
+        if timeout:
+            end_time = time() + timeout
+
+        # Publish any data that was queued before disconnecting, including any
+        # aggregation windows that have not ended yet
+        self.publish_aggregates(force=True)
+        self.flush_wake()
+
+        # Wait for pending work and publishes that have not been dealt with,
+        # unless called from work being handled
+        self.logger.info("Disconnecting...")
+        if (self.gateway.is_alive() and threading.current_thread() not in
+                self.gateway.worker_threads):
+            self.wait_condition(self.work_queue.all_tasks_done,
+                                lambda: not self.work_queue.unfinished_tasks,
+                                end_time)
+            self.wait_condition(self.flush_condition,
+                                lambda: not self.flushing(), end_time)
+
+        # Optionally wait for any outstanding replies.
+        if wait_for_replies and self.is_connected():
+            self.logger.info("Waiting for replies...")
+            self.wait_condition(self.reply_condition,
+                                lambda: len(self.reply_tracker) == 0,
+                                end_time)
+
+        self.stop(end_time)
+        return constants.STATUS_SUCCESS
+
+    def flush_wake(self):
+        """
+        Have the gateway's publish thread check for publishes
+        """
+
+        self.gateway.flush_wake(self)
+
+    def flushing(self):
+        """
+        Check whether the gateway has publishes of this handler it can flush,
+        or is flushing them
+        """
+
+        if self.flush_lock.locked():
+            return True
+        if not self.gateway.is_alive():
+            return False
+        if self.journal and not self.is_connected():
+            return False
+        return self.pending_publishes() > 0
+
+    def on_socket_close(self, mqtt, userdata, sock):
+        """
+        Callback when the MQTT socket is about to be closed
+        """
+
+        self.gateway.call_in_io(self.gateway.io_unregister, sock)
+        closed = self.closed
+        if closed:
+            closed.finish(constants.STATUS_SUCCESS)
+
+    def on_socket_open(self, mqtt, userdata, sock):
+        """
+        Callback when the MQTT socket is opened
+        """
+
+        self.gateway.call_in_io(self.gateway.io_register, self, sock)
+
+    def on_socket_register_write(self, mqtt, userdata, sock):
+        """
+        Callback when MQTT has data to write
+        """
+
+        self.gateway.call_in_io(self.gateway.io_watch, self, sock, True)
+
+    def on_socket_unregister_write(self, mqtt, userdata, sock):
+        """
+        Callback when MQTT has nothing left to write
+        """
+
+        self.gateway.call_in_io(self.gateway.io_watch, self, sock, False)
+
+    def queue_work(self, work):
+        """
+        Place work in the work queue, for the gateway's workers to handle
+        """
+
+        self.work_queue.put(work)
+        self.gateway.queue_work(self, work)
+        return constants.STATUS_SUCCESS
+
+    def stop(self, end_time=None):
+        """
+        Stop the gateway checking on this handler, and close its MQTT
+        connection
+        """
+
+        self.to_quit = True
+        self.gateway.detach(self)
+        self.closed = defs.Completion()
+        if self.mqtt.disconnect() == 0 and self.gateway.is_alive():
+            # The gateway's I/O thread sends the disconnect and closes the
+            # socket. MQTT gives up on a connection after a keep alive period.
+            timeout = constants.MQTT_KEEP_ALIVE
+            if end_time is not None:
+                timeout = max(end_time - time(), 0.001)
+            self.closed.wait(timeout)
+        self.state = constants.STATE_DISCONNECTED
+        return constants.STATUS_SUCCESS
+
+
+class GatewayClient(Client):
+    """
+    Client for one thing hosted by a Gateway. Works like a Client, but its
+    connection, work and publishes are handled by the Gateway's threads.
+    """
+
+    handler_class = GatewayHandler
+
+    def __init__(self, gateway, app_id, kwargs=None):
+        self.gateway = gateway
+        super(GatewayClient, self).__init__(app_id, kwargs)
+
+
+class Gateway(object):
+    """
+    Hosts many things, each with its own Client and MQTT connection, on one
+    set of threads: one thread reads and writes every MQTT socket and checks
+    timeouts, a pool of worker threads handles received messages, actions and
+    file transfers, and one thread batches and flushes publishes. Callbacks,
+    reply tracking and publish queues stay separate for each thing.
+    """
+
+    def __init__(self, thread_count=constants.DEFAULT_THREAD_COUNT,
+                 linger_ms=constants.DEFAULT_LINGER_MS,
+                 max_batch=constants.DEFAULT_MAX_BATCH,
+                 loop_time=constants.DEFAULT_LOOP_TIME):
+        """
+        Parameters:
+          thread_count           (int) Number of worker threads shared by
+                                       every thing
+          linger_ms           (number) Milliseconds to wait for more publishes
+                                       once one is queued, so they can be sent
+                                       together
+          max_batch              (int) Number of queued publishes that are
+                                       flushed without waiting for linger_ms
+          loop_time           (number) Seconds between checks for timeouts,
+                                       reconnections and keep alives
+        """
+
+        self.thread_count = thread_count
+        self.linger_ms = linger_ms
+        self.max_batch = max_batch
+        self.loop_time = loop_time
+
+        # Hosted Clients by thing key, and the handlers of those that are
+        # connected or reconnecting
+        self.clients = OrderedDict()
+        self.handlers = OrderedDict()
+        self.lock = threading.Lock()
+
+        # TLS contexts shared by every thing, by certificate bundle
+        self.tls_contexts = {}
+
+        self.to_quit = True
+        self.io_thread = None
+        self.publish_thread = None
+        self.worker_threads = []
+
+        # Sockets watched by the I/O thread, changes to make to them from
+        # other threads, and a socket pair to wake the I/O thread
+        self.selector = None
+        self.io_calls = deque()
+        self.wake_reader = None
+        self.wake_writer = None
+
+        # Handlers with work waiting, once for each item of work, in lanes
+        # by the type of work
+        self.work_queue = defs.LaneQueue(lane=lambda item: item[1])
+
+        # Handlers with publishes to flush, and the number of publishes queued
+        # since the last flush
+        self.flush_condition = threading.Condition()
+        self.flush_pending = OrderedDict()
+        self.flush_count = 0
+
+    def add_client(self, app_id, kwargs=None):
+        """
+        Host a thing. The Client is initialized but not connected.
+
+        Parameters:
+          app_id              (string) ID of application that will be used to
+                                       generate the thing's key, and to find
+                                       its configuration file
+          kwargs                (dict) Optional dict to override any
+                                       configuration values
+
+        Returns:
+          GatewayClient                Client for the thing
+          Exception                    Error in configuration
+        """
+
+        client = GatewayClient(self, app_id, kwargs)
+        client.initialize()
+        self.lock.acquire()
+        try:
+            if client.config.key in self.clients:
+                raise KeyError("Thing {} is already hosted".format(
+                    client.config.key))
+            self.clients[client.config.key] = client
+        finally:
+            self.lock.release()
+        return client
+
+    def attach(self, handler):
+        """
+        Start checking a handler for timeouts, reconnections and keep alives
+        """
+
+        self.lock.acquire()
+        try:
+            self.handlers[handler] = True
+        finally:
+            self.lock.release()
+
+    def call_in_io(self, function, *args):
+        """
+        Have the I/O thread call a function, such as to change the sockets it
+        watches
+        """
+
+        self.io_calls.append((function, args))
+        self.io_wake()
+
+    def check_handler(self, handler):
+        """
+        Reconnect a handler once its backoff delay has passed, or check its
+        keep alives, and check for overdue replies, ended aggregation windows
+        and round trip times that are due
+        """
+
+        if handler.state == constants.STATE_DISCONNECTED:
+            if handler.reconnect_due():
+                # Reconnecting blocks, so it is left to the workers
+                handler.queue_work(defs.Work(constants.WORK_RECONNECT, None))
+            elif handler.to_quit:
+                self.detach(handler)
+                return
+        else:
+            handler.mqtt.loop_misc()
+        handler.handle_periodic()
+
+    def connect(self, timeout=0):
+        """
+        Connect every hosted thing to the Cloud. Connections are started
+        together and then waited for.
+
+        Parameters:
+          timeout             (number) Maximum time to try to connect
+
+        Returns:
+          dict                         Status of each thing's connection, by
+                                       thing key
+        """
+
+        statuses = OrderedDict()
+        started = []
+        for key, client in list(self.clients.items()):
+            statuses[key] = client.handler.connect_start()
+            if statuses[key] == constants.STATUS_SUCCESS:
+                started.append((key, client))
+
+        end_time = None
+        if timeout:
+            end_time = time() + timeout
+        for key, client in started:
+            remaining = 0
+            if end_time is not None:
+                remaining = max(end_time - time(), 0.001)
+            statuses[key] = client.handler.connect_finish(remaining)
+        return statuses
+
+    def detach(self, handler):
+        """
+        Stop checking a handler
+        """
+
+        self.lock.acquire()
+        try:
+            self.handlers.pop(handler, None)
+        finally:
+            self.lock.release()
+
+    def disconnect(self, wait_for_replies=False, timeout=0):
+        """
+        Disconnect every hosted thing from the Cloud and stop the gateway's
+        threads
+
+        Parameters:
+          wait_for_replies      (bool) When True, wait for any pending replies
+                                       to be received or time out before
+                                       disconnecting
+          timeout             (number) Maximum time to wait before returning
+
+        Returns:
+          STATUS_SUCCESS               Successfully disconnected
+        """
+
+        end_time = None
+        if timeout:
+            end_time = time() + timeout
+        for client in list(self.clients.values()):
+            if client.is_alive():
+                remaining = 0
+                if end_time is not None:
+                    remaining = max(end_time - time(), 0.001)
+                client.disconnect(wait_for_replies=wait_for_replies,
+                                  timeout=remaining)
+        self.stop()
+        return constants.STATUS_SUCCESS
+
+    def flush_wake(self, handler):
+        """
+        Have the publish thread flush a handler's publishes
+        """
+
+        self.flush_condition.acquire()
+        try:
+            self.flush_pending[handler] = True
+            self.flush_count += 1
+            self.flush_condition.notify()
+        finally:
+            self.flush_condition.release()
+
+    def get_tls_context(self, ca_bundle_file):
+        """
+        Get the TLS context shared by every thing that verifies servers with
+        ca_bundle_file (None for no verification), creating it the first time
+        """
+
+        self.lock.acquire()
+        try:
+            context = self.tls_contexts.get(ca_bundle_file)
+            if context is None:
+                context = tls.create_context(ca_bundle_file)
+                self.tls_contexts[ca_bundle_file] = context
+            return context
+        finally:
+            self.lock.release()
+
+    def io_loop(self):
+        """
+        Loop for the I/O thread. Reads and writes MQTT sockets as soon as
+        they are ready, and checks every handler each loop_time seconds.
+        """
+
+        next_check = 0
+        while not self.to_quit:
+            self.io_apply()
+            try:
+                events = self.selector.select(max(next_check - time(), 0))
+            except (OSError, ValueError):
+                # A socket was closed while being watched
+                events = []
+
+            for key, mask in events:
+                handler = key.data
+                if handler is None:
+                    try:
+                        self.wake_reader.recv(4096)
+                    except socket.error:
+                        pass
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self.io_read(handler)
+                    if mask & selectors.EVENT_WRITE:
+                        handler.mqtt.loop_write()
+                except Exception:
+                    # Print traceback, but don't kill thread
+                    handler.logger.exception("Exception:")
+
+            now = time()
+            if now >= next_check:
+                next_check = now + self.loop_time
+                self.lock.acquire()
+                try:
+                    handlers = list(self.handlers)
+                finally:
+                    self.lock.release()
+                for handler in handlers:
+                    try:
+                        self.check_handler(handler)
+                    except Exception:
+                        # Print traceback, but don't kill thread
+                        handler.logger.exception("Exception:")
+
+        return constants.STATUS_SUCCESS
+
+    def io_apply(self):
+        """
+        Make the calls other threads have asked the I/O thread to make
+        """
+
+        while self.io_calls:
+            function, args = self.io_calls.popleft()
+            function(*args)
+
+    def io_read(self, handler):
+        """
+        Read from a handler's MQTT socket, including any data already
+        decrypted by SSL, which the selector does not report
+        """
+
+        mqtt = handler.mqtt
+        result = mqtt.loop_read()
+        sock = mqtt.socket()
+        while (not result and sock is not None and hasattr(sock, "pending")
+               and sock.pending() > 0):
+            result = mqtt.loop_read()
+            sock = mqtt.socket()
+
+    def io_register(self, handler, sock):
+        """
+        Start watching a handler's MQTT socket
+        """
+
+        try:
+            self.selector.register(sock, selectors.EVENT_READ, handler)
+        except KeyError:
+            # File descriptor reused before the old socket was unregistered
+            self.selector.modify(sock, selectors.EVENT_READ, handler)
+        except (OSError, ValueError):
+            # Already closed
+            pass
+
+    def io_unregister(self, sock):
+        """
+        Stop watching an MQTT socket
+        """
+
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, OSError, ValueError):
+            pass
+
+    def io_wake(self):
+        """
+        Wake the I/O thread
+        """
+
+        writer = self.wake_writer
+        if writer:
+            try:
+                writer.send(b"\0")
+            except (socket.error, ValueError):
+                # The socket buffer is full, so the thread is already awake,
+                # or the gateway has stopped
+                pass
+
+    def io_watch(self, handler, sock, write):
+        """
+        Watch an MQTT socket for being writable as well as readable, or stop
+        """
+
+        events = selectors.EVENT_READ
+        if write:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.modify(sock, events, handler)
+        except (KeyError, OSError, ValueError):
+            pass
+
+    def is_alive(self):
+        """
+        Return whether the gateway's threads are running
+
+        Returns:
+          True                         Gateway is running
+          False                        Gateway is not running
+        """
+
+        return not self.to_quit
+
+    def publish_loop(self):
+        """
+        Loop for the publish thread. Wakes as soon as any thing queues a
+        publish, lingers for up to linger_ms (or until max_batch publishes
+        are queued) so more publishes can join the batch, then flushes the
+        publishes of every thing that queued one.
+        """
+
+        linger = (self.linger_ms or 0) / 1000.0
+        max_batch = self.max_batch or 0
+
+        while not self.to_quit:
+            self.flush_condition.acquire()
+            try:
+                if not self.flush_pending:
+                    self.flush_condition.wait(self.loop_time)
+                    continue
+
+                # Give other publishes a chance to join this batch
+                end_time = time() + linger
+                remaining = linger
+                while (remaining > 0 and not self.to_quit and
+                       not (max_batch and self.flush_count >= max_batch)):
+                    self.flush_condition.wait(remaining)
+                    remaining = end_time - time()
+                handlers = list(self.flush_pending)
+                self.flush_pending.clear()
+                self.flush_count = 0
+            finally:
+                self.flush_condition.release()
+
+            for handler in handlers:
+                # Journaled publishes wait for a connection
+                if handler.journal and not handler.is_connected():
+                    continue
+                try:
+                    handler.handle_publish()
+                except Exception:
+                    # Print traceback, but don't kill thread
+                    handler.logger.exception("Exception:")
+
+        return constants.STATUS_SUCCESS
+
+    def queue_work(self, handler, work):
+        """
+        Have a worker handle the next work in a handler's work queue
+        """
+
+        self.work_queue.put((handler, defs.work_lane(work)))
+
+    def remove_client(self, client):
+        """
+        Stop hosting a thing, disconnecting it if it is connected
+
+        Parameters:
+          client        (GatewayClient) Client returned by add_client
+
+        Returns:
+          STATUS_SUCCESS               Thing is no longer hosted
+          STATUS_NOT_FOUND             Thing is not hosted by this gateway
+        """
+
+        self.lock.acquire()
+        try:
+            if self.clients.get(client.config.key) is not client:
+                return constants.STATUS_NOT_FOUND
+            del self.clients[client.config.key]
+        finally:
+            self.lock.release()
+        if client.is_alive():
+            client.disconnect()
+        return constants.STATUS_SUCCESS
+
+    def start(self):
+        """
+        Start the gateway's threads, if they are not running
+        """
+
+        self.lock.acquire()
+        try:
+            if not self.to_quit:
+                return constants.STATUS_SUCCESS
+            self.to_quit = False
+            self.selector = selectors.DefaultSelector()
+            self.wake_reader, self.wake_writer = socket.socketpair()
+            self.wake_reader.setblocking(False)
+            self.wake_writer.setblocking(False)
+            self.selector.register(self.wake_reader, selectors.EVENT_READ,
+                                   None)
+
+            self.io_thread = threading.Thread(target=self.io_loop)
+            self.publish_thread = threading.Thread(target=self.publish_loop)
+            self.worker_threads = [threading.Thread(target=self.work_loop)
+                                   for _ in range(max(self.thread_count, 1))]
+            for thread in [self.io_thread, self.publish_thread] + \
+                    self.worker_threads:
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.lock.release()
+        return constants.STATUS_SUCCESS
+
+    def stats(self):
+        """
+        Get the number of things hosted and connected, and the threads and
+        queues shared by them
+
+        Returns:
+          dict                         "clients": things hosted.
+                                       "connected": things connected.
+                                       "threads": threads running for every
+                                       thing.
+                                       "work_queue": work waiting for a
+                                       worker.
+                                       "flush_pending": things with publishes
+                                       waiting to be flushed.
+        """
+
+        threads = [self.io_thread, self.publish_thread] + self.worker_threads
+        return {"clients":len(self.clients),
+                "connected":sum(1 for x in list(self.clients.values())
+                                if x.is_connected()),
+                "threads":sum(1 for x in threads if x and x.is_alive()),
+                "work_queue":self.work_queue.qsize(),
+                "flush_pending":len(self.flush_pending)}
+
+    def stop(self):
+        """
+        Stop the gateway's threads
+        """
+
+        self.lock.acquire()
+        try:
+            if self.to_quit:
+                return constants.STATUS_SUCCESS
+            self.to_quit = True
+            threads = [self.io_thread, self.publish_thread] + \
+                self.worker_threads
+            self.io_thread = None
+            self.publish_thread = None
+            self.worker_threads = []
+        finally:
+            self.lock.release()
+
+        # Wake every thread so they see to_quit
+        self.io_wake()
+        for _ in threads[2:]:
+            self.work_queue.put((None, constants.LANE_PRIORITY))
+        self.flush_condition.acquire()
+        try:
+            self.flush_condition.notify_all()
+        finally:
+            self.flush_condition.release()
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+        self.selector.close()
+        wake_reader, wake_writer = self.wake_reader, self.wake_writer
+        self.wake_reader = self.wake_writer = None
+        wake_reader.close()
+        wake_writer.close()
+        return constants.STATUS_SUCCESS
+
+    def work_loop(self):
+        """
+        Loop for worker threads to handle the work of any hosted thing
+        """
+
+        while not self.to_quit:
+            try:
+                handler, _ = self.work_queue.get(timeout=self.loop_time)
+            except queue.Empty:
+                continue
+            if handler is None:
+                # Woken to stop
+                continue
+            try:
+                work = handler.work_queue.get_nowait()
+            except queue.Empty:
+                continue
+            try:
+                handler.handle_work(work)
+            finally:
+                handler.work_queue.task_done()
+
+        return constants.STATUS_SUCCESS
@@ -19,6 +19,7 @@ import json
 import logging
 import os
 import random
+import select
 import socket
 
 # proxy support requires PySocks, it is an optional module
@@ -29,18 +30,20 @@ try:
 except ImportError:
     pass
 
-import ssl
 import sys
 import threading
 from binascii import crc32
 from datetime import datetime
-from datetime import timedelta
 from time import sleep
+from time import time
 import requests
 import paho.mqtt.client as mqttlib
 
+from device_cloud._core import codec
 from device_cloud._core import constants
 from device_cloud._core import defs
+from device_cloud._core import journal
+from device_cloud._core import tls
 from device_cloud._core import tr50
 from device_cloud._core.tr50 import TR50Command
 
@@ -122,6 +125,7 @@ class Handler(object):
         self.mqtt.on_disconnect = self.on_disconnect
         self.mqtt.on_message = self.on_message
         self.mqtt.on_publish = self.on_publish
+        self.mqtt.on_socket_register_write = self.on_socket_register_write
         self.mqtt.username_pw_set(self.config.key, self.config.cloud.token)
 
         # Set up proxy.  Note: PySocks is required for this, but it is
@@ -160,25 +164,123 @@ class Handler(object):
         # data
         self.callbacks = defs.Callbacks()
 
-        # Connection state of the Client
+        # Connection state of the Client, and the completion of the current
+        # connection attempt
         self.state = constants.STATE_DISCONNECTED
+        self.connection = None
 
         # Track last time the app was connected so keep alive can time out
         self.last_connected = datetime.utcnow()
 
+        # Reconnection attempts are spread out with exponential backoff and
+        # jitter
+        self.backoff = defs.ReconnectBackoff(
+            self.config.reconnect_delay or constants.DEFAULT_RECONNECT_DELAY,
+            self.config.reconnect_max_delay or
+            constants.DEFAULT_RECONNECT_MAX_DELAY)
+
         # Lock for thread safety
         self.lock = threading.Lock()
 
-        # Queue for any pending publishes (number, string, location, etc.)
-        self.publish_queue = queue.Queue()
+        # TLS context shared by MQTT and HTTPS, created when first needed so
+        # the certificate bundle is only loaded once. File transfers use a
+        # session so up to http_pool_size HTTPS connections are kept open and
+        # reused.
+        self.tls_context = None
+        self.tls_lock = threading.Lock()
+        self.mqtt_tls = False
+        self.http = requests.Session()
+        self.http_adapter = None
+
+        # Queue for any pending publishes (number, string, location, etc.),
+        # optionally journaled to disk so they survive restarts and long
+        # periods offline
+        self.journal = None
+        queue_size = self.config.publish_queue_size or 0
+        if self.config.publish_journal:
+            self.journal = journal.PublishJournal(
+                self.config.publish_journal,
+                max_bytes=self.config.publish_journal_max_bytes,
+                max_age=self.config.publish_journal_max_age,
+                maxsize=queue_size, burst=self.config.priority_burst)
+            self.publish_queue = self.journal
+        else:
+            self.publish_queue = defs.PublishQueue(
+                queue_size, burst=self.config.priority_burst)
+
+        # Numeric telemetry can be buffered in arrays instead of being queued
+        # as publishes, unless publishes are journaled
+        self.telemetry_buffer = None
+        if self.config.telemetry_buffer and not self.journal:
+            self.telemetry_buffer = defs.TelemetryBuffer(queue_size)
+
+        # What to do when the publish queue is full
+        self.queue_policy = (self.config.publish_queue_policy or
+                             constants.QUEUE_POLICY_REJECT)
+        if self.queue_policy not in constants.QUEUE_POLICIES:
+            self.logger.error("Invalid publish queue policy. Supported "
+                              "policies are %s.",
+                              "/".join(constants.QUEUE_POLICIES))
+            raise KeyError("Invalid publish queue policy")
+
+        # Journal entries that have been sent, with the number of commands in
+        # each still waiting for a reply
+        self.journal_pending = {}
+
+        # Totals for publish flushes, and the requests and bytes they produced
+        self.publish_stats = {"flushes":0, "commands":0, "batches":0,
+                              "bytes":0, "coalesced":0}
+
+        # Publish thread, woken as soon as publishes are queued so they can be
+        # flushed without waiting for the main loop. Only one flush runs at a
+        # time.
+        self.publish_thread = None
+        self.flush_condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+
+        # Times and formats publishes, offset to follow the Cloud's clock if
+        # cloud_time is set
+        self.clock = defs.Clock()
+
+        # Attributes and telemetry that only send their newest values per
+        # flush. Changed with lock held.
+        self.coalescer = defs.PublishCoalescer(self.config.publish_coalesce)
+
+        # Telemetry that is aggregated over windows before being published
+        self.aggregator = defs.TelemetryAggregator(
+            self.config.telemetry_aggregate)
+
+        # Telemetry that is only published when it changes significantly
+        self.deadband = defs.TelemetryDeadband(self.config.telemetry_deadband)
+
+        # Number of digits in the topic numbers requests are sent on
+        topic_width = self.config.topic_width or constants.DEFAULT_TOPIC_WIDTH
+        if not isinstance(topic_width, int) or topic_width < 1:
+            self.logger.error("Invalid topic width %s", topic_width)
+            raise ValueError("Invalid topic width")
 
         # Dicts to track which messages sent out have not received replies. Also
-        # stores any actions to be taken when the reply is received.
-        self.reply_tracker = defs.OutTracker()
+        # stores any actions to be taken when the reply is received. Messages
+        # are dropped after reply_timeout seconds without a reply, or once
+        # they add up to more than reply_max_bytes.
+        self.reply_tracker = defs.OutTracker(self.config.reply_timeout or 0,
+                                             self.config.reply_max_bytes or 0,
+                                             topic_width)
+
+        # Notified, with the lock held, when the last reply arrives
+        self.reply_condition = threading.Condition(self.lock)
         self.no_reply = []
 
-        # Counter to allow every message to be sent on a unique topic
-        self.topic_counter = 1
+        # File transfers that have been requested and may not have finished.
+        # Any still unfinished when the client stops are failed, so nothing
+        # waits on them after the connection is gone.
+        self.transfers = []
+
+        # Counts of commands sent, replied to, failed and timed out, with
+        # histograms of round trip times, by TR50 command type. Round trip
+        # times are published as telemetry every stats_interval seconds.
+        self.command_counters = {}
+        self.stats_time = time()
 
         # Flag for notifying client to exit
         self.to_quit = True
@@ -186,11 +288,18 @@ class Handler(object):
         # Thread trackers. Main thread for handling MQTT loop, and worker
         # threads for everything else.
         self.main_thread = None
+
+        # Socket pair that wakes the main thread from select() when MQTT has
+        # data to write or the client is quitting. Created by the main loop.
+        self.wake_reader = None
+        self.wake_writer = None
         self.worker_threads = []
 
         # Queue to track any pending work (parsing messages, actions,
-        # publishing, file transfer, etc.)
-        self.work_queue = queue.Queue()
+        # publishing, file transfer, etc.). Messages, actions and publishing
+        # are handled before file transfers.
+        self.work_queue = defs.LaneQueue(lane=defs.work_lane,
+                                         burst=self.config.priority_burst)
 
     def action_deregister(self, action_name):
         """
@@ -264,6 +373,122 @@ class Handler(object):
 
         return status
 
+    def action_result(self, action_request, action_result, error=None):
+        """
+        Send the result of an executed action to the Cloud. error is the
+        exception raised by the action, if any.
+        """
+
+        result_code = -1
+        result_args = {"mail_id":action_request.request_id}
+
+        if error is not None:
+            self.logger.error("Action %s execution failed", action_request.name)
+            self.logger.error(".... %s", str(error))
+            result_code = constants.STATUS_FAILURE
+            result_args["error_message"] = "ERROR: {}".format(str(error))
+            if action_request.name not in self.callbacks:
+                result_code = constants.STATUS_NOT_FOUND
+
+        # Action execution did not raise an error
+        if error is None:
+            # Handle returning a tuple or just a status code
+            if action_result.__class__.__name__ == "tuple":
+                result_code = action_result[0]
+                if len(action_result) >= 2:
+                    result_args["error_message"] = str(action_result[1])
+                if len(action_result) >= 3:
+                    result_args["params"] = action_result[2]
+            else:
+                result_code = action_result
+
+            if not is_valid_status(result_code):
+                # Returned 'status' is not a valid status
+                error_string = ("Invalid return status: " +
+                                str(result_code))
+                self.logger.error(error_string)
+                result_code = constants.STATUS_BAD_PARAMETER
+                result_args["error_message"] = "ERROR: " + error_string
+
+        # Return status to Cloud
+        # Check for invoked status.  If so, return mail box update not
+        # ack.  Ack is the final notification.  This breaks triggers
+        # etc because it doesn't update the status.
+        result_args["error_code"] = tr50.translate_error_code(result_code)
+        if result_code == constants.STATUS_INVOKED:
+                update_args = {"mail_id":action_request.request_id}
+                update_args["message"] = "Invoked"
+                mailbox_ack = tr50.create_mailbox_update(**update_args)
+        else:
+                mailbox_ack = tr50.create_mailbox_ack(**result_args)
+
+        message_desc = "Action Complete \"{}\"".format(action_request.name)
+        message_desc += " result : {}({})".format(result_code,
+                                                  status_string(result_code))
+        if result_args.get("error_message"):
+            message_desc += " \"{}\"".format(result_args["error_message"])
+        if result_args.get("params"):
+            message_desc += " \"{}\"".format(str(result_args["params"]))
+        message = defs.OutMessage(mailbox_ack, message_desc)
+        status = self.send(message)
+        return status
+
+    def buffer_telemetry(self, name, value, timestamp=None):
+        """
+        Add a telemetry sample to the telemetry buffer, applying the queue
+        policy if it is full. Returns STATUS_NOT_SUPPORTED if it has to be
+        queued as a publish instead.
+        """
+
+        if timestamp is None:
+            timestamp = self.clock.now()
+        status = self.telemetry_buffer.add(name, value, timestamp,
+                                           self.queue_policy,
+                                           self.config.publish_queue_timeout)
+        if status == constants.STATUS_SUCCESS:
+            self.flush_wake()
+        elif status == constants.STATUS_NOT_SUPPORTED:
+            # Queue the property's buffered samples ahead of this one, so they
+            # are sent in order
+            pub = self.telemetry_buffer.pop(name)
+            if pub:
+                self.queue_publish(pub)
+        else:
+            self.logger.warning("Telemetry buffer full, telemetry not queued "
+                                "(%s)", status_string(status))
+        return status
+
+    def command_counter(self, command_type):
+        """
+        Get the counters for a TR50 command type. The lock must be held.
+        """
+
+        counter = self.command_counters.get(command_type)
+        if counter is None:
+            counter = {"sent":0, "replies":0, "failures":0, "timeouts":0,
+                       "rtt":defs.Histogram()}
+            self.command_counters[command_type] = counter
+        return counter
+
+    def command_stats(self):
+        """
+        Get the number of commands sent, replied to, failed and timed out, and
+        their round trip times in seconds, by TR50 command type
+        """
+
+        self.lock.acquire()
+        try:
+            stats = {}
+            for command_type, counter in self.command_counters.items():
+                stats[command_type] = {"sent":counter["sent"],
+                                       "replies":counter["replies"],
+                                       "failures":counter["failures"],
+                                       "timeouts":counter["timeouts"],
+                                       "rtt":counter["rtt"].summary()}
+            return stats
+        finally:
+            self.lock.release()
+
     def connect(self, timeout=0):
         """
         Connect to MQTT and start main thread
@@ -273,48 +498,19 @@ class Handler(object):
         status = constants.STATUS_FAILURE
         result = -1
 
-        # Ensure we have a host and port to connect to
-        if not self.config.cloud.host or not self.config.cloud.port:
-            self.logger.error("Missing host or port from configuration")
-            status = constants.STATUS_BAD_PARAMETER
-
+        setup_status = self.connect_setup()
+        if setup_status != constants.STATUS_SUCCESS:
+            status = setup_status
         else:
-            current_time = datetime.utcnow()
-            end_time = current_time + timedelta(seconds=timeout)
-            self.state = constants.STATE_CONNECTING
-
-            # Start a secure connection if using a secure port and the cert file
-            # is available
-            if self.config.cloud.port in constants.SECURE_PORTS:
-                if self.config.validate_cloud_cert is False:
-                    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-                    context.verify_mode = ssl.CERT_NONE
-                    context.check_hostname = False
-                    self.mqtt.tls_set_context(context)
-                elif not self.config.ca_bundle_file:
-                    self.logger.error("Missing certificate bundle from configuration")
-                    status = constants.STATUS_BAD_PARAMETER
-                elif not os.path.isfile(self.config.ca_bundle_file):
-                    self.logger.error("Certificate bundle not found")
-                    status = constants.STATUS_NOT_FOUND
-                else:
-                    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-                    context.load_verify_locations(cafile=self.config.ca_bundle_file)
-                    context.verify_mode = ssl.CERT_REQUIRED
-                    context.check_hostname = True
-                    self.mqtt.tls_set_context(context)
-
-
-            # status != bad_parameter or not_found
-            if status == constants.STATUS_FAILURE:
-                # Start MQTT connection
-                try:
-                    result = self.mqtt.connect(self.config.cloud.host,
-                                               self.config.cloud.port, 60)
-                except Exception as error:
-                    # socket.gaierror or ssl.SSLError
-                    self.state = constants.STATE_DISCONNECTED
-                    self.logger.error(str(error))
+            # Start MQTT connection
+            try:
+                result = self.mqtt.connect(self.config.cloud.host,
+                                           self.config.cloud.port,
+                                           constants.MQTT_KEEP_ALIVE)
+            except Exception as error:
+                # socket.gaierror or ssl.SSLError
+                self.state = constants.STATE_DISCONNECTED
+                self.logger.error(str(error))
 
         if result == 0:
             # Successful MQTT connection
@@ -326,10 +522,7 @@ class Handler(object):
             self.main_thread.start()
 
             # Wait for cloud connection
-            while ((timeout == 0 or current_time < end_time) and
-                   self.state == constants.STATE_CONNECTING):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            self.connection.wait(timeout)
 
             # Still connecting, timed out
             if self.state == constants.STATE_CONNECTING:
@@ -346,6 +539,8 @@ class Handler(object):
                     target=self.handle_work_loop))
             for thread in self.worker_threads:
                 thread.start()
+            self.publish_thread = threading.Thread(target=self.publish_loop)
+            self.publish_thread.start()
 
         else:
             # Not connected. Stop main loop.
@@ -359,34 +554,79 @@ class Handler(object):
         # Return result of connection
         return status
 
+    def connect_setup(self):
+        """
+        Check the connection configuration and set up TLS before connecting.
+        Starts a new connection attempt if successful.
+        """
+
+        status = constants.STATUS_SUCCESS
+
+        # Ensure we have a host and port to connect to
+        if not self.config.cloud.host or not self.config.cloud.port:
+            self.logger.error("Missing host or port from configuration")
+            return constants.STATUS_BAD_PARAMETER
+
+        self.state = constants.STATE_CONNECTING
+        self.connection = defs.Completion()
+
+        # Start a secure connection if using a secure port and the cert file
+        # is available. The TLS context is only set up on the first connection
+        # and is reused, resuming the TLS session, on reconnects.
+        if self.config.cloud.port in constants.SECURE_PORTS:
+            if self.config.validate_cloud_cert is not False:
+                if not self.config.ca_bundle_file:
+                    self.logger.error("Missing certificate bundle from "
+                                      "configuration")
+                    status = constants.STATUS_BAD_PARAMETER
+                elif not os.path.isfile(self.config.ca_bundle_file):
+                    self.logger.error("Certificate bundle not found")
+                    status = constants.STATUS_NOT_FOUND
+            if status == constants.STATUS_SUCCESS and not self.mqtt_tls:
+                self.mqtt.tls_set_context(self.get_tls_context())
+                self.mqtt_tls = True
+
+        return status
+
+    def create_tls_context(self, ca_bundle_file):
+        """
+        Create the TLS context, verifying servers with ca_bundle_file if set
+        """
+
+        return tls.create_context(ca_bundle_file)
+
     def disconnect(self, wait_for_replies=False, timeout=0):
         """
         Stop threads and shut down MQTT client
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        end_time = None
+        if timeout:
+            end_time = time() + timeout
 
-        # Publish any data that was queued before disconnecting
-        if not self.publish_queue.empty():
-            self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+        # Publish any data that was queued before disconnecting, including any
+        # aggregation windows that have not ended yet
+        self.publish_aggregates(force=True)
+        self.flush_wake()
 
-        # Wait for pending work that has not been dealt with
+        # Wait for pending work and publishes that have not been dealt with
         self.logger.info("Disconnecting...")
-        while ((timeout == 0 or current_time < end_time) and
-               not self.work_queue.empty()):
-            sleep(0.1)
-            current_time = datetime.utcnow()
+        if self.worker_threads:
+            self.wait_condition(self.work_queue.all_tasks_done,
+                                lambda: not self.work_queue.unfinished_tasks,
+                                end_time)
+        self.wait_condition(self.flush_condition,
+                            lambda: not self.flushing(), end_time)
 
         # Optionally wait for any outstanding replies.
         if wait_for_replies and self.is_connected():
             self.logger.info("Waiting for replies...")
-            while ((timeout == 0 or current_time < end_time) and
-                   len(self.reply_tracker) != 0):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            self.wait_condition(self.reply_condition,
+                                lambda: len(self.reply_tracker) == 0,
+                                end_time)
 
         self.to_quit = True
+        self.io_wake()
         #TODO: Kill any hanging threads
         if threading.current_thread() not in self.worker_threads:
             if self.main_thread:
@@ -395,74 +635,107 @@ class Handler(object):
 
         return constants.STATUS_SUCCESS
 
+    def expire_replies(self):
+        """
+        Stop waiting for replies to any messages that are past their deadline
+        """
+
+        self.lock.acquire()
+        try:
+            expired = self.reply_tracker.expire()
+            if expired and not self.reply_tracker:
+                self.reply_condition.notify_all()
+        finally:
+            self.lock.release()
+        if expired:
+            self.handle_reply_timeouts(expired)
+        return constants.STATUS_SUCCESS
+
+    def fail_transfers(self):
+        """
+        Finish every file transfer that has not finished with STATUS_FAILURE
+        """
+
+        self.lock.acquire()
+        try:
+            transfers = self.transfers
+            self.transfers = []
+        finally:
+            self.lock.release()
+        for transfer in transfers:
+            if transfer.completion.finish(constants.STATUS_FAILURE):
+                self.logger.error("File transfer of \"%s\" did not finish",
+                                  transfer.file_name)
+                transfer.finish()
+        return constants.STATUS_SUCCESS
+
+    def flush_wake(self):
+        """
+        Wake the publish thread to check for publishes, and anything waiting
+        for a flush to finish
+        """
+
+        self.flush_condition.acquire()
+        try:
+            self.flush_condition.notify_all()
+        finally:
+            self.flush_condition.release()
+
+    def flushing(self):
+        """
+        Check whether the publish thread has publishes it can flush, or is
+        flushing them
+        """
+
+        if not self.publish_thread or not self.publish_thread.is_alive():
+            return False
+        if self.flush_lock.locked():
+            return True
+        if self.journal and not self.is_connected():
+            return False
+        return self.pending_publishes() > 0
+
+    def get_tls_context(self):
+        """
+        Get the TLS context shared by MQTT and HTTPS connections, creating it
+        the first time
+        """
+
+        self.tls_lock.acquire()
+        try:
+            if self.tls_context is None:
+                ca_bundle_file = None
+                if self.tls_verify():
+                    ca_bundle_file = self.config.ca_bundle_file
+                self.tls_context = self.create_tls_context(ca_bundle_file)
+                pool_size = (self.config.http_pool_size or
+                             constants.DEFAULT_HTTP_POOL_SIZE)
+                self.http_adapter = tls.TLSAdapter(self.tls_context,
+                                                   pool_maxsize=pool_size)
+                self.http.mount("https://", self.http_adapter)
+            return self.tls_context
+        finally:
+            self.tls_lock.release()
+
     def handle_action(self, action_request):
         """
         Handle action execution requests from Cloud
         """
 
-        result_code = -1
-        result_args = {"mail_id":action_request.request_id}
         action_result = None
-        action_failed = False
+        error = None
 
         try:
             # Execute callback
             action_result = self.callbacks.execute_action(action_request)
 
-        except Exception as error:
+        except Exception as action_error:
             # Error with action execution. Might not have been registered.
-            action_failed = True
-            self.logger.error("Action %s execution failed", action_request.name)
-            self.logger.error(".... %s", str(error))
-            result_code = constants.STATUS_FAILURE
-            result_args["error_message"] = "ERROR: {}".format(str(error))
-            if action_request.name not in self.callbacks:
-                result_code = constants.STATUS_NOT_FOUND
-            else:
+            error = action_error
+            if action_request.name in self.callbacks:
                 self.logger.exception("Exception:")
 
-        # Action execution did not raise an error
-        if not action_failed:
-            # Handle returning a tuple or just a status code
-            if action_result.__class__.__name__ == "tuple":
-                result_code = action_result[0]
-                if len(action_result) >= 2:
-                    result_args["error_message"] = str(action_result[1])
-                if len(action_result) >= 3:
-                    result_args["params"] = action_result[2]
-            else:
-                result_code = action_result
-
-            if not is_valid_status(result_code):
-                # Returned 'status' is not a valid status
-                error_string = ("Invalid return status: " +
-                                str(result_code))
-                self.logger.error(error_string)
-                result_code = constants.STATUS_BAD_PARAMETER
-                result_args["error_message"] = "ERROR: " + error_string
-
-        # Return status to Cloud
-        # Check for invoked status.  If so, return mail box update not
-        # ack.  Ack is the final notification.  This breaks triggers
-        # etc because it doesn't update the status.
-        result_args["error_code"] = tr50.translate_error_code(result_code)
-        if result_code == constants.STATUS_INVOKED:
-                update_args = {"mail_id":action_request.request_id}
-                update_args["message"] = "Invoked"
-                mailbox_ack = tr50.create_mailbox_update(**update_args)
-        else:
-                mailbox_ack = tr50.create_mailbox_ack(**result_args)
-
-        message_desc = "Action Complete \"{}\"".format(action_request.name)
-        message_desc += " result : {}({})".format(result_code,
-                                                  status_string(result_code))
-        if result_args.get("error_message"):
-            message_desc += " \"{}\"".format(result_args["error_message"])
-        if result_args.get("params"):
-            message_desc += " \"{}\"".format(str(result_args["params"]))
-        message = defs.OutMessage(mailbox_ack, message_desc)
-        status = self.send(message)
-        return status
+        return self.action_result(action_request, action_result, error)
 
     def handle_file_download(self, download):
         """
@@ -497,14 +770,10 @@ class Handler(object):
             status = constants.STATUS_IO_ERROR
 
         if status == constants.STATUS_SUCCESS:
-            # Secure or insecure HTTPS request.
-            response = None
-            if (self.config.validate_cloud_cert is False or
-                    not self.config.ca_bundle_file):
-                response = requests.get(url, stream=True, verify=False)
-            else:
-                cert_location = self.config.ca_bundle_file
-                response = requests.get(url, stream=True, verify=cert_location)
+            # Secure or insecure HTTPS request, using the shared TLS context
+            self.get_tls_context()
+            response = self.http.get(url, stream=True,
+                                     verify=self.tls_verify())
 
             if response.status_code == 200:
                 # Write to temporary file, while simultaneously calculating
@@ -567,14 +836,10 @@ class Handler(object):
         if os.path.exists(upload.file_path):
             # If file exists attempt upload
             with open(upload.file_path, "rb") as up_file:
-                # Secure or insecure HTTPS Post
-                if (self.config.validate_cloud_cert is False or
-                        not self.config.ca_bundle_file):
-                    response = requests.post(url, data=up_file, verify=False)
-                else:
-                    cert_location = self.config.ca_bundle_file
-                    response = requests.post(url, data=up_file,
-                                             verify=cert_location)
+                # Secure or insecure HTTPS Post, using the shared TLS context
+                self.get_tls_context()
+                response = self.http.post(url, data=up_file,
+                                          verify=self.tls_verify())
 
             if response.status_code == 200:
                 self.logger.info("Successfully uploaded \"%s\"",
@@ -630,12 +895,26 @@ class Handler(object):
                 try:
                     sent_message = self.reply_tracker.pop_message(topic_num,
                                                                   command_num)
+                    if not self.reply_tracker:
+                        self.reply_condition.notify_all()
+
+                    # Record the round trip time
+                    counter = self.command_counter(sent_message.command_type)
+                    counter["replies"] += 1
+                    if not reply.get("success"):
+                        counter["failures"] += 1
+                    counter["rtt"].add(max(time() - sent_message.timestamp,
+                                           0.0))
                 except KeyError as error:
-                    self.logger.error(error.message)
+                    self.logger.error(error.args[0])
                     continue
                 finally:
                     self.lock.release()
-                sent_command_type = sent_message.command.get("command")
+                sent_command_type = sent_message.command_type
+
+                # Journaled publishes are done with once the Cloud replies
+                if sent_message.journal_id is not None:
+                    self.journal_reply(sent_message.journal_id)
 
                 # Log success status of reply
                 if reply.get("success"):
@@ -646,6 +925,15 @@ class Handler(object):
                                       topic_num, command_num, sent_message)
                     self.logger.error(".... %s", str(reply))
 
+                # Wake anything waiting for this reply
+                if sent_message.completion:
+                    if reply.get("success"):
+                        sent_message.completion.finish(
+                            constants.STATUS_SUCCESS, reply)
+                    else:
+                        sent_message.completion.finish(
+                            constants.STATUS_FAILURE, reply)
+
                 # Check what kind of message this is a reply to
                 if sent_command_type == TR50Command.file_get:
                     # Recevied a reply for a file download request
@@ -696,6 +984,8 @@ class Handler(object):
                     if reply.get("success"):
                         mill = reply["params"].get("time")
                         print (datetime.fromtimestamp(mill/1000.0))
+                        if self.config.cloud_time:
+                            self.set_cloud_time(sent_message, mill / 1000.0)
 
                     else:
                         if -90008 in reply.get("errorCodes", []):
@@ -719,11 +1009,45 @@ class Handler(object):
 
     def handle_publish(self):
         """
-        Publish any pending publishes in the publish queue, or the cloud logger
+        Publish any pending publishes in the publish queue, or the cloud logger.
+        Waits for any flush that is already running.
+        """
+
+        self.flush_lock.acquire()
+        try:
+            return self.handle_publish_locked()
+        finally:
+            self.flush_lock.release()
+
+            # Wake anything waiting for the flush to finish
+            self.flush_condition.acquire()
+            try:
+                self.flush_condition.notify_all()
+            finally:
+                self.flush_condition.release()
+
+    def handle_publish_locked(self):
+        """
+        Publish any pending publishes. flush_lock must be held.
         """
 
         status = constants.STATUS_SUCCESS
 
+        # Journaled publishes stay on disk until there is a connection to send
+        # them over
+        if self.journal:
+            if not self.is_connected():
+                return status
+            self.journal.expire()
+
+        # Coalesce the whole flush the same way, even if coalescing is changed
+        # while it is sent
+        self.lock.acquire()
+        try:
+            coalescer = defs.PublishCoalescer(self.coalescer)
+        finally:
+            self.lock.release()
+
         # Collect all pending publishes in publish queue
         to_publish = []
         while not self.publish_queue.empty():
@@ -731,70 +1055,147 @@ class Handler(object):
                 to_publish.append(self.publish_queue.get())
             except queue.Empty:
                 break
+        if self.telemetry_buffer:
+            to_publish.extend(self.telemetry_buffer.drain(coalescer))
+
+        # Send alarms ahead of everything else, keeping the order within each
+        # lane
+        to_publish.sort(key=lambda x: constants.LANES.index(
+            defs.publish_lane(x)))
+
+        # Drop any values superseded by newer ones in the same flush
+        superseded = to_publish
+        coalesced = len(to_publish)
+        to_publish = coalescer.filter(to_publish)
+        coalesced -= len(to_publish)
+
+        # Journaled publishes that were superseded have nothing left to send
+        if self.journal:
+            kept = set(id(x) for x in to_publish)
+            self.journal.ack([x.journal_id for x in superseded if
+                              id(x) not in kept])
 
         if to_publish:
             # If pending publishes are found, parse into list for sending
             messages = []
             for pub in to_publish:
+                pub_messages = self.publish_messages(pub)
+                if pub.journal_id is not None:
+                    # Keep the journal entry until every command is replied to
+                    for message in pub_messages:
+                        message.journal_id = pub.journal_id
+                    self.lock.acquire()
+                    try:
+                        self.journal_pending[pub.journal_id] = len(pub_messages)
+                    finally:
+                        self.lock.release()
+                messages.extend(pub_messages)
 
-                # Create publish command for an alarm
-                if pub.type == "PublishAlarm":
-                    command = tr50.create_alarm_publish(self.config.key,
-                                                        pub.name, pub.state,
-                                                        message=pub.message,
-                                                        timestamp=pub.timestamp)
-                    message_desc = "Alarm Publish {}".format(pub.name)
-                    message_desc += " : {}".format(pub.state)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for strings
-                elif pub.type == "PublishAttribute":
-                    command = tr50.create_attribute_publish(self.config.key,
-                                                            pub.name, pub.value,
-                                                            timestamp=pub.timestamp)
-                    message_desc = "Attribute Publish {}".format(pub.name)
-                    message_desc += " : \"{}\"".format(pub.value)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for numbers
-                elif pub.type == "PublishTelemetry":
-                    command = tr50.create_property_publish(self.config.key,
-                                                           pub.name, pub.value,
-                                                           timestamp=pub.timestamp)
-                    message_desc = "Property Publish {}".format(pub.name)
-                    message_desc += " : {}".format(pub.value)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for location
-                elif pub.type == "PublishLocation":
-                    command = tr50.create_location_publish(self.config.key,
-                                                           pub.latitude,
-                                                           pub.longitude,
-                                                           heading=pub.heading,
-                                                           altitude=pub.altitude,
-                                                           speed=pub.speed,
-                                                           fix_accuracy=pub.accuracy,
-                                                           fix_type=pub.fix_type,
-                                                           timestamp=pub.timestamp)
-                    message_desc = "Location Publish {}".format(str(pub))
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for a log
-                elif pub.type == "PublishLog":
-                    command = tr50.create_log_publish(self.config.key,
-                                                      pub.message,
-                                                      timestamp=pub.timestamp)
-                    message_desc = "Log Publish {}".format(pub.message)
-                    message = defs.OutMessage(command, message_desc)
-
-                messages.append(message)
-
-            # Send all publishes
+            # Send all publishes, split into as few requests as the size
+            # limits allow
             if messages:
-                status = self.send(messages)
+                max_bytes = self.config.publish_max_bytes
+                batches = tr50.generate_requests([x.command for x in messages],
+                                                 self.config.publish_max_commands,
+                                                 max_bytes)
+                flush_bytes = 0
+                for start, end, payload in batches:
+                    if max_bytes and len(payload) > max_bytes:
+                        self.logger.warning("Publish request of %d bytes "
+                                            "exceeds limit of %d bytes",
+                                            len(payload), max_bytes)
+                    result = self.send(messages[start:end], payload=payload)
+                    if result != constants.STATUS_SUCCESS:
+                        status = result
+                    flush_bytes += len(payload)
+
+                # Report the result of this flush
+                self.lock.acquire()
+                try:
+                    self.publish_stats["flushes"] += 1
+                    self.publish_stats["commands"] += len(messages)
+                    self.publish_stats["batches"] += len(batches)
+                    self.publish_stats["bytes"] += flush_bytes
+                    self.publish_stats["coalesced"] += coalesced
+                finally:
+                    self.lock.release()
+                self.logger.debug("Flushed %d publishes in %d requests "
+                                  "(%d bytes, %d coalesced)", len(messages),
+                                  len(batches), flush_bytes, coalesced)
 
         return status
 
+    def handle_reconnect(self):
+        """
+        Attempt to reconnect MQTT
+        """
+
+        try:
+            result = self.mqtt.reconnect()
+        except Exception:
+            result = None
+        self.reconnect_result(result)
+        return constants.STATUS_SUCCESS
+
+    def handle_reply_timeouts(self, messages):
+        """
+        Handle sent messages that will not be waited on for a reply any longer.
+        Journaled publishes are replayed, file transfers are failed and any
+        timeout callbacks are called.
+        """
+
+        retry = []
+        self.lock.acquire()
+        try:
+            for message in messages:
+                self.command_counter(message.command_type)["timeouts"] += 1
+                if message.journal_id is not None:
+                    if self.journal_pending.pop(message.journal_id,
+                                                None) is not None:
+                        retry.append(message.journal_id)
+        finally:
+            self.lock.release()
+        if retry:
+            self.journal.retry(retry)
+
+        for message in messages:
+            self.logger.warning("No reply for %s - %s", message.out_id,
+                                message)
+            if isinstance(message.data, defs.FileTransfer):
+                message.data.status = constants.STATUS_TIMED_OUT
+                message.data.finish()
+            if message.completion:
+                message.completion.finish(constants.STATUS_TIMED_OUT)
+            if message.on_timeout:
+                try:
+                    message.on_timeout(message)
+                except Exception:
+                    self.logger.exception("Exception in reply timeout "
+                                          "callback:")
+        return constants.STATUS_SUCCESS
+
+    def handle_work(self, work):
+        """
+        Handle an item taken from the work queue based on its type
+        """
+
+        try:
+            if work.type == constants.WORK_MESSAGE:
+                self.handle_message(work.data)
+            elif work.type == constants.WORK_PUBLISH:
+                self.handle_publish()
+            elif work.type == constants.WORK_ACTION:
+                self.handle_action(work.data)
+            elif work.type == constants.WORK_DOWNLOAD:
+                self.handle_file_download(work.data)
+            elif work.type == constants.WORK_UPLOAD:
+                self.handle_file_upload(work.data)
+            elif work.type == constants.WORK_RECONNECT:
+                self.handle_reconnect()
+        except Exception:
+            # Print traceback, but don't kill thread
+            self.logger.exception("Exception:")
+
     def handle_work_loop(self):
         """
         Loop for worker threads to handle any items put on the work queue
@@ -810,22 +1211,24 @@ class Handler(object):
             # If work is retrieved from the queue, handle it based on type
             if work:
                 try:
-                    if work.type == constants.WORK_MESSAGE:
-                        self.handle_message(work.data)
-                    elif work.type == constants.WORK_PUBLISH:
-                        self.handle_publish()
-                    elif work.type == constants.WORK_ACTION:
-                        self.handle_action(work.data)
-                    elif work.type == constants.WORK_DOWNLOAD:
-                        self.handle_file_download(work.data)
-                    elif work.type == constants.WORK_UPLOAD:
-                        self.handle_file_upload(work.data)
-                except Exception:
-                    # Print traceback, but don't kill thread
-                    self.logger.exception("Exception:")
+                    self.handle_work(work)
+                finally:
+                    self.work_queue.task_done()
 
         return constants.STATUS_SUCCESS
 
+    def handle_periodic(self):
+        """
+        Stop waiting for replies that are overdue, and queue publishes for
+        any aggregation windows that have ended and for round trip times when
+        they are due
+        """
+
+        self.expire_replies()
+        self.publish_aggregates()
+        self.report_stats()
+        return constants.STATUS_SUCCESS
+
     def handle_ping(self):
         """
         Request connection check
@@ -846,6 +1249,20 @@ class Handler(object):
         status = self.send(message)
         return constants.STATUS_SUCCESS
 
+    def io_wake(self):
+        """
+        Wake the main loop from waiting for the MQTT socket
+        """
+
+        writer = self.wake_writer
+        if writer:
+            try:
+                writer.send(b"\0")
+            except (socket.error, ValueError):
+                # The socket buffer is full, so the loop is already awake, or
+                # the main loop has ended
+                pass
+
     def is_connected(self):
         """
         Returns connection status of Client to Cloud
@@ -854,6 +1271,35 @@ class Handler(object):
         return self.state == constants.STATE_CONNECTED
 
 
+    def journal_reply(self, journal_id):
+        """
+        Count a reply for a command of a journaled publish, removing the
+        publish from the journal when all of its commands have been replied to
+        """
+
+        done = False
+        self.lock.acquire()
+        try:
+            remaining = self.journal_pending.get(journal_id)
+            if remaining is not None:
+                if remaining > 1:
+                    self.journal_pending[journal_id] = remaining - 1
+                else:
+                    del self.journal_pending[journal_id]
+                    done = True
+        finally:
+            self.lock.release()
+        if done:
+            self.journal.ack([journal_id])
+
+    def latency_stats(self):
+        """
+        Get how long publishes and work have waited in each queue lane
+        """
+
+        return {"publish":self.publish_queue.latency_stats(),
+                "work":self.work_queue.latency_stats()}
+
     def log_level(self, log_level=None):
         """
         Set Logging Level
@@ -884,61 +1330,162 @@ class Handler(object):
         #self.logger.log(logging.INFO, "This is a log with info")
         #self.logger.warning("This is a warning")
 
+    def loop_timeout(self):
+        """
+        Get the number of seconds the main loop can wait for the MQTT socket
+        before it has to check for overdue replies, ended aggregation windows,
+        round trip times to publish or keep alives. While disconnected, this
+        is the time until the next reconnection attempt is due.
+        """
+
+        if self.state == constants.STATE_DISCONNECTED:
+            return self.reconnect_timeout()
+
+        # MQTT keep alives are checked a few times per keep alive period
+        now = time()
+        deadlines = [now + constants.MQTT_KEEP_ALIVE / 4.0]
+
+        self.lock.acquire()
+        try:
+            deadlines.append(self.reply_tracker.next_deadline())
+        finally:
+            self.lock.release()
+
+        # Aggregation windows are timed by the publish clock
+        offset = self.clock.offset
+        expiry = self.aggregator.next_expiry(now + offset)
+        if expiry is not None:
+            deadlines.append(expiry - offset)
+        if self.config.stats_interval:
+            deadlines.append(self.stats_time + self.config.stats_interval)
+
+        return max(min(x for x in deadlines if x is not None) - now, 0)
+
     def main_loop(self):
         """
         Main loop for MQTT to send and receive messages, as well as queue work
         for publishing and checking timeouts
         """
 
+        # Sockets to wake the loop early. Without them, MQTT is polled.
+        if hasattr(socket, "socketpair"):
+            self.wake_reader, self.wake_writer = socket.socketpair()
+            self.wake_reader.setblocking(False)
+            self.wake_writer.setblocking(False)
+
         # Continuously loop while connected or connecting
         while not self.to_quit:
 
-            # If disconnected, attempt to reestablish connection
+            # If disconnected, attempt to reestablish connection once the
+            # backoff delay has passed
             if self.state == constants.STATE_DISCONNECTED:
-                max_time = self.config.keep_alive
-                elapsed_time = (datetime.utcnow() -
-                                self.last_connected).total_seconds()
-                if max_time == 0 or elapsed_time < max_time:
-                    try:
-                        result = self.mqtt.reconnect()
-                        if result == 0:
-                            self.logger.debug("Reconnecting...")
-                            self.state = constants.STATE_CONNECTING
-                    except Exception:
-                        sleep(self.config.loop_time)
-                else:
-                    self.logger.error("No connection after %d seconds, "
-                                      "exiting...",
-                                      self.config.keep_alive)
-                    self.to_quit = True
+                if self.reconnect_due():
+                    self.handle_reconnect()
+                elif self.to_quit:
                     break
 
-            self.mqtt.loop(timeout=self.config.loop_time)
+            self.mqtt_loop(self.loop_timeout())
 
-            # Make a work item to publish anything that's pending
-            if not self.publish_queue.empty():
-                self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+            # Check for overdue replies, ended aggregation windows and round
+            # trip times that are due
+            self.handle_periodic()
 
         # One last loop to send out any pending messages
-        self.mqtt.loop(timeout=0.1)
+        self.mqtt_loop(0.1)
 
         # Disconnect MQTT
         self.mqtt.disconnect()
-
-        # Wait for worker threads to finish.
+        wake_reader, wake_writer = self.wake_reader, self.wake_writer
+        self.wake_reader = self.wake_writer = None
+        if wake_reader:
+            wake_reader.close()
+            wake_writer.close()
+
+        # Wait for worker threads and the publish thread to finish.
+        self.flush_wake()
         for thread in self.worker_threads:
             thread.join()
         self.worker_threads = []
+        if self.publish_thread:
+            self.publish_thread.join()
+            self.publish_thread = None
+
+        # No transfer can finish once the workers have stopped
+        self.fail_transfers()
 
         # On disconnect, show all messages that never received replies
         if len(self.reply_tracker) > 0:
             self.logger.error("These messages never received a reply:")
             for mid, message in self.reply_tracker.items():
-                self.logger.error(".... %s - %s", mid,
-                                  message.description)
+                self.logger.error(".... %s - %s", mid, message)
 
         return constants.STATUS_SUCCESS
 
+    def mqtt_loop(self, timeout):
+        """
+        Wait for up to timeout seconds for the MQTT socket to be readable, or
+        writable if MQTT has data to send, or for the loop to be woken. Then
+        read, write and handle keep alives as needed. MQTT is polled with
+        loop() if its socket can't be watched with select().
+        """
+
+        sock = self.mqtt.socket()
+        if sock is None:
+            fileno = None
+        else:
+            try:
+                fileno = sock.fileno()
+            except Exception:
+                fileno = None
+        if (not self.wake_reader or
+                (sock is not None and not isinstance(fileno, int))):
+            if sock is None:
+                # Nothing to poll while disconnected
+                sleep(timeout)
+                return mqttlib.MQTT_ERR_NO_CONN
+            return self.mqtt.loop(timeout=timeout)
+
+        rlist = [self.wake_reader]
+        wlist = []
+        pending = False
+        if sock is not None:
+            rlist.append(sock)
+            if self.mqtt.want_write():
+                wlist.append(sock)
+
+            # Data already decrypted by SSL is not reported by select()
+            if hasattr(sock, "pending") and sock.pending() > 0:
+                pending = True
+                timeout = 0
+
+        try:
+            readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        except (select.error, socket.error, TypeError, ValueError):
+            # Socket was closed
+            return mqttlib.MQTT_ERR_CONN_LOST
+
+        if self.wake_reader in readable:
+            try:
+                self.wake_reader.recv(4096)
+            except socket.error:
+                pass
+
+            # Woken because MQTT has data to send
+            if sock is not None and self.mqtt.want_write():
+                writable = [sock]
+
+        if sock is None:
+            return mqttlib.MQTT_ERR_NO_CONN
+        if sock in readable or pending:
+            result = self.mqtt.loop_read()
+            if result or self.mqtt.socket() is None:
+                return result
+        if sock in writable:
+            result = self.mqtt.loop_write()
+            if result or self.mqtt.socket() is None:
+                return result
+        return self.mqtt.loop_misc()
+
     def num_unfinished(self):
         """
         Get number of unfulfilled requests
@@ -955,10 +1502,32 @@ class Handler(object):
         # Check connection result from MQTT
         self.logger.info("MQTT connected: %s", mqttlib.connack_string(rc))
         if rc == 0:
+            # Replay any journaled publishes that were sent without a reply
+            if self.journal:
+                self.lock.acquire()
+                try:
+                    self.journal_pending.clear()
+                finally:
+                    self.lock.release()
+                self.journal.rewind()
             self.state = constants.STATE_CONNECTED
+            self.backoff.success()
+
+            # TLS 1.3 session tickets arrive after the handshake
+            if self.tls_context and self.mqtt_tls:
+                self.tls_context.save_session(self.mqtt.socket())
+            if self.connection:
+                self.connection.finish(constants.STATUS_SUCCESS)
+            self.flush_wake()
+
+            # Time publishes by the Cloud's clock
+            if self.config.cloud_time:
+                self.handle_time()
         else:
             self.state = constants.STATE_DISCONNECTED
-            self.last_connected = datetime.utcnow()
+            self.backoff.failure()
+            if self.connection:
+                self.connection.finish(constants.STATUS_FAILURE)
 
     def on_disconnect(self, mqtt, userdata, rc):
         """
@@ -967,9 +1536,13 @@ class Handler(object):
 
         if self.to_quit:
             self.logger.info("MQTT disconnected")
-        else:
+        elif self.state == constants.STATE_CONNECTED:
+            # Keep alive counts from when the connection was lost, not from
+            # failed reconnection attempts
             self.logger.error("MQTT connection lost. Attempting to reconnect...")
             self.last_connected = datetime.utcnow()
+        if not self.to_quit:
+            self.backoff.disconnected()
         self.state = constants.STATE_DISCONNECTED
 
     def on_message(self, mqtt, userdata, msg):
@@ -977,7 +1550,7 @@ class Handler(object):
         Callback when MQTT Client receives a message
         """
 
-        message = defs.Message(msg.topic, json.loads(msg.payload.decode()))
+        message = defs.Message(msg.topic, codec.loads(msg.payload))
         self.logger.debug("Received message on topic \"%s\"\n%s", msg.topic,
                           message)
 
@@ -991,11 +1564,160 @@ class Handler(object):
         Notify that a message has been published
         """
 
-        if self.qos_level == 0:
-            pass
+        topic_num = self.reply_tracker.pop_mid(mid)
+        self.logger.debug("MQTT sent %s", topic_num)
+
+    def on_socket_register_write(self, mqtt, userdata, sock):
+        """
+        Callback when MQTT has data to write, so the main loop writes it
+        """
+
+        self.io_wake()
+
+    def pending_publishes(self):
+        """
+        Get the number of publishes and buffered telemetry samples waiting to
+        be sent
+        """
+
+        count = self.publish_queue.qsize()
+        if self.telemetry_buffer:
+            count += len(self.telemetry_buffer)
+        return count
+
+    def publish_aggregates(self, force=False):
+        """
+        Queue publishes for any aggregation windows that have ended, or for all
+        open windows if force is set
+        """
+
+        for pub in self.aggregator.expire(now=self.clock.now(), force=force):
+            self.queue_publish(pub, block=False)
+        return constants.STATUS_SUCCESS
+
+    def publish_loop(self):
+        """
+        Loop for the publish thread. Wakes as soon as publishes are queued,
+        lingers for up to linger_ms (or until max_batch publishes are waiting)
+        so more publishes can join the batch, then flushes them. Publishes
+        queued during a flush are sent by the next one.
+        """
+
+        linger = (self.config.linger_ms or 0) / 1000.0
+        max_batch = self.config.max_batch or 0
+
+        while not self.to_quit:
+            self.flush_condition.acquire()
+            try:
+                # Wait for publishes, and for a connection if publishes are
+                # journaled
+                if (not self.pending_publishes() or
+                        (self.journal and not self.is_connected())):
+                    self.flush_condition.wait(self.config.loop_time)
+                    continue
+
+                # Give other publishes a chance to join this batch
+                end_time = time() + linger
+                remaining = linger
+                while (remaining > 0 and not self.to_quit and
+                       not (max_batch and
+                            self.pending_publishes() >= max_batch)):
+                    self.flush_condition.wait(remaining)
+                    remaining = end_time - time()
+            finally:
+                self.flush_condition.release()
+
+            try:
+                self.handle_publish()
+            except Exception:
+                # Print traceback, but don't kill thread
+                self.logger.exception("Exception:")
+
+        return constants.STATUS_SUCCESS
+
+    def publish_messages(self, pub):
+        """
+        Create the messages to send for a pending publish
+        """
+
+        messages = []
+
+        # Descriptions are only formatted if they are logged, and are skipped
+        # entirely if commands are not logged
+        if self.config.log_commands is False:
+            describe = lambda fmt, *args: None
         else:
-            topic_num = self.reply_tracker.pop_mid(mid)
-            self.logger.debug("MQTT sent %s", topic_num)
+            describe = defs.Description
+
+        # Publish times are only formatted when they are sent
+        timestamp = defs.format_timestamp(pub.timestamp, self.clock)
+
+        # Create publish command for an alarm
+        if pub.type == "PublishAlarm":
+            command = tr50.encode_alarm_publish(self.config.key, pub.name,
+                                                pub.state, message=pub.message,
+                                                timestamp=timestamp)
+            message_desc = describe("Alarm Publish {} : {}", pub.name,
+                                    pub.state)
+            messages.append(defs.OutMessage(
+                command, message_desc,
+                command_type=TR50Command.alarm_publish))
+
+        # Create publish command for strings
+        elif pub.type == "PublishAttribute":
+            command = tr50.encode_attribute_publish(self.config.key, pub.name,
+                                                    pub.value,
+                                                    timestamp=timestamp)
+            message_desc = describe("Attribute Publish {} : \"{}\"",
+                                    pub.name, pub.value)
+            messages.append(defs.OutMessage(
+                command, message_desc,
+                command_type=TR50Command.attribute_publish))
+
+        # Create publish command for numbers
+        elif pub.type == "PublishTelemetry":
+            command = tr50.encode_property_publish(self.config.key, pub.name,
+                                                   pub.value,
+                                                   timestamp=timestamp)
+            message_desc = describe("Property Publish {} : {}", pub.name,
+                                    pub.value)
+            messages.append(defs.OutMessage(
+                command, message_desc,
+                command_type=TR50Command.property_publish))
+
+        # Create publish commands for many samples of a number
+        elif pub.type == "PublishTelemetryBulk":
+            for value, timestamp in pub.samples(self.clock):
+                command = tr50.encode_property_publish(self.config.key,
+                                                       pub.name, value,
+                                                       timestamp=timestamp)
+                message_desc = describe("Property Publish {} : {}",
+                                        pub.name, value)
+                messages.append(defs.OutMessage(
+                    command, message_desc,
+                    command_type=TR50Command.property_publish))
+
+        # Create publish command for location
+        elif pub.type == "PublishLocation":
+            command = tr50.create_location_publish(self.config.key,
+                                                   pub.latitude, pub.longitude,
+                                                   heading=pub.heading,
+                                                   altitude=pub.altitude,
+                                                   speed=pub.speed,
+                                                   fix_accuracy=pub.accuracy,
+                                                   fix_type=pub.fix_type,
+                                                   timestamp=timestamp)
+            message_desc = describe("Location Publish {}", pub)
+            messages.append(defs.OutMessage(command, message_desc))
+
+        # Create publish command for a log
+        elif pub.type == "PublishLog":
+            command = tr50.create_log_publish(self.config.key, pub.message,
+                                              timestamp=timestamp)
+            message_desc = describe("Log Publish {}", pub.message)
+            messages.append(defs.OutMessage(command, message_desc))
+
+        return messages
 
     def qos_level(self, qos_level=None):
         """
@@ -1009,13 +1731,34 @@ class Handler(object):
             self.logger.warning("qos_level invalid or not set, 1 used as default")
             self.qos_level = 1
 
-    def queue_publish(self, pub):
+    def queue_publish(self, pub, block=True):
         """
-        Place pub in the publish queue
+        Place pub in the publish queue, applying the queue policy if it is
+        full. If block is False a full queue never blocks, and is treated as
+        the reject policy instead. Publishes without a time are timed now.
         """
 
-        self.publish_queue.put(pub)
-        return constants.STATUS_SUCCESS
+        policy = self.queue_policy
+        if not block and policy == constants.QUEUE_POLICY_BLOCK:
+            policy = constants.QUEUE_POLICY_REJECT
+
+        if pub.timestamp is None:
+            pub.timestamp = self.clock.now()
+
+        try:
+            status = self.publish_queue.put_policy(
+                pub, policy, self.config.publish_queue_timeout)
+        except (TypeError, ValueError) as error:
+            # Publish cannot be written to the journal
+            self.logger.error("Failed to queue publish: %s", str(error))
+            return constants.STATUS_BAD_PARAMETER
+
+        if status != constants.STATUS_SUCCESS:
+            self.logger.warning("Publish queue full, publish not queued (%s)",
+                                status_string(status))
+        else:
+            self.flush_wake()
+        return status
 
     def queue_work(self, work):
         """
@@ -1025,14 +1768,243 @@ class Handler(object):
         self.work_queue.put(work)
         return constants.STATUS_SUCCESS
 
+    def reconnect_due(self):
+        """
+        Check whether a reconnection attempt is due. Once keep_alive seconds
+        have passed since the connection was lost, gives up and sets to_quit.
+        """
+
+        max_time = self.config.keep_alive
+        elapsed_time = (datetime.utcnow() -
+                        self.last_connected).total_seconds()
+        if max_time and elapsed_time >= max_time:
+            self.logger.error("No connection after %d seconds, exiting...",
+                              max_time)
+            self.to_quit = True
+            return False
+        if self.backoff.state == constants.BREAKER_CLOSED:
+            # Lost the connection without a disconnect callback
+            self.backoff.disconnected()
+        return self.backoff.attempt()
+
+    def reconnect_result(self, result):
+        """
+        Handle the result of an MQTT reconnection attempt, or None if it
+        raised an exception
+        """
+
+        if result == 0:
+            self.logger.debug("Reconnecting...")
+            self.state = constants.STATE_CONNECTING
+        else:
+            self.backoff.failure()
+            self.logger.debug("Reconnecting failed, retrying in %.1f seconds",
+                              self.backoff.remaining())
+
+    def reconnect_timeout(self):
+        """
+        Get the number of seconds until the next reconnection attempt is due,
+        or until keep_alive runs out if that is sooner
+        """
+
+        timeout = self.backoff.remaining()
+        if timeout is None:
+            timeout = 0.0
+        if self.config.keep_alive:
+            elapsed_time = (datetime.utcnow() -
+                            self.last_connected).total_seconds()
+            timeout = min(timeout, max(self.config.keep_alive - elapsed_time,
+                                       0.0))
+        return timeout
+
+    def report_stats(self, force=False):
+        """
+        Publish round trip time percentiles, in milliseconds, as telemetry if
+        stats_interval seconds have passed since they were last published
+        """
+
+        interval = self.config.stats_interval
+        now = time()
+        if not force and (not interval or now < self.stats_time + interval):
+            return constants.STATUS_SUCCESS
+        self.stats_time = now
+
+        for command_type, stats in self.command_stats().items():
+            rtt = stats["rtt"]
+            if not rtt["count"]:
+                continue
+            for name in ("p50", "p95", "p99", "max"):
+                key = "rtt.{}.{}".format(command_type, name)
+                self.queue_publish(defs.PublishTelemetry(key,
+                                                         rtt[name] * 1000.0),
+                                   block=False)
+        return constants.STATUS_SUCCESS
+
     def request_download(self, file_name, file_dest, blocking=False,
                          callback=None, timeout=0, file_global=False):
         """
         Request a C2D file transfer
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        status, completion = self.start_download(file_name, file_dest,
+                                                 callback=callback,
+                                                 file_global=file_global)
+
+        # If blocking is set, wait for result of file transfer
+        if status == constants.STATUS_SUCCESS and blocking:
+            status = completion.wait(timeout)
+            if status is None:
+                status = constants.STATUS_TIMED_OUT
+
+        return status
+
+    def request_upload(self, file_path, upload_name=None, blocking=False,
+                       callback=None, timeout=0, file_global=False):
+        """
+        Request a D2C file transfer
+        """
+
+        status, completion = self.start_upload(file_path,
+                                               upload_name=upload_name,
+                                               callback=callback,
+                                               file_global=file_global)
+
+        # If blocking is set, wait for result of file transfer
+        if status == constants.STATUS_SUCCESS and blocking:
+            status = completion.wait(timeout)
+            if status is None:
+                status = constants.STATUS_TIMED_OUT
+
+        return status
+
+    def set_cloud_time(self, sent_message, cloud_time):
+        """
+        Offset the time of new publishes to follow the Cloud's clock, given the
+        Cloud's time in a reply to a diag.time request. The Cloud's time is
+        assumed to be from half way through the round trip.
+        """
+
+        sent = defs.epoch_seconds(sent_message.timestamp)
+        local_time = (sent + time()) / 2.0
+        self.clock.offset = cloud_time - local_time
+        self.logger.info("Clock offset from Cloud is %.3f seconds",
+                         self.clock.offset)
+        return constants.STATUS_SUCCESS
+
+    def send(self, messages, payload=None):
+        """
+        Send commands to the Cloud, and track them to wait for replies. A
+        request string already generated for the commands can be passed as
+        payload.
+        """
+        status = constants.STATUS_FAILURE
+
+        message_list = messages
+        if messages.__class__.__name__ != "list":
+            message_list = [messages]
+
+        # Generate final request string
+        if payload is None:
+            payload = tr50.generate_request([x.command for x in message_list])
+
+        # Lock to ensure all outgoing messages are tracked before handling
+        # received messages
+        self.lock.acquire()
+        try:
+            # Obtain new unused topic number. Messages are only dropped for a
+            # topic number if every one is waiting for replies.
+            topic_num, evicted = self.reply_tracker.new_topic()
+
+            # Send payload over MQTT
+            result, mid = self.mqtt.publish("api/{}".format(topic_num),
+                                            payload, qos = self.qos_level)
+
+            # Track the topic this message will send on
+            self.reply_tracker.add_mid(mid, topic_num)
+
+            # Current timestamp to mark when message was sent
+            now = time()
+
+            # Track each message, with its share of the request size
+            size = len(payload) // len(message_list)
+            for num, msg in enumerate(message_list):
+                # Add timestamps and ids
+                msg.timestamp = now
+                msg.out_id = "{}-{}".format(topic_num, num+1)
+                msg.size = size
+                self.command_counter(msg.command_type)["sent"] += 1
+
+                evicted.extend(self.reply_tracker.add_message(msg, now))
+            status = constants.STATUS_SUCCESS
+
+        finally:
+            self.lock.release()
+
+        # Log outside the lock. Descriptions and commands are only formatted
+        # if the records are emitted.
+        if (self.config.log_commands is not False and
+                self.logger.isEnabledFor(logging.INFO)):
+            for num, msg in enumerate(message_list):
+                self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num,
+                                 num+1, msg, defs.CommandDump(msg.command))
+
+        # Messages dropped to stay under the size limit are handled as if
+        # they timed out
+        if evicted:
+            self.handle_reply_timeouts(evicted)
+
+        return status
+
+
+    def send_request(self, message):
+        """
+        Send a single command to the Cloud, returning a Completion that is
+        finished with the reply (or STATUS_TIMED_OUT if none arrives)
+        """
+
+        message.completion = defs.Completion()
+        status = self.send(message)
+        if status != constants.STATUS_SUCCESS:
+            message.completion.finish(status)
+        return message.completion
+
+    def stats(self):
+        """
+        Get statistics for commands, publish flushes, queue waits, publishes
+        that were dropped or refused, reconnection attempts, TLS handshakes
+        and reuse of HTTPS connections
+        """
+
+        publish_queue = {"size":self.publish_queue.qsize(),
+                         "dropped":self.publish_queue.dropped,
+                         "rejected":self.publish_queue.rejected}
+        if self.telemetry_buffer is not None:
+            publish_queue["buffered"] = len(self.telemetry_buffer)
+            publish_queue["dropped"] += self.telemetry_buffer.dropped
+            publish_queue["rejected"] += self.telemetry_buffer.rejected
+        self.lock.acquire()
+        try:
+            publish = dict(self.publish_stats)
+            replies = {"pending":len(self.reply_tracker),
+                       "timed_out":self.reply_tracker.timed_out,
+                       "evicted":self.reply_tracker.evicted}
+        finally:
+            self.lock.release()
+        return {"commands":self.command_stats(),
+                "publish":publish,
+                "publish_queue":publish_queue,
+                "latency":self.latency_stats(),
+                "reconnect":self.backoff.stats(),
+                "replies":replies,
+                "tls":self.tls_context.stats() if self.tls_context else None,
+                "http":self.http_adapter.stats() if self.http_adapter else None}
+
+    def start_download(self, file_name, file_dest, callback=None,
+                       file_global=False):
+        """
+        Request a C2D file transfer without waiting for it. Returns the status
+        of the request and a Completion finished with the transfer's status.
+        """
 
         self.logger.info("Request download of %s", file_name)
 
@@ -1049,31 +2021,22 @@ class Handler(object):
         message = defs.OutMessage(command, "Download {}".format(file_name),
                                   data=transfer)
         status = self.send(message)
+        if status == constants.STATUS_SUCCESS:
+            self.track_transfer(transfer)
+        else:
+            transfer.status = status
 
-        # If blocking is set, wait for result of file transfer
-        if status == constants.STATUS_SUCCESS and blocking:
-            while ((timeout == 0 or current_time < end_time) and
-                   transfer.status is None):
-                sleep(0.1)
-                current_time = datetime.utcnow()
-
-            if transfer.status is None:
-                status = constants.STATUS_TIMED_OUT
-            else:
-                status = transfer.status
-
-        return status
+        return status, transfer.completion
 
-    def request_upload(self, file_path, upload_name=None, blocking=False,
-                       callback=None, timeout=0, file_global=False):
+    def start_upload(self, file_path, upload_name=None, callback=None,
+                     file_global=False):
         """
-        Request a D2C file transfer
+        Request a D2C file transfer without waiting for it. Returns the status
+        of the request and a Completion finished with the transfer's status.
         """
 
         status = constants.STATUS_SUCCESS
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
-        transfer = None
+        completion = defs.Completion()
 
         self.logger.info("Request upload of %s", file_path)
 
@@ -1090,7 +2053,6 @@ class Handler(object):
                                   "Upload cancelled.", file_path)
                 status = constants.STATUS_NOT_FOUND
             else:
-                transfer = None
                 file_name = os.path.basename(file_path)
                 if not upload_name:
                     upload_name = file_name
@@ -1106,6 +2068,7 @@ class Handler(object):
                 transfer = defs.FileTransfer(upload_name, file_path,
                                              self.client,
                                              callback=callback)
+                completion = transfer.completion
 
                 # Generate and send message to request file transfer
                 command = tr50.create_file_put(self.config.key, upload_name,
@@ -1116,68 +2079,55 @@ class Handler(object):
                 message = defs.OutMessage(command, message_desc,
                                           data=transfer)
                 status = self.send(message)
+                if status == constants.STATUS_SUCCESS:
+                    self.track_transfer(transfer)
 
-                # If blocking is set, wait for result of file transfer
-                if status == constants.STATUS_SUCCESS and blocking:
-                    while ((timeout == 0 or current_time < end_time) and
-                           not self.to_quit and transfer.status is None):
-                        sleep(0.1)
-                        current_time = datetime.utcnow()
-
-                    if transfer.status is None:
-                        status = constants.STATUS_TIMED_OUT
-                    else:
-                        status = transfer.status
+        if status != constants.STATUS_SUCCESS:
+            completion.finish(status)
 
-        return status
+        return status, completion
 
-    def send(self, messages):
+    def track_transfer(self, transfer):
         """
-        Send commands to the Cloud, and track them to wait for replies
+        Track a requested file transfer until it finishes, forgetting any
+        that already have
         """
-        status = constants.STATUS_FAILURE
 
-        message_list = messages
-        if messages.__class__.__name__ != "list":
-            message_list = [messages]
-
-        # Generate final request string
-        payload = tr50.generate_request([x.command for x in message_list])
-
-        # Lock to ensure all outgoing messages are tracked before handling
-        # received messages
         self.lock.acquire()
         try:
-            # Obtain new unused topic number
-            while True:
-                topic_num = "{:0>4}".format(self.topic_counter)
-                self.topic_counter += 1
-                if topic_num not in self.reply_tracker:
-                    break
-            # Send payload over MQTT
-            result, mid = self.mqtt.publish("api/{}".format(topic_num),
-                                            payload, qos = self.qos_level)
-
-            # Track the topic this message will send on
-            self.reply_tracker.add_mid(mid, topic_num)
+            self.transfers = [tracked for tracked in self.transfers
+                              if not tracked.completion.done()]
+            self.transfers.append(transfer)
+        finally:
+            self.lock.release()
 
-            # Current timestamp to mark when message was sent
-            current_time = datetime.utcnow()
+    def tls_verify(self):
+        """
+        Check whether server certificates are verified
+        """
 
-            # Track each message
-            for num, msg in enumerate(message_list):
-                # Add timestamps and ids
-                msg.timestamp = current_time
-                msg.out_id = "{}-{}".format(topic_num, num+1)
+        return bool(self.config.validate_cloud_cert is not False and
+                    self.config.ca_bundle_file)
 
-                self.reply_tracker.add_message(msg)
-                self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num, num+1,
-                                 msg, json.dumps(msg.command, indent=2,
-                                                 sort_keys=True))
-            status = constants.STATUS_SUCCESS
+    def wait_condition(self, condition, predicate, end_time=None):
+        """
+        Wait on a condition variable until predicate() is true, or until
+        end_time (from time.time()) if one is given. Returns the last result
+        of predicate().
+        """
 
+        condition.acquire()
+        try:
+            result = predicate()
+            while not result:
+                if end_time is None:
+                    condition.wait(self.config.loop_time)
+                else:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        break
+                    condition.wait(remaining)
+                result = predicate()
+            return result
         finally:
-            self.lock.release()
-
-        return status
-
+            condition.release()
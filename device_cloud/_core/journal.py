@@ -0,0 +1,269 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains a disk-backed publish queue that keeps pending publishes
+across restarts and long periods offline
+"""
+
+import sqlite3
+import time
+from collections import deque
+
+from device_cloud._core import codec
+from device_cloud._core import defs
+
+# States of journal entries
+ENTRY_PENDING = 0
+ENTRY_IN_FLIGHT = 1
+
+# Number of pending entries read from disk at a time
+READ_AHEAD = 256
+
+
+class PublishJournal(defs.PublishQueue):
+    """
+    Queue of pending publishes stored in an SQLite database (in WAL mode).
+    Entries taken from the queue stay in the journal, marked as in flight,
+    until they are acknowledged once the Cloud has replied to them. In flight
+    entries are replayed, in their original order, after rewind() or when the
+    journal is opened again. The oldest entries are dropped when the journal is
+    larger than max_bytes or older than max_age seconds (0 means no limit).
+    Entries are read back in the order they were written; alarms are moved
+    ahead of other publishes when each flush is sent.
+    """
+
+    def __init__(self, path, max_bytes=0, max_age=0, maxsize=0, burst=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # Calls _init() to open the database
+        defs.PublishQueue.__init__(self, maxsize, burst=burst)
+
+    def __len__(self):
+        self.mutex.acquire()
+        try:
+            return self.count
+        finally:
+            self.mutex.release()
+
+    def ack(self, entry_ids):
+        """
+        Remove entries that have been delivered to the Cloud
+        """
+
+        if not entry_ids:
+            return
+        self.mutex.acquire()
+        try:
+            for entry_id in entry_ids:
+                row = self.db.execute("SELECT size FROM publishes WHERE id=?",
+                                      (entry_id,)).fetchone()
+                if row:
+                    self.db.execute("DELETE FROM publishes WHERE id=?",
+                                    (entry_id,))
+                    self.count -= 1
+                    self.size -= row[0]
+            self.db.commit()
+        finally:
+            self.mutex.release()
+
+    def close(self):
+        """
+        Close the database
+        """
+
+        self.mutex.acquire()
+        try:
+            self.db.close()
+        finally:
+            self.mutex.release()
+
+    def expire(self):
+        """
+        Drop any entries that are over the age limit
+        """
+
+        self.mutex.acquire()
+        try:
+            self._expire()
+            self.db.commit()
+        finally:
+            self.mutex.release()
+
+    def retry(self, entry_ids):
+        """
+        Mark some in flight entries as pending again so they will be replayed,
+        such as entries whose replies timed out
+        """
+
+        if not entry_ids:
+            return
+        self.mutex.acquire()
+        try:
+            # Entries already read ahead are still to be sent
+            reading = set(x[0] for x in self.read_ahead)
+            retried = 0
+            for entry_id in entry_ids:
+                if entry_id in reading:
+                    continue
+                retried += self.db.execute(
+                    "UPDATE publishes SET state=? WHERE id=? AND state=?",
+                    (ENTRY_PENDING, entry_id, ENTRY_IN_FLIGHT)).rowcount
+            self.db.commit()
+            self.pending += retried
+            if retried:
+                self.not_empty.notify()
+        finally:
+            self.mutex.release()
+
+    def rewind(self):
+        """
+        Mark all in flight entries as pending again so they will be replayed
+        """
+
+        self.mutex.acquire()
+        try:
+            self._rewind()
+            if self.pending:
+                self.not_empty.notify()
+        finally:
+            self.mutex.release()
+
+    # Queue storage hooks. Apart from _init these are called by Queue with the
+    # mutex held.
+
+    def _init(self, maxsize):
+        self.read_ahead = deque()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS publishes ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "created REAL NOT NULL, "
+                        "size INTEGER NOT NULL, "
+                        "state INTEGER NOT NULL, "
+                        "data TEXT NOT NULL)")
+        self.db.commit()
+        self.count, self.size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "
+            "publishes").fetchone()
+        self.pending = 0
+
+        # Anything in flight when the journal was last closed is replayed
+        self._rewind()
+
+    def _qsize(self):
+        return self.pending
+
+    def _put(self, item):
+        data = codec.dumps(defs.publish_to_dict(item))
+        self.db.execute("INSERT INTO publishes (created, size, state, data) "
+                        "VALUES (?, ?, ?, ?)", (time.time(), len(data),
+                                                ENTRY_PENDING, data))
+        self.count += 1
+        self.pending += 1
+        self.size += len(data)
+        self._expire()
+        self.db.commit()
+
+    def _get(self):
+        if not self.read_ahead:
+            rows = self.db.execute("SELECT id, data, created FROM publishes "
+                                   "WHERE state=? ORDER BY id LIMIT ?",
+                                   (ENTRY_PENDING, READ_AHEAD)).fetchall()
+            self.db.executemany("UPDATE publishes SET state=? WHERE id=?",
+                                [(ENTRY_IN_FLIGHT, x[0]) for x in rows])
+            self.db.commit()
+            self.read_ahead.extend(rows)
+        entry_id, data, created = self.read_ahead.popleft()
+        self.pending -= 1
+        pub = defs.publish_from_dict(codec.loads(data))
+        pub.journal_id = entry_id
+        self._record(defs.publish_lane(pub), created)
+        return pub
+
+    def _discard(self):
+        pub = self._get()
+        self._drop(self.db.execute("SELECT id, size, created FROM publishes "
+                                   "WHERE id=?", (pub.journal_id,)).fetchall())
+        self.db.commit()
+
+    def _rewind(self):
+        """
+        Mark all in flight entries as pending
+        """
+
+        self.read_ahead.clear()
+        self.db.execute("UPDATE publishes SET state=? WHERE state=?",
+                        (ENTRY_PENDING, ENTRY_IN_FLIGHT))
+        self.db.commit()
+        self.pending = self.db.execute(
+            "SELECT COUNT(*) FROM publishes WHERE state=?",
+            (ENTRY_PENDING,)).fetchone()[0]
+
+    def _expire(self):
+        """
+        Drop the oldest entries while over the size or age limits
+        """
+
+        dropped = 0
+        if self.max_age:
+            oldest = time.time() - self.max_age
+            while self.count:
+                rows = self._oldest()
+                expired = [x for x in rows if x[2] < oldest]
+                dropped += self._drop(expired)
+                if len(expired) < len(rows):
+                    break
+        while self.max_bytes and self.size > self.max_bytes and self.count > 1:
+            over = []
+            freed = 0
+            for row in self._oldest():
+                if (self.size - freed <= self.max_bytes or
+                        self.count - len(over) <= 1):
+                    break
+                over.append(row)
+                freed += row[1]
+            dropped += self._drop(over)
+        self.dropped += dropped
+
+    def _oldest(self):
+        """
+        Read the (id, size, created) of the oldest entries
+        """
+
+        return self.db.execute("SELECT id, size, created FROM publishes "
+                               "ORDER BY id LIMIT ?", (READ_AHEAD,)).fetchall()
+
+    def _drop(self, rows):
+        """
+        Delete entries from the journal. Returns the number deleted.
+        """
+
+        if not rows:
+            return 0
+        ids = set()
+        for row in rows:
+            self.db.execute("DELETE FROM publishes WHERE id=?", (row[0],))
+            self.count -= 1
+            self.size -= row[1]
+            ids.add(row[0])
+
+        # Entries already read ahead may have been dropped
+        self.read_ahead = deque(x for x in self.read_ahead if x[0] not in ids)
+        self.pending = self.db.execute(
+            "SELECT COUNT(*) FROM publishes WHERE state=?",
+            (ENTRY_PENDING,)).fetchone()[0] + len(self.read_ahead)
+        return len(rows)
@@ -0,0 +1,175 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the TLS context shared by the MQTT connection and HTTPS
+file transfers, which resumes TLS sessions and times handshakes
+"""
+
+import ssl
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from device_cloud._core import defs
+
+# Sessions can only be resumed on Python 3.6 and newer
+SESSIONS = hasattr(ssl.SSLSocket, "session")
+
+
+class TLSSocket(ssl.SSLSocket):
+    """
+    SSL socket that reports its handshakes to the context that created it.
+    Used on Python 3.7 and newer.
+    """
+
+    def do_handshake(self, *args, **kwargs):
+        start = time.time()
+        super(TLSSocket, self).do_handshake(*args, **kwargs)
+        if isinstance(self.context, TLSContext):
+            self.context.handshake_done(self, time.time() - start)
+
+
+class TLSContext(ssl.SSLContext):
+    """
+    SSL context that keeps the last TLS session with each server, and
+    resumes it on the next connection to skip a full handshake. Counts
+    handshakes and how many resumed a session, and how long they took.
+    """
+
+    sslsocket_class = TLSSocket
+
+    def __init__(self, protocol):
+        if "__init__" in vars(ssl.SSLContext):
+            # Python 3.5 and older take the protocol in __init__ as well
+            super(TLSContext, self).__init__(protocol)
+        else:
+            super(TLSContext, self).__init__()
+        self.sessions = {}
+        self.session_lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_times = defs.Histogram()
+
+    def handshake_done(self, sock, seconds):
+        """
+        Record a finished handshake, and keep its session for the next
+        connection to the same server
+        """
+
+        self.session_lock.acquire()
+        try:
+            self.handshakes += 1
+            if SESSIONS and sock.session_reused:
+                self.resumed += 1
+            self.handshake_times.add(seconds)
+        finally:
+            self.session_lock.release()
+        self.save_session(sock)
+
+    def save_session(self, sock):
+        """
+        Keep the session of a connected socket. TLS 1.3 servers only send
+        session tickets after the handshake, so this is also called once the
+        first reply is received.
+        """
+
+        hostname = getattr(sock, "server_hostname", None)
+        session = getattr(sock, "session", None)
+        if hostname and session is not None:
+            self.session_lock.acquire()
+            try:
+                self.sessions[hostname] = session
+            finally:
+                self.session_lock.release()
+
+    def stats(self):
+        """
+        Get the number of handshakes, how many resumed a session, and how
+        long they took in seconds
+        """
+
+        self.session_lock.acquire()
+        try:
+            return {"handshakes":self.handshakes,
+                    "resumed":self.resumed,
+                    "handshake_time":self.handshake_times.summary()}
+        finally:
+            self.session_lock.release()
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        hostname = kwargs.get("server_hostname")
+        if (SESSIONS and hostname and kwargs.get("session") is None and
+                not kwargs.get("server_side")):
+            session = self.sessions.get(hostname)
+            if session is not None:
+                kwargs["session"] = session
+        return super(TLSContext, self).wrap_socket(sock, *args, **kwargs)
+
+
+class TLSAdapter(HTTPAdapter):
+    """
+    HTTPS transport for requests that uses a shared TLSContext, which already
+    has the certificate bundle loaded, instead of loading the bundle for each
+    new connection. Keeps up to pool_maxsize connections open to each host
+    for reuse.
+    """
+
+    def __init__(self, context, **kwargs):
+        self.context = context
+        super(TLSAdapter, self).__init__(**kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super(TLSAdapter, self).cert_verify(conn, url, verify, cert)
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.context
+        return super(TLSAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def stats(self):
+        """
+        Get the number of HTTP requests sent, the number of connections
+        opened for them, and how many requests reused an open connection
+        """
+
+        requests = 0
+        connections = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests += pool.num_requests
+                connections += pool.num_connections
+        return {"requests":requests,
+                "connections":connections,
+                "reused":max(requests - connections, 0)}
+
+
+def create_context(ca_bundle_file=None):
+    """
+    Create a TLS context that verifies servers with a certificate bundle, or
+    does not verify them if no bundle is given
+    """
+
+    context = TLSContext(ssl.PROTOCOL_TLSv1_2)
+    if ca_bundle_file:
+        context.load_verify_locations(cafile=ca_bundle_file)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
@@ -16,8 +16,7 @@ This module contains functions for generating TR50 messages relevent to the
 Client application
 """
 
-import json
-
+from device_cloud._core import codec
 from device_cloud._core import constants
 
 
@@ -67,6 +66,112 @@ class TR50Command(object):
     thing_find = "thing.find"
 
 
+class CommandTemplate(object):
+    """
+    Precompiled encoder for one type of TR50 command. Encodes a command straight
+    to JSON, exactly as the command created by the matching create_* function
+    would be encoded, without building the command first. The encoded values of
+    the first cached parameters (such as the thing key and property key) are
+    kept so they are only encoded once. With a fast JSON backend the command is
+    built as a single dict and encoded by the backend instead.
+    """
+
+    # Number of encoded leading parameters kept
+    CACHE_SIZE = 1024
+
+    def __init__(self, command, params, cached=0):
+        self.command = command
+        self.params = params
+        self.prefix = "{\"command\":" + codec.dumps(command) + ",\"params\":{"
+        self.keys = [codec.dumps(x) + ":" for x in params]
+        self.cached = cached
+        self.heads = {}
+
+    def encode(self, *values):
+        """
+        Encode a command from the values of its parameters, in order. None
+        values are left out.
+        """
+
+        # Fast JSON backends encode a single flat dict quicker than the values
+        # can be joined here
+        if codec.name != "json":
+            return codec.dumps({"command":self.command,
+                                "params":{key:value for key, value in
+                                          zip(self.params, values)
+                                          if value is not None}})
+
+        cached = self.cached
+        head_values = values[:cached]
+        head = self.heads.get(head_values)
+        if head is None:
+            head = self._items(self.keys[:cached], head_values)
+            if len(self.heads) >= self.CACHE_SIZE:
+                self.heads.clear()
+            self.heads[head_values] = head
+        items = self._items(self.keys[cached:], values[cached:])
+        if head and items:
+            return self.prefix + head + "," + items + "}}"
+        return self.prefix + head + items + "}}"
+
+    @staticmethod
+    def _items(keys, values):
+        """
+        Encode the parameters that have values
+        """
+
+        dumps_value = codec.dumps_value
+        return ",".join([key + dumps_value(value) for key, value in
+                         zip(keys, values) if value is not None])
+
+
+class RequestEncoder(object):
+    """
+    Builds a TR50 request string one command at a time
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 2
+
+    def __len__(self):
+        return len(self.parts)
+
+    def add(self, command):
+        """
+        Add a command, or a command that is already encoded. Returns the number
+        of characters it added to the request.
+        """
+
+        if isinstance(command, dict):
+            command = _encode_command(command)
+        part = "\"" + str(len(self.parts) + 1) + "\":" + command
+        size = len(part) + (1 if self.parts else 0)
+        self.parts.append(part)
+        self.size += size
+        return size
+
+    def getvalue(self):
+        """
+        Get the request string
+        """
+
+        return "{" + ",".join(self.parts) + "}"
+
+
+# Templates for commands that are published at high rates
+ALARM_PUBLISH = CommandTemplate(TR50Command.alarm_publish,
+                                ("thingKey", "key", "state", "msg", "ts",
+                                 "corrId", "lat", "lng", "republish"),
+                                cached=2)
+ATTRIBUTE_PUBLISH = CommandTemplate(TR50Command.attribute_publish,
+                                    ("thingKey", "key", "value", "ts",
+                                     "republish"), cached=2)
+PROPERTY_PUBLISH = CommandTemplate(TR50Command.property_publish,
+                                   ("thingKey", "key", "value", "ts", "corrId",
+                                    "aggregate"), cached=2)
+
+
 def _generate_params(kwargs):
     """
     Generate JSON based on the arguments passed to this function
@@ -313,23 +418,95 @@ def create_thing_find(key):
     cmd["params"] = _generate_params(kwargs)
     return cmd
 
-def generate_request(commands):
+def encode_alarm_publish(thing_key, key, state, message=None, timestamp=None,
+                         corr_id=None, latitude=None, longitude=None,
+                         republish=None):
+    """
+    Encode the JSON for an alarm publish, the same as create_alarm_publish
+    """
+
+    return ALARM_PUBLISH.encode(thing_key, key, state, message, timestamp,
+                                corr_id, latitude, longitude, republish)
+
+def encode_attribute_publish(thing_key, key, value, timestamp=None,
+                             republish=None):
+    """
+    Encode the JSON for a string value publish, the same as
+    create_attribute_publish
+    """
+
+    return ATTRIBUTE_PUBLISH.encode(thing_key, key, value, timestamp,
+                                    republish)
+
+def encode_property_publish(thing_key, key, value, timestamp=None, corr_id=None,
+                            aggregate=None):
     """
-    Generate a final TR50 request string out of multiple commands
+    Encode the JSON for a numeric value publish, the same as
+    create_property_publish
     """
 
-    request = {}
+    return PROPERTY_PUBLISH.encode(thing_key, key, value, timestamp, corr_id,
+                                   aggregate)
+
+def _encode_command(command):
+    """
+    Encode a single TR50 command as compact JSON
+    """
+
+    return codec.dumps(command)
+
+def generate_request(commands):
+    """
+    Generate a final TR50 request string out of multiple commands. Commands
+    can be already encoded by the encode_* functions.
+    """
 
     # Ensure we are working with a list
     command_list = commands
     if commands.__class__.__name__ != "list":
         command_list = [commands]
 
-    # Add each command to the request
-    for num, val in enumerate(command_list):
-        request[str(num+1)] = val
+    request = RequestEncoder()
+    for command in command_list:
+        request.add(command)
+    return request.getvalue()
+
+def generate_requests(commands, max_commands=0, max_bytes=0):
+    """
+    Generate as few TR50 request strings as possible out of multiple commands
+    without any request holding more than max_commands commands or being
+    larger than max_bytes bytes. A limit of 0 means no limit. A single command
+    that is larger than max_bytes on its own is sent in a request by itself.
+    Returns a list of (start, end, request) tuples where start and end index
+    the commands carried by each request. Commands can be already encoded by
+    the encode_* functions.
+    """
+
+    batches = []
+    request = RequestEncoder()
+    start = 0
+    for num, command in enumerate(commands):
+        if isinstance(command, dict):
+            command = _encode_command(command)
+
+        # Size of '"N":value' plus a separating comma if not the first
+        value_size = len(command) + len(str(num-start+1)) + 3
+        if request:
+            value_size += 1
+
+        if request and ((max_commands and len(request) >= max_commands) or
+                        (max_bytes and request.size + value_size > max_bytes)):
+            # Request is full, start a new one with this command
+            batches.append((start, num, request.getvalue()))
+            request = RequestEncoder()
+            start = num
+
+        request.add(command)
+
+    if request:
+        batches.append((start, len(commands), request.getvalue()))
 
-    return json.dumps(request, separators=(",", ":"))
+    return batches
 
 def translate_error_code(error_code):
     """
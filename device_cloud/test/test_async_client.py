@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Tests for the asyncio AsyncClient. They use async/await syntax, so they are
+in their own module that is only collected on Python 3.5 and newer.
+"""
+
+import asyncio
+import json
+import socket
+import unittest
+
+import mock
+
+import device_cloud
+import device_cloud.test.test_helpers as helpers
+
+builtin = "builtins"
+
+
+class AsyncClientLoop(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        self.client = device_cloud.AsyncClient("testing-client",
+                                               {"validate_cloud_cert":False})
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        defs = device_cloud._core.defs
+
+        def reply(payload):
+            message = mock.Mock()
+            message.topic = "reply/" + mqtt.publish.call_args[0][0][4:]
+            message.payload = json.dumps({"1":payload}).encode()
+            handler.on_message(mqtt, None, message)
+
+        async def action(client, params):
+            await asyncio.sleep(0)
+            return (device_cloud.STATUS_SUCCESS, "done")
+
+        async def scenario():
+            # Connecting waits for the connection to be acknowledged
+            connecting = asyncio.ensure_future(self.client.connect(timeout=5))
+            while handler.connection is None:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+            assert not connecting.done()
+            handler.on_connect(mqtt, None, None, 0)
+            assert await connecting == device_cloud.STATUS_SUCCESS
+            assert handler.main_thread is None
+            assert handler.worker_threads == []
+
+            # Publishes are flushed by a task on the loop
+            assert await self.client.telemetry_publish("property_key", 1.5) \
+                == device_cloud.STATUS_SUCCESS
+            for _ in range(100):
+                if mqtt.publish.called:
+                    break
+                await asyncio.sleep(0.01)
+            jload = json.loads(mqtt.publish.call_args[0][1])
+            assert jload["1"]["command"] == "property.publish"
+
+            # Coroutine action callbacks are awaited on the loop
+            self.client.action_register_callback("async_action", action)
+            handler.queue_work(defs.Work(device_cloud._core.constants.WORK_ACTION,
+                                         defs.ActionRequest("mail", "async_action",
+                                                            {})))
+            for _ in range(100):
+                if "mailbox.ack" in mqtt.publish.call_args[0][1]:
+                    break
+                await asyncio.sleep(0.01)
+            jload = json.loads(mqtt.publish.call_args[0][1])
+            assert jload["1"]["command"] == "mailbox.ack"
+            assert jload["1"]["params"]["errorMessage"] == "done"
+            reply({"success":True})
+
+            # File transfers finish as soon as their reply is handled
+            download = asyncio.ensure_future(self.client.file_download(
+                "file.txt", "/tmp/file.txt", timeout=5))
+            await asyncio.sleep(0.01)
+            assert not download.done()
+            reply({"success":False, "errorCodes":[-90008]})
+            assert await download == device_cloud.STATUS_NOT_FOUND
+
+            # The MQTT socket is read when it is readable
+            reader, writer = socket.socketpair()
+            handler.on_socket_open(mqtt, None, reader)
+            writer.send(b"x")
+            for _ in range(100):
+                if mqtt.loop_read.called:
+                    break
+                await asyncio.sleep(0.01)
+            mqtt.loop_read.assert_called()
+            handler.on_socket_close(mqtt, None, reader)
+            reader.close()
+            writer.close()
+
+            assert await self.client.disconnect() == device_cloud.STATUS_SUCCESS
+            assert not self.client.is_alive()
+            assert handler.tasks == []
+
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(scenario())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
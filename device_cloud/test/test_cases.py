@@ -13,6 +13,8 @@
     OR CONDITIONS OF ANY KIND, either express or implied.
 '''
 
+import array
+import certifi
 import json
 import os
 import unittest
@@ -20,9 +22,14 @@ from binascii import crc32
 import mock
 import platform
 import re
+import shutil
 import socket
 import ssl
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 # yocto supports websockets, not websocket, so check for that
 try:
@@ -30,6 +37,18 @@ try:
 except ImportError:
     import websockets as websocket
 
+if sys.version_info.major == 2:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+else:
+    import queue
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import tzinfo
 from time import sleep
 
 import device_cloud
@@ -262,8 +281,7 @@ class ClientAlarmPublish(unittest.TestCase):
         assert pub.name == "alarm_key"
         assert pub.state == 5
         assert pub.message == "alarm message"
-        work = self.client.handler.work_queue.get()
-        assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        assert self.client.handler.work_queue.empty()
 
     def setUp(self):
         # Configuration to be 'read' from config file
@@ -301,7 +319,7 @@ class ClientAttributePublish(unittest.TestCase):
         self.config_args = helpers.config_file_default()
 
 class ClientConnectFailure(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
@@ -342,7 +360,7 @@ class ClientConnectFailure(unittest.TestCase):
             self.client.handler.main_thread.join()
 
 class ClientConnectSuccess(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
@@ -384,7 +402,7 @@ class ClientConnectSuccess(unittest.TestCase):
             self.client.handler.main_thread.join()
 
 class ClientDisconnectFailure(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
@@ -458,7 +476,7 @@ class ClientEventPublish(unittest.TestCase):
         self.config_args = helpers.config_file_default()
 
 class ClientFileDownloadAsyncSuccess(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch(builtin + ".open")
     @mock.patch("os.rename")
     @mock.patch("os.path.isdir")
@@ -466,7 +484,7 @@ class ClientFileDownloadAsyncSuccess(unittest.TestCase):
     @mock.patch("os.path.exists")
     @mock.patch("time.sleep")
     @mock.patch("paho.mqtt.client.Client")
-    @mock.patch("requests.get")
+    @mock.patch("requests.Session.get")
     def runTest(self, mock_get, mock_mqtt, mock_sleep, mock_exists,
                 mock_isfile, mock_isdir, mock_rename, mock_open, mock_context):
         # Set up mocks
@@ -551,13 +569,13 @@ class ClientFileDownloadAsyncSuccess(unittest.TestCase):
             self.client.handler.main_thread.join()
 
 class ClientFileUploadAsyncSuccess(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
     @mock.patch("time.sleep")
     @mock.patch("paho.mqtt.client.Client")
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def runTest(self, mock_post, mock_mqtt, mock_sleep, mock_exists,
                 mock_isfile, mock_open, mock_context):
         # Set up mocks
@@ -617,7 +635,9 @@ class ClientFileUploadAsyncSuccess(unittest.TestCase):
 
         # Check to see what has been uploaded
         assert post_kwargs["url"] == "https://api.notarealcloudhost.com/file/123456789"
-        assert post_kwargs["verify"] == "/top/secret/location"
+        assert post_kwargs["verify"] is True
+        mock_context.return_value.load_verify_locations.assert_called_once_with(
+            cafile="/top/secret/location")
         assert post_kwargs["data"] is mock_open.return_value.__enter__.return_value
         args = upload_callback.call_args_list[0][0]
         assert args[0] is self.client
@@ -1062,7 +1082,7 @@ class ConfigWriteReadDeviceID(unittest.TestCase):
         self.config_args = helpers.config_file_default()
 
 class HandleActionExecCallbackSuccess(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
@@ -1172,7 +1192,7 @@ class HandleActionExecCallbackSuccess(unittest.TestCase):
             self.client.handler.main_thread.join()
 
 class HandlePublishAllTypes(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
@@ -2136,7 +2156,7 @@ class RelayLoopLocalReadError(unittest.TestCase):
         assert self.relay.lsock == None
 
 class ClientFileDownloadAsyncChecksumFail(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch("os.remove")
     @mock.patch(builtin + ".open")
     @mock.patch("os.rename")
@@ -2145,7 +2165,7 @@ class ClientFileDownloadAsyncChecksumFail(unittest.TestCase):
     @mock.patch("os.path.exists")
     @mock.patch("time.sleep")
     @mock.patch("paho.mqtt.client.Client")
-    @mock.patch("requests.get")
+    @mock.patch("requests.Session.get")
     def runTest(self, mock_get, mock_mqtt, mock_sleep, mock_exists,
                 mock_isfile, mock_isdir, mock_rename, mock_open, mock_remove,
                 mock_context):
@@ -2227,7 +2247,7 @@ class ClientFileDownloadAsyncChecksumFail(unittest.TestCase):
             self.client.handler.main_thread.join()
 
 class ClientFileDownloadAsyncRequestFail(unittest.TestCase):
-    @mock.patch("ssl.SSLContext")
+    @mock.patch("device_cloud._core.tls.TLSContext")
     @mock.patch("os.remove")
     @mock.patch(builtin + ".open")
     @mock.patch("os.rename")
@@ -2236,7 +2256,7 @@ class ClientFileDownloadAsyncRequestFail(unittest.TestCase):
     @mock.patch("os.path.exists")
     @mock.patch("time.sleep")
     @mock.patch("paho.mqtt.client.Client")
-    @mock.patch("requests.get")
+    @mock.patch("requests.Session.get")
     def runTest(self, mock_get, mock_mqtt, mock_sleep, mock_exists,
                 mock_isfile, mock_isdir, mock_rename, mock_open, mock_remove,
                 mock_context):
@@ -2383,3 +2403,1937 @@ class ClientConnectMissingPort(unittest.TestCase):
     def setUp(self):
         # Configuration to be 'read' from config file
         self.config_args = helpers.config_file_default()
+
+class HandlePublishBatches(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client, allowing only 4 commands per request
+        kwargs = {"publish_max_commands":4}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+
+        # Queue and flush 10 publishes
+        for num in range(10):
+            self.client.telemetry_publish("property_key", num)
+        assert self.client.handler.handle_publish() == device_cloud.STATUS_SUCCESS
+
+        # Published over three topics, in order
+        assert mqtt.publish.call_count == 3
+        topics = [x[0][0] for x in mqtt.publish.call_args_list]
+        assert topics == ["api/0001", "api/0002", "api/0003"]
+        values = []
+        for call in mqtt.publish.call_args_list:
+            jload = json.loads(call[0][1])
+            assert len(jload) <= 4
+            for num in range(len(jload)):
+                values.append(jload[str(num+1)]["params"]["value"])
+        assert values == list(range(10))
+        assert len(self.client.handler.reply_tracker) == 10
+
+        # Flush is reported
+        stats = self.client.handler.publish_stats
+        assert stats["flushes"] == 1
+        assert stats["commands"] == 10
+        assert stats["batches"] == 3
+        assert stats["bytes"] == sum(len(x[0][1]) for x in
+                                     mqtt.publish.call_args_list)
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class TR50GenerateRequests(unittest.TestCase):
+    def runTest(self):
+        tr50 = device_cloud._core.tr50
+        commands = [tr50.create_property_publish("thing", "key", x)
+                    for x in range(20)]
+
+        # No limits, same as a single request
+        batches = tr50.generate_requests(commands)
+        assert len(batches) == 1
+        assert batches[0] == (0, 20, tr50.generate_request(commands))
+
+        # Byte limit is respected, and each request is a valid TR50 request
+        single = len(tr50.generate_request(commands[:1]))
+        batches = tr50.generate_requests(commands, max_bytes=single * 3)
+        assert len(batches) > 1
+        assert batches[0][0] == 0
+        assert batches[-1][1] == 20
+        for start, end, request in batches:
+            assert len(request) <= single * 3
+            assert request == tr50.generate_request(commands[start:end])
+
+        # Command limit is respected
+        batches = tr50.generate_requests(commands, max_commands=7)
+        assert [(x[0], x[1]) for x in batches] == [(0, 7), (7, 14), (14, 20)]
+
+        # A command bigger than the limit is sent on its own
+        batches = tr50.generate_requests(commands[:3], max_bytes=10)
+        assert [(x[0], x[1]) for x in batches] == [(0, 1), (1, 2), (2, 3)]
+
+class HandlePublishCoalesce(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client, coalescing "attribute_key" from configuration
+        kwargs = {"publish_coalesce":{"attribute_key":1}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+        assert self.client.publish_coalesce("property_key", 2) == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.publish_coalesce("other_key", 0) == \
+            device_cloud.STATUS_BAD_PARAMETER
+
+        # Queue a burst of values, alarms and events
+        for num in range(5):
+            self.client.telemetry_publish("property_key", num)
+            self.client.telemetry_publish("other_key", num)
+            self.client.attribute_publish("attribute_key", str(num))
+            self.client.handler.queue_publish(
+                device_cloud._core.defs.PublishAlarm("alarm_key", num))
+            self.client.event_publish("event {}".format(num))
+        self.client.handler.handle_publish()
+
+        # Only the newest coalesced values were sent, everything else in full
+        sent = {}
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        for num in range(len(jload)):
+            params = jload[str(num+1)]["params"]
+            key = params.get("key", "log")
+            sent.setdefault(key, []).append(params.get("value",
+                                                       params.get("state")))
+        assert sent["property_key"] == [3, 4]
+        assert sent["other_key"] == [0, 1, 2, 3, 4]
+        assert sent["attribute_key"] == ["4"]
+        assert sent["alarm_key"] == [0, 1, 2, 3, 4]
+        assert len(sent["log"]) == 5
+        assert self.client.handler.publish_stats["coalesced"] == 7
+
+        # Coalescing is changed with the handler's lock held
+        handler = self.client.handler
+        handler.lock.acquire()
+        try:
+            thread = threading.Thread(target=self.client.publish_coalesce,
+                                      args=("property_key", None))
+            thread.start()
+            thread.join(0.1)
+            assert thread.is_alive()
+            assert handler.coalescer.depth("property_key") == 2
+        finally:
+            handler.lock.release()
+        thread.join()
+        assert handler.coalescer.depth("property_key") is None
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryAggregate(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+        assert self.client.telemetry_aggregate("property_key", 0) == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.telemetry_aggregate("property_key", 10,
+                                               ["median"]) == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.telemetry_aggregate("property_key", 10) == \
+            device_cloud.STATUS_SUCCESS
+
+        # Samples in one window are buffered, not queued
+        start = datetime(2017, 1, 1, 0, 0, 10)
+        for num in range(5):
+            self.client.telemetry_publish("property_key", num + 1,
+                                          start + timedelta(seconds=num))
+        self.client.telemetry_publish("other_key", 2)
+        assert handler.publish_queue.qsize() == 1
+
+        # A sample for the next window closes the first one
+        self.client.telemetry_publish("property_key", 100,
+                                      start + timedelta(seconds=10))
+        stats = {}
+        for pub in handler.aggregator.expire(now=0):
+            assert device_cloud._core.defs.format_timestamp(
+                pub.timestamp, handler.clock) == "2017-01-01T00:00:10.000000Z"
+            stats[pub.name] = pub.value
+        assert stats == {"property_key.min":1, "property_key.max":5,
+                         "property_key.mean":3.0, "property_key.count":5,
+                         "property_key.last":5}
+
+        # Removing aggregation publishes the open window
+        assert self.client.telemetry_aggregate("property_key", None) == \
+            device_cloud.STATUS_SUCCESS
+        assert handler.publish_queue.qsize() == 6
+        assert self.client.telemetry_aggregate("property_key", None) == \
+            device_cloud.STATUS_NOT_FOUND
+
+        # Values that are not numbers are published instead of aggregated
+        while not handler.publish_queue.empty():
+            handler.publish_queue.get()
+        assert self.client.telemetry_aggregate("property_key", 10) == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", "high") == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", None) == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish_many("property_key",
+                                                  [101, "low", 102],
+                                                  [start] * 3) == \
+            device_cloud.STATUS_SUCCESS
+        assert handler.publish_queue.qsize() == 3
+        assert handler.publish_queue.get().value == "high"
+        assert handler.publish_queue.get().value is None
+        assert handler.publish_queue.get().values == ["low"]
+        stats = dict((pub.name, pub.value) for pub in
+                     handler.aggregator.expire(force=True))
+        assert stats["property_key.count"] == 2
+        assert stats["property_key.mean"] == 101.5
+
+        # Samples without a time are windowed by the handler's clock, which
+        # can follow the Cloud's
+        while not handler.publish_queue.empty():
+            handler.publish_queue.get()
+        handler.clock.offset = -3600.0
+        self.client.telemetry_publish("property_key", 1)
+        self.client.telemetry_publish_many("property_key", [2, 3])
+        handler.publish_aggregates()
+        assert handler.publish_queue.empty()
+        handler.state = device_cloud._core.constants.STATE_CONNECTED
+        assert 0 < handler.loop_timeout() <= 10
+        handler.publish_aggregates(force=True)
+        now = time.time() - 3600.0
+        while not handler.publish_queue.empty():
+            pub = handler.publish_queue.get()
+            assert now - 10 <= pub.timestamp <= now
+            if pub.name == "property_key.count":
+                assert pub.value == 3
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryPublishMany(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Mismatched samples are rejected
+        assert self.client.telemetry_publish_many("property_key", [1, 2],
+                                                  [0]) == \
+            device_cloud.STATUS_BAD_PARAMETER
+
+        # Arrays of values and epoch timestamps are queued as one publish
+        values = array.array("d", [1.5, 2.5, 3.5])
+        timestamps = [1483228800, 1483228801.25, 1483228802]
+        assert self.client.telemetry_publish_many("property_key", values,
+                                                  timestamps) == \
+            device_cloud.STATUS_SUCCESS
+        assert handler.publish_queue.qsize() == 1
+        handler.handle_publish()
+
+        # Each sample becomes its own property publish
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert len(jload) == 3
+        assert [jload[str(x+1)]["params"]["value"] for x in range(3)] == \
+            [1.5, 2.5, 3.5]
+        assert jload["2"]["command"] == "property.publish"
+        assert jload["2"]["params"]["key"] == "property_key"
+        assert jload["2"]["params"]["ts"] == "2017-01-01T00:00:01.250000Z"
+        assert len(handler.reply_tracker) == 3
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryDeadband(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client, with a percent band for all properties
+        kwargs = {"telemetry_deadband":{"*":{"percent":10}}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        assert self.client.telemetry_deadband("abs_key", absolute=-1) == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.telemetry_deadband("abs_key", absolute=0.5,
+                                              heartbeat=60) == \
+            device_cloud.STATUS_SUCCESS
+
+        # Only values outside the band, or after the heartbeat, are queued
+        start = datetime(2017, 1, 1)
+        samples = [(0, 10.0), (1, 10.2), (2, 10.6), (3, 10.0), (70, 10.1)]
+        for seconds, value in samples:
+            self.client.telemetry_publish("abs_key", value,
+                                          start + timedelta(seconds=seconds))
+        for value in [100, 105, 111, 101, 89]:
+            self.client.telemetry_publish("pct_key", value)
+        queued = []
+        while not handler.publish_queue.empty():
+            pub = handler.publish_queue.get()
+            queued.append((pub.name, pub.value))
+        assert queued == [("abs_key", 10.0), ("abs_key", 10.6),
+                          ("abs_key", 10.0), ("abs_key", 10.1),
+                          ("pct_key", 100), ("pct_key", 111),
+                          ("pct_key", 89)]
+        assert handler.deadband.dropped == 3
+
+        # Bulk samples are filtered the same way
+        self.client.telemetry_publish_many("pct_key", [90, 95, 120])
+        pub = handler.publish_queue.get()
+        assert pub.values == [120]
+
+        # Filters can be removed
+        assert self.client.telemetry_deadband("abs_key") == \
+            device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_deadband("abs_key") == \
+            device_cloud.STATUS_NOT_FOUND
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishJournal(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a publish journal
+        kwargs = {"publish_journal":self.journal_path}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Publishes stay in the journal while disconnected
+        self.client.telemetry_publish("property_key", 1.5)
+        self.client.attribute_publish("attribute_key", "value")
+        self.client.event_publish("event")
+        handler.handle_publish()
+        mqtt.publish.assert_not_called()
+        assert handler.publish_queue.qsize() == 3
+
+        # Sent once connected, but kept until replied to
+        handler.on_connect(mqtt, None, None, 0)
+        handler.handle_publish()
+        assert mqtt.publish.call_count == 1
+        assert handler.publish_queue.qsize() == 0
+        assert len(handler.journal) == 3
+        reply = {"1":{"success":True}, "2":{"success":True}}
+        handler.handle_message(device_cloud._core.defs.Message("reply/0001",
+                                                               reply))
+        assert len(handler.journal) == 1
+
+        # Unreplied publishes are replayed when the journal is opened again
+        handler.journal.close()
+        journal = device_cloud._core.journal.PublishJournal(self.journal_path)
+        assert journal.qsize() == 1
+        pub = journal.get()
+        assert pub.type == "PublishLog"
+        assert pub.message == "event"
+        journal.close()
+
+        # Oldest entries are dropped to stay under the size limit
+        journal = device_cloud._core.journal.PublishJournal(self.journal_path,
+                                                            max_bytes=400)
+        for num in range(10):
+            journal.put(device_cloud._core.defs.PublishTelemetry("key", num))
+        assert journal.size <= 400
+        assert journal.dropped > 0
+        values = [journal.get().value for _ in range(journal.qsize())]
+        assert values == list(range(10 - len(values), 10))
+        journal.close()
+
+        # Bulk samples timed with datetimes are journaled as seconds, and sent
+        # in the Cloud's time format when replayed
+        codec = device_cloud._core.codec
+        timestamps = [datetime(2017, 1, 1),
+                      datetime(2017, 1, 1, 0, 0, 1, 500000)]
+        try:
+            for backend in codec.available():
+                codec.use(backend)
+                path = os.path.join(self.journal_dir, backend + ".db")
+                journal = device_cloud._core.journal.PublishJournal(path)
+                journal.put(device_cloud._core.defs.PublishTelemetryBulk(
+                    "key", [1, 2], timestamps))
+                journal.close()
+                journal = device_cloud._core.journal.PublishJournal(path)
+                pub = journal.get()
+                journal.close()
+                assert list(pub.samples(
+                    device_cloud._core.defs.Clock())) == [
+                    (1, "2017-01-01T00:00:00.000000Z"),
+                    (2, "2017-01-01T00:00:01.500000Z")]
+        finally:
+            codec.use()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.journal_dir, "journal.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+class HandlePublishQueuePolicies(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with room for two publishes
+        kwargs = {"publish_queue_size":2, "publish_queue_timeout":0.01}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        def queued():
+            values = []
+            while not handler.publish_queue.empty():
+                values.append(handler.publish_queue.get().value)
+            return values
+
+        # Default policy refuses new publishes
+        for num in range(3):
+            status = self.client.telemetry_publish("property_key", num)
+        assert status == device_cloud.STATUS_FULL
+        assert handler.publish_queue.rejected == 1
+        assert queued() == [0, 1]
+
+        # Drop the oldest to make room
+        handler.queue_policy = device_cloud.QUEUE_POLICY_DROP_OLDEST
+        for num in range(4):
+            assert self.client.telemetry_publish("property_key", num) == \
+                device_cloud.STATUS_SUCCESS
+        assert handler.publish_queue.dropped == 2
+        assert queued() == [2, 3]
+
+        # Drop the newest silently
+        handler.queue_policy = device_cloud.QUEUE_POLICY_DROP_NEWEST
+        for num in range(4):
+            assert self.client.telemetry_publish("property_key", num) == \
+                device_cloud.STATUS_SUCCESS
+        assert handler.publish_queue.dropped == 4
+        assert queued() == [0, 1]
+
+        # Block until the timeout
+        handler.queue_policy = device_cloud.QUEUE_POLICY_BLOCK
+        for num in range(3):
+            status = self.client.telemetry_publish("property_key", num)
+        assert status == device_cloud.STATUS_TIMED_OUT
+        assert handler.publish_queue.rejected == 2
+        assert queued() == [0, 1]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class LaneQueuePriority(unittest.TestCase):
+    def runTest(self):
+        # Even numbers are priority, odd numbers are bulk
+        lane = lambda x: (device_cloud._core.constants.LANE_PRIORITY
+                          if x % 2 == 0 else
+                          device_cloud._core.constants.LANE_BULK)
+        lane_queue = device_cloud._core.defs.LaneQueue(lane=lane, burst=3)
+        for num in range(20):
+            lane_queue.put(num)
+        order = []
+        while not lane_queue.empty():
+            order.append(lane_queue.get())
+
+        # Priority items first, with one bulk item after every three
+        assert order[:8] == [0, 2, 4, 1, 6, 8, 10, 3]
+        assert sorted(order) == list(range(20))
+        stats = lane_queue.latency_stats()
+        assert stats["priority"]["count"] == 10
+        assert stats["bulk"]["count"] == 10
+
+class HandlePublishPriority(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a small, full publish queue
+        kwargs = {"publish_queue_size":3,
+                  "publish_queue_policy":"drop_oldest"}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        for num in range(3):
+            self.client.telemetry_publish("property_key", num)
+
+        # The alarm makes room by dropping telemetry, and is sent first
+        self.client.handler.queue_publish(
+            device_cloud._core.defs.PublishAlarm("alarm_key", 1))
+        self.client.handler.handle_publish()
+        jload = json.loads(mqtt.publish.call_args_list[0][0][1])
+        assert jload["1"]["command"] == "alarm.publish"
+        assert [jload[x]["params"]["value"] for x in ("2", "3")] == [1, 2]
+        assert handler.latency_stats()["publish"]["priority"]["count"] == 1
+
+        # Actions are handled before file transfers
+        download = device_cloud._core.defs.Work(
+            device_cloud._core.constants.WORK_DOWNLOAD, None)
+        action = device_cloud._core.defs.Work(
+            device_cloud._core.constants.WORK_ACTION, None)
+        handler.queue_work(download)
+        handler.queue_work(action)
+        assert handler.work_queue.get() is action
+        assert handler.work_queue.get() is download
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishLinger(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a long linger time, cut short by max_batch
+        kwargs = {"linger_ms":60000, "max_batch":3}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        handler.to_quit = False
+        handler.publish_thread = threading.Thread(target=handler.publish_loop)
+        handler.publish_thread.start()
+
+        def wait_for_publishes(count):
+            for _ in range(50):
+                if mqtt.publish.call_count >= count:
+                    break
+                sleep(0.02)
+            return mqtt.publish.call_count
+
+        try:
+            # Lingers while the batch is small
+            self.client.telemetry_publish("property_key", 1)
+            self.client.telemetry_publish("property_key", 2)
+            sleep(0.2)
+            assert mqtt.publish.call_count == 0
+
+            # A full batch is flushed straight away, in one request
+            self.client.telemetry_publish("property_key", 3)
+            assert wait_for_publishes(1) == 1
+            assert len(json.loads(mqtt.publish.call_args[0][1])) == 3
+
+            # Only one flush runs at a time
+            handler.flush_lock.acquire()
+            for num in range(4, 7):
+                self.client.telemetry_publish("property_key", num)
+            sleep(0.2)
+            assert handler.flushing()
+            assert mqtt.publish.call_count == 1
+            handler.flush_lock.release()
+            assert wait_for_publishes(2) == 2
+            assert len(json.loads(mqtt.publish.call_args[0][1])) == 3
+            assert handler.work_queue.empty()
+        finally:
+            handler.to_quit = True
+            handler.flush_wake()
+            handler.publish_thread.join()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleSendLazyLogging(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+        defs = device_cloud._core.defs
+
+        # Descriptions and commands are formatted when records are emitted
+        with mock.patch.object(handler.logger, "handle") as mock_handle:
+            self.client.telemetry_publish("property_key", 1)
+            handler.handle_publish()
+            logged = "\n".join(x[0][0].getMessage()
+                               for x in mock_handle.call_args_list)
+            assert "Property Publish property_key : 1" in logged
+            assert "\"property_key\"" in logged
+
+        # Nothing is formatted when the records are discarded
+        handler.logger.setLevel(device_cloud.LOGWARNING)
+        with mock.patch.object(defs.Description, "__str__") as mock_desc, \
+             mock.patch.object(defs.CommandDump, "__str__") as mock_dump:
+            self.client.telemetry_publish("property_key", 2)
+            handler.handle_publish()
+            assert mock_desc.call_count == 0
+            assert mock_dump.call_count == 0
+
+        # Descriptions are not built at all when commands are not logged
+        handler.config.log_commands = False
+        messages = handler.publish_messages(
+            defs.PublishTelemetry("property_key", 3))
+        assert messages[0].description is None
+        assert str(messages[0]) == "property.publish"
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class CodecBackends(unittest.TestCase):
+    def runTest(self):
+        codec = device_cloud._core.codec
+        command = {"command":"property.publish",
+                   "params":{"thingKey":"key", "key":"property_key",
+                             "value":12.5, "ts":"2017-01-01T00:00:00.000000Z"}}
+        expected = json.dumps(command, separators=(",", ":"))
+        try:
+            assert codec.available()[-1] == "json"
+            for backend in codec.available():
+                assert codec.use(backend) == backend
+
+                # Encodes the same as the json module, and decodes bytes
+                assert json.loads(codec.dumps(command)) == command
+                assert codec.loads(expected.encode("utf-8")) == command
+                assert codec.loads(expected) == command
+
+                # Values the backend cannot encode fall back to json
+                assert codec.dumps({"value":2**70}) == "{\"value\":" + \
+                    str(2**70) + "}"
+
+                # NaN, Infinity, None, floats in exponent notation, control
+                # characters and non-ASCII characters are written exactly as
+                # the json module writes them
+                for value in [float("nan"), float("inf"), -float("inf"),
+                              None, u"a\u00e9\u2603", [u"\u00e9", 1.5],
+                              1e16, -1.5e16, 1e-07, 1e-05, 2.5e-05, 1.5e300,
+                              1e22, 0.0001, 1e15, u"\x7f\x00\x1f/", u"a:1e5,",
+                              [None, 1e16, "Info"]]:
+                    payload = {"value":value}
+                    assert codec.dumps(payload) == \
+                        json.dumps(payload, separators=(",", ":"))
+                    assert codec.dumps_value(value) == \
+                        json.dumps(value, separators=(",", ":"))
+
+                # Ordinary values, even strings such as "Info" and None, are
+                # only encoded once
+                if backend != "json":
+                    with mock.patch.object(codec, "_encoder") as mock_encoder:
+                        codec.dumps({"value":None, "log":"Info: nullable",
+                                     "list":[1.5, "NaN", -2]})
+                    assert not mock_encoder.encode.called
+            with self.assertRaises(KeyError):
+                codec.use("missing")
+        finally:
+            codec.use()
+
+        # Requests are identical whichever backend is used
+        requests = set()
+        for backend in codec.available():
+            codec.use(backend)
+            requests.add(device_cloud._core.tr50.generate_request(
+                [command, command]))
+        codec.use()
+        assert len(requests) == 1
+
+class TR50EncodeTemplates(unittest.TestCase):
+    def runTest(self):
+        tr50 = device_cloud._core.tr50
+        codec = device_cloud._core.codec
+        ts = "2017-01-01T00:00:00.000000Z"
+        cases = [
+            (tr50.create_property_publish, tr50.encode_property_publish,
+             [("thing", "key", 1), ("thing", "key", 1.25, ts),
+              ("thing", "key", -1e-07, None, "corr", "avg"),
+              ("thing", "key", 2**70, ts), ("thing", "key", 1e16),
+              ("thing", "key", 1e-05, ts), ("thing", "key", 1.5e300)]),
+            (tr50.create_attribute_publish, tr50.encode_attribute_publish,
+             [("thing", "key", "value"), ("thing", "key", u"\u00e9\"\\\n", ts),
+              ("thing", "key", "", ts, True),
+              ("thing", "key", u"\x7f/Info", ts)]),
+            (tr50.create_alarm_publish, tr50.encode_alarm_publish,
+             [("thing", "key", 3), ("thing", "key", 0, "message", ts),
+              ("thing", "key", 1, None, None, None, 45.5, -75.25, False)])]
+        try:
+            for backend in codec.available():
+                codec.use(backend)
+
+                # Identical to encoding the command created by create_* with
+                # the json module
+                commands = []
+                encoded = []
+                for create, encode, args_list in cases:
+                    for args in args_list:
+                        commands.append(create(*args))
+                        encoded.append(encode(*args))
+                        assert tr50.generate_request([encoded[-1]]) == \
+                            json.dumps({"1":commands[-1]},
+                                       separators=(",", ":"))
+                assert tr50.generate_request(encoded) == \
+                    tr50.generate_request(commands)
+                assert tr50.generate_requests(encoded, max_commands=4) == \
+                    tr50.generate_requests(commands, max_commands=4)
+        finally:
+            codec.use()
+
+class DefsClockFormat(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        clock = defs.Clock()
+        epoch = datetime(1970, 1, 1)
+
+        # Same as formatting a datetime, in and across seconds
+        start = 1483228800
+        for offset in (0, 0.000001, 0.25, 0.5, 0.9999994, 0.9999996, 1.5,
+                       86399.75):
+            seconds = start + offset
+            expected = (epoch + timedelta(seconds=seconds)).strftime(
+                device_cloud._core.constants.TIME_FORMAT)
+            assert clock.format(seconds) == expected
+        assert defs.format_timestamp(datetime(2017, 1, 1, 0, 0, 1),
+                                     clock) == "2017-01-01T00:00:01.000000Z"
+        assert defs.format_timestamp("2017-01-01T00:00:01.000000Z",
+                                     clock) == "2017-01-01T00:00:01.000000Z"
+
+        # Timezone aware datetimes are converted to UTC
+        class UTCPlusOne(tzinfo):
+            def utcoffset(self, dt):
+                return timedelta(hours=1)
+            def dst(self, dt):
+                return timedelta(0)
+            def tzname(self, dt):
+                return "+01:00"
+        aware = datetime(2017, 1, 1, 1, 0, 1, 500000, tzinfo=UTCPlusOne())
+        assert defs.epoch_seconds(aware) == 1483228801.5
+        assert defs.epoch_seconds(datetime(2017, 1, 1, 0, 0, 1, 500000)) == \
+            1483228801.5
+        assert defs.format_timestamp(aware, clock) == \
+            "2017-01-01T00:00:01.500000Z"
+        pub = defs.PublishTelemetry("property_key", 1.5, aware)
+        assert defs.format_timestamp(pub.timestamp, clock) == \
+            "2017-01-01T00:00:01.500000Z"
+
+        # Clocks record the time unformatted, including any offset
+        clock.offset = 100.0
+        before = time.time()
+        now = clock.now()
+        assert before + 100.0 <= now <= time.time() + 100.0
+
+        # Publishes are only timed when they are queued
+        assert defs.PublishLog("message").timestamp is None
+
+class HandleCloudTime(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client timing publishes by the Cloud's clock
+        kwargs = {"cloud_time":True}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        defs = device_cloud._core.defs
+
+        # Connecting asks for the Cloud's time
+        handler.on_connect(handler.mqtt, None, None, 0)
+        request = json.loads(handler.mqtt.publish.call_args[0][1])
+        assert request["1"]["command"] == "diag.time"
+        topic = handler.mqtt.publish.call_args[0][0].split("/")[1]
+
+        # The reply sets the offset of new publishes
+        cloud_time = time.time() + 3600
+        reply = {"1":{"success":True, "params":{"time":cloud_time * 1000}}}
+        message = defs.Message("reply/" + topic, reply)
+        handler.handle_message(message)
+        assert abs(handler.clock.offset - 3600) < 5
+        pub = defs.PublishLog("message")
+        handler.queue_publish(pub)
+        assert abs(pub.timestamp - cloud_time) < 5
+
+        # Publishes with their own time keep it
+        pub = defs.PublishTelemetry("property_key", 1.5, 1483228800.0)
+        handler.queue_publish(pub)
+        assert pub.timestamp == 1483228800.0
+
+        # Other clients keep their own clocks
+        mock_exists.side_effect = [True, True, True]
+        mock_read.side_effect = [json.dumps(self.config_args), helpers.uuid]
+        other = device_cloud.Client("other-client")
+        other.initialize()
+        assert other.handler.clock is not handler.clock
+        assert other.handler.clock.offset == 0.0
+        pub = defs.PublishLog("message")
+        other.handler.queue_publish(pub)
+        assert abs(pub.timestamp - time.time()) < 5
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class DefsSlottedRecords(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+
+        # Records have no per-instance dict
+        records = [defs.PublishTelemetry("property_key", 1.5),
+                   defs.PublishAlarm("alarm_key", 1, "message"),
+                   defs.PublishLocation(45.5, -75.25, heading=90),
+                   defs.Work(device_cloud._core.constants.WORK_ACTION, None),
+                   defs.Message("reply/0001", {}),
+                   defs.OutMessage({"command":"diag.ping"}, "Ping")]
+        for record in records:
+            assert not hasattr(record, "__dict__")
+
+        # Publishes can still be stored and restored
+        for pub in records[:3]:
+            data = defs.publish_to_dict(pub)
+            copy = defs.publish_from_dict(json.loads(json.dumps(data)))
+            assert type(copy) is type(pub)
+            assert copy.type == pub.type
+            assert defs.publish_to_dict(copy) == data
+        bulk = defs.PublishTelemetryBulk("property_key", array.array("d", [1.5]),
+                                         array.array("d", [1483228800.0]))
+        assert defs.publish_to_dict(bulk)["values"] == [1.5]
+
+@unittest.skipIf(sys.version_info < (3, 4), "tracemalloc not available")
+class DefsTelemetryMemory(unittest.TestCase):
+    def runTest(self):
+        import tracemalloc
+        defs = device_cloud._core.defs
+        count = 100000
+
+        def measure(function):
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                kept = function()
+                after = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            del kept
+            return float(after - before) / count
+
+        # Queued publish objects
+        def publishes():
+            return [defs.PublishTelemetry("property_key", x * 0.5)
+                    for x in range(count)]
+        assert measure(publishes) < 160
+
+        # Buffered samples, including the arrays' spare capacity
+        def buffered():
+            telemetry_buffer = defs.TelemetryBuffer()
+            for num in range(count):
+                telemetry_buffer.add("property_key", num * 0.5)
+            return telemetry_buffer
+        assert measure(buffered) < 24
+
+class DefsTelemetryBuffer(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        constants = device_cloud._core.constants
+
+        # A full buffer applies the publish queue policy
+        buffer = defs.TelemetryBuffer(3)
+        buffer.add("a", 1, 1.0)
+        buffer.add("b", 2, 2.0)
+        buffer.add("b", 5, 3.0)
+        assert buffer.add("a", 3, 4.0, constants.QUEUE_POLICY_DROP_OLDEST) \
+            == device_cloud.STATUS_SUCCESS
+        assert buffer.add("a", 4, 5.0, constants.QUEUE_POLICY_DROP_NEWEST) \
+            == device_cloud.STATUS_SUCCESS
+        assert buffer.add("a", 4, 5.0, constants.QUEUE_POLICY_BLOCK, 0.05) \
+            == device_cloud.STATUS_TIMED_OUT
+        assert buffer.add("a", 4, 5.0) == device_cloud.STATUS_FULL
+        assert buffer.dropped == 2
+        assert buffer.rejected == 2
+        assert len(buffer) == 3
+
+        # Blocked samples are added once the buffer is drained
+        threading.Timer(0.05, buffer.drain).start()
+        assert buffer.add("a", 6, 6.0, constants.QUEUE_POLICY_BLOCK) == \
+            device_cloud.STATUS_SUCCESS
+        assert len(buffer) == 1
+        buffer.drain()
+
+        # Coalesced properties keep their newest values
+        buffer.add("a", 1, 1.0)
+        buffer.add("b", 2, 2.0)
+        buffer.add("b", 5, 3.0)
+        coalescer = defs.PublishCoalescer({"b":1})
+        pubs = dict((x.name, (list(x.values), list(x.timestamps)))
+                    for x in buffer.drain(coalescer))
+        assert pubs == {"a":([1], [1.0]), "b":([5], [3.0])}
+
+class ClientTelemetryBuffer(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client buffering up to three samples
+        kwargs = {"telemetry_buffer":True, "publish_queue_size":3}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Numbers are buffered, in order even when ints and floats are mixed
+        for value in (1, 2.5, 3):
+            assert self.client.telemetry_publish("property_key", value) == \
+                device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("other_key", "4") == \
+            device_cloud.STATUS_SUCCESS
+        assert len(handler.telemetry_buffer) == 3
+        assert handler.publish_queue.qsize() == 1
+        assert handler.pending_publishes() == 4
+        assert self.client.telemetry_publish("last_key", 6) == \
+            device_cloud.STATUS_FULL
+
+        # Anything else is queued after the samples already buffered
+        assert self.client.telemetry_publish("property_key", "5") == \
+            device_cloud.STATUS_SUCCESS
+        assert len(handler.telemetry_buffer) == 0
+        assert handler.publish_queue.qsize() == 3
+
+        # Buffered samples are sent in order with their own times
+        handler.handle_publish()
+        jload = json.loads(handler.mqtt.publish.call_args[0][1])
+        sent = [(jload[x]["params"]["key"], jload[x]["params"]["value"])
+                for x in sorted(jload, key=int)]
+        assert sent == [("other_key", "4"), ("property_key", 1),
+                        ("property_key", 2.5), ("property_key", 3),
+                        ("property_key", "5")]
+        assert all("ts" in x["params"] for x in jload.values())
+        assert handler.pending_publishes() == 0
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class DefsOutTrackerExpiry(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        tracker = defs.OutTracker(timeout=30, max_bytes=100)
+
+        def message(out_id, timeout=None):
+            msg = defs.OutMessage({"command":"diag.ping"}, out_id,
+                                  out_id=out_id, timeout=timeout)
+            msg.size = 40
+            return msg
+
+        # Messages expire by their own timeout, or the default
+        assert tracker.add_message(message("0001-1"), now=0) == []
+        assert tracker.add_message(message("0001-2", timeout=5), now=0) == []
+        assert [x.out_id for x in tracker.expire(now=10)] == ["0001-2"]
+        assert tracker.size == 40
+        assert tracker.pop_message("0001", "1").out_id == "0001-1"
+        assert tracker.expire(now=60) == []
+        assert tracker.timed_out == 1
+
+        # Messages that never time out stay until they are replied to
+        tracker.add_message(message("0002-1", timeout=0), now=0)
+        assert tracker.expire(now=1e9) == []
+        self.assertRaises(KeyError, tracker.pop_message, "0001", "1")
+
+        # The oldest messages are dropped to stay under the size limit
+        tracker.add_message(message("0003-1"), now=0)
+        evicted = tracker.add_message(message("0003-2"), now=0)
+        assert [x.out_id for x in evicted] == ["0002-1"]
+        assert list(tracker) == ["0003-1", "0003-2"]
+        assert tracker.size == 80
+        assert tracker.evicted == 1
+
+        # MIDs are dropped after the default timeout, including QoS 0 MIDs
+        # that were published before they were added
+        tracker.add_mid(1, "0003", now=0)
+        assert tracker.pop_mid(2) is None
+        tracker.add_mid(2, "0004", now=0)
+        assert list(tracker.mid_tracker) == [1]
+        tracker.expire(now=40)
+        assert tracker.pop_mid(1) is None
+        assert len(tracker.mid_published) == 1
+        tracker.expire(now=time.time() + 40)
+        assert len(tracker.mid_published) == 0
+
+class HandleReplyTimeouts(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a publish journal
+        kwargs = {"publish_journal":self.journal_path, "reply_timeout":30}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        handler.on_connect(mqtt, None, None, 0)
+        mqtt.publish.reset_mock()
+
+        # Journaled publishes and a file transfer with a short timeout
+        self.client.telemetry_publish("property_key", 1.5)
+        self.client.attribute_publish("attribute_key", "value")
+        handler.handle_publish()
+        assert handler.publish_queue.qsize() == 0
+        timed_out = []
+        transfer = device_cloud._core.defs.FileTransfer("file", "/tmp/file",
+                                                        self.client)
+        message = device_cloud._core.defs.OutMessage(
+            {"command":"file.get"}, "Download file", data=transfer, timeout=5,
+            on_timeout=timed_out.append)
+        assert handler.send(message) == device_cloud.STATUS_SUCCESS
+        assert len(handler.reply_tracker) == 3
+
+        # The file transfer fails first
+        start = time.time()
+        expired = handler.reply_tracker.expire(now=start + 10)
+        assert expired == [message]
+        handler.handle_reply_timeouts(expired)
+        assert timed_out == [message]
+        assert transfer.status == device_cloud.STATUS_TIMED_OUT
+
+        # Journaled publishes without replies are sent again
+        expired = handler.reply_tracker.expire(now=start + 40)
+        assert len(expired) == 2
+        handler.handle_reply_timeouts(expired)
+        assert len(handler.reply_tracker) == 0
+        assert handler.journal_pending == {}
+        assert handler.publish_queue.qsize() == 2
+        handler.handle_publish()
+        assert mqtt.publish.call_count == 3
+        assert len(handler.journal) == 2
+
+        # Late replies are ignored
+        reply = {"1":{"success":True}, "2":{"success":True}}
+        handler.handle_message(device_cloud._core.defs.Message("reply/0002",
+                                                               reply))
+        assert len(handler.journal) == 2
+        handler.journal.close()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.journal_dir, "journal.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+class DefsTopicAllocator(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+
+        # Unused numbers first, then released numbers, oldest first
+        topics = defs.TopicAllocator(width=1)
+        assert [topics.allocate() for _ in range(9)] == \
+            [str(x) for x in range(1, 10)]
+        assert topics.allocate() is None
+        topics.release("4")
+        topics.release("2")
+        topics.release("2")
+        topics.release("0")
+        assert len(topics) == 7
+        assert topics.allocate() == "4"
+        assert topics.allocate() == "2"
+        assert topics.allocate() is None
+
+        # Topic numbers are released once all of their messages are removed
+        tracker = defs.OutTracker(topic_width=1)
+        for num in range(9):
+            topic, evicted = tracker.new_topic()
+            assert evicted == []
+            for cmd in range(2):
+                tracker.add_message(defs.OutMessage(
+                    {"command":"diag.ping"}, None,
+                    out_id="{}-{}".format(topic, cmd + 1)))
+        tracker.pop_message("3", "1")
+        assert tracker.topics.allocate() is None
+        tracker.pop_message("3", "2")
+        assert tracker.new_topic() == ("3", [])
+
+        # If every topic number is in use, the oldest messages are dropped
+        topic, evicted = tracker.new_topic()
+        assert topic == "1"
+        assert [x.out_id for x in evicted] == ["1-1", "1-2"]
+
+class HandleSendTopics(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with two digit topic numbers
+        self.client = device_cloud.Client("testing-client", {"topic_width":2})
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+
+        # Topic numbers keep their width, and are reused once replied to
+        for num in range(99):
+            handler.send(device_cloud._core.defs.OutMessage(
+                {"command":"diag.ping"}, "Ping"))
+        assert mqtt.publish.call_args_list[0][0][0] == "api/01"
+        assert mqtt.publish.call_args_list[-1][0][0] == "api/99"
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/42", {"1":{"success":True}}))
+        handler.send(device_cloud._core.defs.OutMessage(
+            {"command":"diag.ping"}, "Ping"))
+        assert mqtt.publish.call_args[0][0] == "api/42"
+        assert len(handler.reply_tracker) == 99
+
+        # The oldest request is given up on when none are free
+        handler.send(device_cloud._core.defs.OutMessage(
+            {"command":"diag.ping"}, "Ping"))
+        assert mqtt.publish.call_args[0][0] == "api/01"
+        assert len(handler.reply_tracker) == 99
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class DefsCompletion(unittest.TestCase):
+    def runTest(self):
+        completion = device_cloud._core.defs.Completion()
+        finished = []
+        completion.add_callback(finished.append)
+
+        # Waiting times out until it is finished
+        assert completion.wait(0.01) is None
+        assert not completion.done()
+
+        # Waiters are woken as soon as it is finished from another thread
+        timer = threading.Timer(0.05, completion.finish,
+                                (device_cloud.STATUS_SUCCESS, "result"))
+        start = time.time()
+        timer.start()
+        assert completion.wait(10) == device_cloud.STATUS_SUCCESS
+        assert time.time() - start < 5
+        timer.join()
+        assert completion.result == "result"
+        assert finished == [completion]
+
+        # It only finishes once, and late callbacks are called right away
+        assert not completion.finish(device_cloud.STATUS_FAILURE)
+        assert completion.status == device_cloud.STATUS_SUCCESS
+        completion.add_callback(finished.append)
+        assert finished == [completion, completion]
+
+        # File transfers finish when their status is set
+        transfer = device_cloud._core.defs.FileTransfer("file", "/tmp/file",
+                                                        None)
+        assert transfer.status is None
+        transfer.status = device_cloud.STATUS_NOT_FOUND
+        assert transfer.completion.wait() == device_cloud.STATUS_NOT_FOUND
+
+class HandleSendRequest(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+        Message = device_cloud._core.defs.Message
+
+        # Requests finish with their reply
+        completion = handler.send_request(device_cloud._core.defs.OutMessage(
+            {"command":"diag.ping"}, "Ping"))
+        assert not completion.done()
+        reply = {"success":True, "params":{}}
+        handler.handle_message(Message("reply/0001", {"1":reply}))
+        assert completion.status == device_cloud.STATUS_SUCCESS
+        assert completion.result == reply
+
+        # Blocking downloads return as soon as the reply is handled
+        timer = threading.Timer(0.05, handler.handle_message,
+                                (Message("reply/0002", {"1":{
+                                    "success":False,
+                                    "errorCodes":[-90008]}}),))
+        start = time.time()
+        timer.start()
+        status = self.client.file_download("file.txt", "/tmp/file.txt",
+                                           blocking=True, timeout=10)
+        timer.join()
+        assert status == device_cloud.STATUS_NOT_FOUND
+        assert time.time() - start < 5
+
+        # Blocking transfers still waiting when the client stops fail
+        finished = []
+        timer = threading.Timer(0.05, handler.fail_transfers)
+        start = time.time()
+        timer.start()
+        status = self.client.file_download(
+            "file.txt", "/tmp/file.txt", blocking=True, timeout=10,
+            callback=lambda client, name, status: finished.append(status))
+        timer.join()
+        assert status == device_cloud.STATUS_FAILURE
+        assert finished == [device_cloud.STATUS_FAILURE]
+        assert time.time() - start < 5
+        assert handler.transfers == []
+
+        # Timed out requests finish with STATUS_TIMED_OUT
+        completion = handler.send_request(device_cloud._core.defs.OutMessage(
+            {"command":"diag.ping"}, "Ping", timeout=1))
+        handler.handle_reply_timeouts(
+            handler.reply_tracker.expire(now=time.time() + 2))
+        assert completion.wait(1) == device_cloud.STATUS_TIMED_OUT
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class DefsHistogram(unittest.TestCase):
+    def runTest(self):
+        histogram = device_cloud._core.defs.Histogram()
+        assert histogram.summary()["p50"] == 0.0
+
+        # Percentiles are within a bucket of the exact values
+        for num in range(1, 1001):
+            histogram.add(num / 1000.0)
+        summary = histogram.summary()
+        assert summary["count"] == 1000
+        assert abs(summary["mean"] - 0.5005) < 1e-9
+        assert 0.5 <= summary["p50"] <= 0.5 * 1.05
+        assert 0.95 <= summary["p95"] <= 0.95 * 1.05
+        assert 0.99 <= summary["p99"] <= 1.0
+        assert summary["max"] == 1.0
+
+        # Durations past the last bucket are still counted
+        histogram.add(3600.0)
+        assert histogram.percentile(100) == 3600.0
+        assert len(histogram.counts) == histogram.BUCKETS
+
+class ClientStats(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Commands are counted by type when sent and replied to
+        self.client.telemetry_publish("property_key", 1.5)
+        self.client.telemetry_publish("other_key", 2.5)
+        self.client.alarm_publish("alarm_key", 1)
+        handler.handle_publish()
+        reply = {"1":{"success":True}, "2":{"success":False}}
+        handler.handle_message(device_cloud._core.defs.Message("reply/0001",
+                                                               reply))
+        stats = self.client.stats()
+        commands = stats["commands"]
+        assert commands["property.publish"]["sent"] == 2
+        assert commands["alarm.publish"]["sent"] == 1
+        assert commands["alarm.publish"]["replies"] == 1
+        assert commands["property.publish"]["replies"] == 1
+        assert commands["property.publish"]["failures"] == 1
+        rtt = commands["alarm.publish"]["rtt"]
+        assert rtt["count"] == 1
+        assert 0 <= rtt["p50"] <= rtt["max"] < 5
+        assert stats["replies"]["pending"] == 1
+        assert stats["publish"]["commands"] == 3
+        assert stats["publish_queue"] == {"size":0, "dropped":0,
+                                          "rejected":0}
+        assert stats["latency"]["publish"]["priority"]["count"] == 1
+
+        # Timeouts are counted too
+        handler.handle_reply_timeouts(
+            handler.reply_tracker.expire(now=time.time() + 3600))
+        assert self.client.stats()["commands"]["property.publish"][
+            "timeouts"] == 1
+
+        # Round trip times are published as telemetry in milliseconds
+        assert handler.report_stats() == device_cloud.STATUS_SUCCESS
+        assert handler.publish_queue.qsize() == 0
+        handler.report_stats(force=True)
+        keys = [handler.publish_queue.get().name for _ in range(8)]
+        assert sorted(keys) == sorted(
+            "rtt.{}.{}".format(command, name)
+            for command in ("alarm.publish", "property.publish")
+            for name in ("p50", "p95", "p99", "max"))
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlerSelectLoop(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mqtt = helpers.init_mock_mqtt()
+        mock_mqtt.return_value = mqtt
+
+        # Initialize client
+        kwargs = {"reply_timeout":5, "stats_interval":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.state = device_cloud._core.constants.STATE_CONNECTED
+
+        # MQTT is polled if its socket can't be selected on
+        assert handler.mqtt_loop(0) == 0
+        assert mqtt.loop.call_count == 1
+
+        handler.wake_reader, handler.wake_writer = socket.socketpair()
+        reader, writer = socket.socketpair()
+        mqtt.socket.return_value = reader
+        mqtt.want_write.return_value = False
+        mqtt.loop_read.return_value = 0
+        mqtt.loop_write.return_value = 0
+        mqtt.loop_misc.return_value = 0
+        try:
+            # Nothing to do until the timeout
+            start = time.time()
+            assert handler.mqtt_loop(0.05) == 0
+            assert time.time() - start >= 0.04
+            assert mqtt.loop.call_count == 1
+            assert not mqtt.loop_read.called
+            assert not mqtt.loop_write.called
+            assert mqtt.loop_misc.call_count == 1
+
+            # Received data is read
+            writer.send(b"x")
+            assert handler.mqtt_loop(5) == 0
+            assert mqtt.loop_read.call_count == 1
+            reader.recv(1)
+
+            # Data to send wakes the loop and is written straight away
+            mqtt.want_write.return_value = True
+            threading.Timer(0.05, handler.on_socket_register_write,
+                            (mqtt, None, reader)).start()
+            start = time.time()
+            assert handler.mqtt_loop(5) == 0
+            assert time.time() - start < 2
+            assert mqtt.loop_write.call_count >= 1
+
+            # Waking while disconnected ends the wait for reconnecting early
+            mqtt.socket.return_value = None
+            handler.io_wake()
+            start = time.time()
+            assert handler.mqtt_loop(5) != 0
+            assert time.time() - start < 2
+        finally:
+            handler.wake_reader.close()
+            handler.wake_writer.close()
+            handler.wake_reader = handler.wake_writer = None
+            reader.close()
+            writer.close()
+
+        # The loop waits until the next thing it has to check
+        now = time.time()
+        keep_alive = device_cloud._core.constants.MQTT_KEEP_ALIVE / 4.0
+        assert keep_alive - 1 < handler.loop_timeout() <= keep_alive
+        self.client.telemetry_publish("property_key", 1.5)
+        handler.handle_publish()
+        assert 4 < handler.loop_timeout() <= 5
+        self.client.telemetry_aggregate("aggregated", 2)
+        assert handler.loop_timeout() <= 2
+        handler.config.stats_interval = 1
+        handler.stats_time = now - 1
+        assert handler.loop_timeout() == 0
+        handler.on_disconnect(mqtt, None, 1)
+        assert 0 <= handler.loop_timeout() <= handler.config.reconnect_delay
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class DefsReconnectBackoff(unittest.TestCase):
+    @mock.patch("random.uniform")
+    def runTest(self, mock_uniform):
+        constants = device_cloud._core.constants
+        # Use the longest delay allowed
+        mock_uniform.side_effect = lambda low, high: high
+        backoff = device_cloud._core.defs.ReconnectBackoff(1, 10)
+        assert backoff.state == constants.BREAKER_CLOSED
+        assert backoff.remaining() is None
+        assert not backoff.attempt(now=100)
+
+        # Losing the connection opens the breaker
+        backoff.disconnected(now=100)
+        assert backoff.state == constants.BREAKER_OPEN
+        assert backoff.remaining(now=100) == 1
+        assert not backoff.attempt(now=100.5)
+        assert backoff.attempt(now=101)
+        assert backoff.state == constants.BREAKER_HALF_OPEN
+        assert not backoff.attempt(now=101)
+
+        # Delays double for each failure, up to the maximum
+        delays = []
+        for num in range(5):
+            backoff.failure(now=200)
+            delays.append(backoff.remaining(now=200))
+            assert backoff.attempt(now=300)
+        assert delays == [2, 4, 8, 10, 10]
+
+        # Failures are only counted for attempts in progress
+        backoff.disconnected(now=300)
+        backoff.failure(now=300)
+        backoff.disconnected(now=300)
+        assert backoff.failed == 6
+        assert backoff.remaining(now=300) == 10
+
+        # Reconnecting closes the breaker and records the time taken
+        backoff.attempt(now=400)
+        backoff.success(now=400)
+        stats = backoff.stats()
+        assert stats["state"] == constants.BREAKER_CLOSED
+        assert stats["attempts"] == 7
+        assert stats["failures"] == 6
+        assert stats["reconnects"] == 1
+        assert stats["time_to_reconnect"]["max"] == 300
+        backoff.disconnected(now=500)
+        assert backoff.remaining(now=500) == 1
+
+        # Delays are random up to the current limit
+        mock_uniform.side_effect = None
+        mock_uniform.return_value = 0.25
+        backoff.attempt(now=501)
+        backoff.failure(now=501)
+        assert backoff.remaining(now=501) == 0.25
+        mock_uniform.assert_called_with(0, 2)
+
+class HandlerReconnect(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mqtt = helpers.init_mock_mqtt()
+        mock_mqtt.return_value = mqtt
+
+        # Initialize client
+        kwargs = {"keep_alive":60, "reconnect_delay":2,
+                  "reconnect_max_delay":30}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        constants = device_cloud._core.constants
+        handler.to_quit = False
+        handler.on_connect(mqtt, None, None, 0)
+        assert handler.backoff.state == constants.BREAKER_CLOSED
+
+        # Losing the connection schedules a reconnection within the delay
+        handler.on_disconnect(mqtt, None, 1)
+        assert handler.state == constants.STATE_DISCONNECTED
+        assert handler.backoff.state == constants.BREAKER_OPEN
+        assert 0 <= handler.loop_timeout() <= 2
+        last_connected = handler.last_connected
+
+        # A failed attempt waits longer, and doesn't restart keep alive
+        handler.backoff.next_attempt = 0
+        assert handler.reconnect_due()
+        handler.reconnect_result(None)
+        assert handler.state == constants.STATE_DISCONNECTED
+        assert handler.backoff.delay <= 4
+        handler.backoff.next_attempt = 0
+        assert handler.reconnect_due()
+        handler.reconnect_result(0)
+        assert handler.state == constants.STATE_CONNECTING
+        handler.on_connect(mqtt, None, None, 5)
+        handler.on_disconnect(mqtt, None, 1)
+        assert handler.last_connected == last_connected
+        assert handler.backoff.failed == 2
+
+        # Reconnecting is recorded in the stats
+        handler.backoff.next_attempt = 0
+        assert handler.reconnect_due()
+        handler.reconnect_result(0)
+        handler.on_connect(mqtt, None, None, 0)
+        stats = self.client.stats()["reconnect"]
+        assert stats["state"] == constants.BREAKER_CLOSED
+        assert stats["attempts"] == 3
+        assert stats["reconnects"] == 1
+        assert stats["time_to_reconnect"]["count"] == 1
+
+        # Gives up once keep alive runs out
+        handler.on_disconnect(mqtt, None, 1)
+        handler.last_connected = datetime.utcnow() - timedelta(seconds=30)
+        assert handler.loop_timeout() <= 30
+        handler.last_connected = datetime.utcnow() - timedelta(seconds=61)
+        assert handler.loop_timeout() == 0
+        assert not handler.reconnect_due()
+        assert handler.to_quit
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class TLSSessionResumption(unittest.TestCase):
+    def runTest(self):
+        tls = device_cloud._core.tls
+        if not tls.SESSIONS or not hasattr(ssl.SSLContext, "sslsocket_class"):
+            self.skipTest("TLS sessions need Python 3.7")
+
+        # Self signed certificate for a local server
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cert_path = os.path.join(temp_dir, "cert.pem")
+            key_path = os.path.join(temp_dir, "key.pem")
+            try:
+                subprocess.check_call(["openssl", "req", "-x509", "-newkey",
+                                       "rsa:2048", "-nodes", "-days", "1",
+                                       "-subj", "/CN=localhost", "-keyout",
+                                       key_path, "-out", cert_path],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+            except (OSError, subprocess.CalledProcessError):
+                self.skipTest("openssl is not available")
+            server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            server_context.load_cert_chain(cert_path, key_path)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(2)
+        def serve():
+            for _ in range(2):
+                conn, _ = listener.accept()
+                try:
+                    with server_context.wrap_socket(conn,
+                                                    server_side=True) as sock:
+                        sock.sendall(b"x")
+                        sock.recv(1)
+                except (ssl.SSLError, socket.error):
+                    pass
+        server = threading.Thread(target=serve)
+        server.start()
+
+        # The second connection resumes the session of the first
+        context = tls.create_context()
+        try:
+            for num in range(2):
+                sock = socket.create_connection(listener.getsockname())
+                sock = context.wrap_socket(sock, server_hostname="localhost")
+                assert sock.recv(1) == b"x"
+                context.save_session(sock)
+                assert sock.session_reused == (num == 1)
+                sock.sendall(b"y")
+                sock.close()
+        finally:
+            server.join()
+            listener.close()
+        stats = context.stats()
+        assert stats["handshakes"] == 2
+        assert stats["resumed"] == 1
+        assert stats["handshake_time"]["count"] == 2
+        assert "localhost" in context.sessions
+
+class TLSCreateContext(unittest.TestCase):
+    def runTest(self):
+        tls = device_cloud._core.tls
+
+        # Not mocked, so the context is built as it is for connections
+        context = tls.create_context()
+        assert isinstance(context, tls.TLSContext)
+        assert context.verify_mode == ssl.CERT_NONE
+        assert not context.check_hostname
+        assert context.stats()["handshakes"] == 0
+
+        context = tls.create_context(certifi.where())
+        assert context.verify_mode == ssl.CERT_REQUIRED
+        assert context.check_hostname
+        assert context.sessions == {}
+
+class HandlerTLSContext(unittest.TestCase):
+    @mock.patch("device_cloud._core.tls.TLSContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_isfile, mock_open,
+                mock_context):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.return_value = True
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mqtt = helpers.init_mock_mqtt()
+        mock_mqtt.return_value = mqtt
+
+        # Initialize client
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+        handler.config.cloud.port = 8883
+        handler.config.ca_bundle_file = "/top/secret/location"
+
+        # The context is created and given to MQTT once, and reused for
+        # reconnects and HTTPS
+        assert handler.connect_setup() == device_cloud.STATUS_SUCCESS
+        assert handler.connect_setup() == device_cloud.STATUS_SUCCESS
+        context = mock_context.return_value
+        mqtt.tls_set_context.assert_called_once_with(context)
+        context.load_verify_locations.assert_called_once_with(
+            cafile="/top/secret/location")
+        assert handler.get_tls_context() is context
+        assert mock_context.call_count == 1
+        adapter = handler.http.get_adapter("https://somewhere/file")
+        assert isinstance(adapter, device_cloud._core.tls.TLSAdapter)
+        assert adapter.context is context
+
+        # Connections don't load the bundle again
+        conn = mock.Mock()
+        adapter.cert_verify(conn, "https://somewhere/file", True, None)
+        assert conn.ca_certs is None
+        assert conn.cert_reqs == "CERT_REQUIRED"
+        context.stats.return_value = {"handshakes":1}
+        assert self.client.stats()["tls"] == {"handshakes":1}
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class GatewayClients(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.return_value = True
+        read_strings = [json.dumps(self.config_args), helpers.uuid,
+                        json.dumps(self.config_args), helpers.uuid[::-1]]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mqtts = [self.mock_mqtt(), self.mock_mqtt()]
+        mock_mqtt.side_effect = mqtts
+        defs = device_cloud._core.defs
+
+        # Things share the gateway's threads
+        gateway = device_cloud.Gateway(thread_count=2, loop_time=0.05)
+        self.gateway = gateway
+        clients = [gateway.add_client("testing-client",
+                                      {"validate_cloud_cert":False}),
+                   gateway.add_client("testing-client",
+                                      {"validate_cloud_cert":False})]
+        threads = threading.active_count()
+        statuses = gateway.connect(timeout=5)
+        assert list(statuses.values()) == [device_cloud.STATUS_SUCCESS] * 2
+        assert all(x.is_connected() for x in clients)
+        assert threading.active_count() - threads == 4
+        assert gateway.stats()["connected"] == 2
+        assert gateway.stats()["threads"] == 4
+        assert all(x.handler.main_thread is None for x in clients)
+        assert all(x.handler.worker_threads == [] for x in clients)
+
+        # Publishes are flushed by the gateway's publish thread, and written
+        # by its I/O thread
+        for client in clients:
+            assert client.telemetry_publish("property_key", 1.5) == \
+                device_cloud.STATUS_SUCCESS
+        for mqtt in mqtts:
+            assert self.wait(lambda: mqtt.written)
+            assert mqtt.publish_threads == [gateway.publish_thread]
+            jload = json.loads(mqtt.publish.call_args[0][1])
+            assert jload["1"]["command"] == "property.publish"
+
+        # Work is handled by the gateway's workers
+        callback_threads = []
+        def action(client, params):
+            callback_threads.append(threading.current_thread())
+            return (device_cloud.STATUS_SUCCESS, "done")
+        clients[1].action_register_callback("gateway_action", action)
+        clients[1].handler.queue_work(defs.Work(
+            device_cloud._core.constants.WORK_ACTION,
+            defs.ActionRequest("mail", "gateway_action", {})))
+        assert self.wait(lambda: callback_threads)
+        assert callback_threads[0] in gateway.worker_threads
+        assert self.wait(
+            lambda: not clients[1].handler.work_queue.unfinished_tasks)
+
+        # A lost connection is retried by a worker
+        handler = clients[0].handler
+        handler.on_disconnect(mqtts[0], None, 1)
+        handler.backoff.next_attempt = 0
+        assert self.wait(lambda: mqtts[0].reconnect.called)
+        assert self.wait(lambda: handler.state ==
+                         device_cloud._core.constants.STATE_CONNECTING)
+
+        # Removing a thing disconnects it, and disconnecting the gateway
+        # stops its threads
+        assert gateway.remove_client(clients[0]) == device_cloud.STATUS_SUCCESS
+        assert not clients[0].is_alive()
+        assert gateway.remove_client(clients[0]) == \
+            device_cloud.STATUS_NOT_FOUND
+        assert gateway.disconnect() == device_cloud.STATUS_SUCCESS
+        assert not clients[1].is_alive()
+        assert gateway.stats()["threads"] == 0
+        assert threading.active_count() == threads
+        for mqtt in mqtts:
+            assert mqtt.sockets == []
+
+    def mock_mqtt(self):
+        # MQTT client whose socket is a socket pair, read and written when
+        # the gateway selects it
+        mqtt = helpers.init_mock_mqtt()
+        mqtt.sockets = []
+        mqtt.written = []
+        mqtt.publish_threads = []
+
+        def open_socket():
+            reader, writer = socket.socketpair()
+            mqtt.sockets.append((reader, writer))
+            mqtt.socket.return_value = reader
+            mqtt.on_socket_open(mqtt, None, reader)
+            return reader, writer
+
+        def mqtt_connect(host, port=1883, keepalive=60, bind_address=""):
+            writer = open_socket()[1]
+            writer.send(b"c")
+            return 0
+
+        def mqtt_reconnect():
+            close_socket()
+            open_socket()
+            return 0
+
+        def close_socket():
+            if mqtt.sockets:
+                reader, writer = mqtt.sockets.pop()
+                mqtt.socket.return_value = None
+                mqtt.on_socket_close(mqtt, None, reader)
+                reader.close()
+                writer.close()
+
+        def mqtt_disconnect():
+            mqtt.on_disconnect(mqtt, None, 0)
+            close_socket()
+            return 0
+
+        def mqtt_loop_read():
+            if mqtt.socket().recv(1) == b"c":
+                mqtt.on_connect(mqtt, None, None, 0)
+            return 0
+
+        def mqtt_loop_write():
+            mqtt.written.append(threading.current_thread())
+            mqtt.on_socket_unregister_write(mqtt, None, mqtt.socket())
+            return 0
+
+        def mqtt_publish(topic, payload, qos=1):
+            mqtt.publish_threads.append(threading.current_thread())
+            mqtt.on_socket_register_write(mqtt, None, mqtt.socket())
+            return (0, 0)
+
+        mqtt.connect.side_effect = mqtt_connect
+        mqtt.reconnect.side_effect = mqtt_reconnect
+        mqtt.disconnect.side_effect = mqtt_disconnect
+        mqtt.loop_read.side_effect = mqtt_loop_read
+        mqtt.loop_write.side_effect = mqtt_loop_write
+        mqtt.loop_misc.return_value = 0
+        mqtt.publish.side_effect = mqtt_publish
+        return mqtt
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.gateway = None
+
+    def tearDown(self):
+        if self.gateway:
+            self.gateway.stop()
+
+    def wait(self, predicate):
+        for _ in range(500):
+            if predicate():
+                return True
+            sleep(0.01)
+        return False
+
+class HandlerHTTPPool(unittest.TestCase):
+    @mock.patch("device_cloud._core.tls.TLSContext")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_context):
+        # Set up mocks, only while initializing so requests can read files
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+        with mock.patch(builtin + ".open") as mock_open, \
+                mock.patch("os.path.exists") as mock_exists:
+            mock_exists.side_effect = [True, True, True]
+            read_strings = [json.dumps(self.config_args), helpers.uuid]
+            mock_read = mock_open.return_value.__enter__.return_value.read
+            mock_read.side_effect = read_strings
+
+            # Initialize client
+            self.client = device_cloud.Client("testing-client",
+                                              {"http_pool_size":2})
+            self.client.initialize()
+        handler = self.client.handler
+        assert self.client.stats()["http"] is None
+
+        # The pool size is configurable
+        handler.get_tls_context()
+        adapter = handler.http.get_adapter("https://somewhere/file")
+        assert adapter is handler.http_adapter
+        assert adapter._pool_maxsize == 2
+
+        # Requests on a kept alive connection count as reused
+        class FileHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            timeout = 1
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+        server = HTTPServer(("127.0.0.1", 0), FileHandler)
+        serving = threading.Thread(target=server.serve_forever)
+        serving.start()
+        handler.http.mount("http://", adapter)
+        try:
+            url = "http://127.0.0.1:{}/file/1".format(server.server_port)
+            for _ in range(3):
+                response = handler.http.post(url, data=b"contents")
+                assert response.status_code == 200
+            assert self.client.stats()["http"] == {"requests":3,
+                                                   "connections":1,
+                                                   "reused":2}
+        finally:
+            handler.http.close()
+            server.shutdown()
+            server.server_close()
+            serving.join()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Micro-benchmarks for the device_cloud publish path. Nothing is sent to a Cloud;
+MQTT publishes are discarded once they are encoded.
+
+Usage:
+  benchmark.py [-n SAMPLES] [benchmark ...]
+
+Run with no benchmark names to run all of them.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import device_cloud
+import paho.mqtt.client as mqttlib
+
+
+class NullMQTT(object):
+    """
+    Stands in for the MQTT client, counting and discarding publishes.
+    Connecting succeeds straight away, without a socket.
+    """
+
+    def __init__(self, handler=None):
+        self.mid = 0
+        self.published = 0
+        self._out_messages = []
+        self.handler = handler
+
+    def connect(self, host, port=1883, keepalive=60):
+        self.handler.on_connect(self, None, None, 0)
+        return 0
+
+    def disconnect(self):
+        self.handler.on_disconnect(self, None, 0)
+        return mqttlib.MQTT_ERR_NO_CONN
+
+    def loop_misc(self):
+        return mqttlib.MQTT_ERR_NO_CONN
+
+    def publish(self, topic, payload, qos=0):
+        self.mid += 1
+        self.published += len(payload)
+        return 0, self.mid
+
+    def reconnect(self):
+        return 0
+
+    def socket(self):
+        return None
+
+    def want_write(self):
+        return False
+
+
+def make_client(gateway=None):
+    """
+    Create an initialized Client that is not connected to anything, hosted by
+    gateway if one is given
+    """
+
+    config_dir = tempfile.mkdtemp()
+    config = {"cloud":{"host":"localhost", "port":1883, "token":"benchmark"},
+              "qos_level":1, "quiet":True}
+    with open(os.path.join(config_dir, "benchmark-connect.cfg"), "w") as cfg:
+        json.dump(config, cfg)
+    if gateway:
+        client = gateway.add_client("benchmark", {"config_dir":config_dir})
+    else:
+        client = device_cloud.Client("benchmark", {"config_dir":config_dir})
+        client.initialize()
+    client.handler.mqtt = NullMQTT(client.handler)
+    shutil.rmtree(config_dir)
+    return client
+
+
+def timed(function, *args):
+    """
+    Return how many seconds it takes to run a function
+    """
+
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def report(name, count, seconds):
+    """
+    Print the rate of a benchmark
+    """
+
+    print("{:<40} {:>10.3f}s {:>14,.0f}/s".format(name, seconds,
+                                                  count / seconds))
+
+
+def report_resources(name, things, threads, memory):
+    """
+    Print the threads and memory used by a number of things
+    """
+
+    print("{:<40} {:>6} threads {:>14,.0f} bytes/thing".format(
+        name, threads, memory / float(things)))
+
+
+def bench_gateway(count):
+    """
+    Connect one thing for every 1000 samples as standalone Clients, each
+    with its own threads, and hosted by a Gateway on shared threads
+    """
+
+    import tracemalloc
+
+    things = max(count // 1000, 10)
+    tracemalloc.start()
+    for name in ("Client", "Gateway"):
+        gateway = None
+        if name == "Gateway":
+            gateway = device_cloud.Gateway()
+        threads = threading.active_count()
+        memory = tracemalloc.get_traced_memory()[0]
+        clients = [make_client(gateway) for _ in range(things)]
+        if gateway:
+            gateway.connect()
+        else:
+            for client in clients:
+                client.connect()
+        report_resources("{} x {}".format(name, things), things,
+                         threading.active_count() - threads,
+                         tracemalloc.get_traced_memory()[0] - memory)
+        if gateway:
+            gateway.disconnect()
+        else:
+            stopping = [threading.Thread(target=x.disconnect) for x in clients]
+            for thread in stopping:
+                thread.start()
+            for thread in stopping:
+                thread.join()
+    tracemalloc.stop()
+
+
+def bench_telemetry_bulk(count):
+    """
+    Queue and encode samples one at a time, and all at once
+    """
+
+    start = time.time()
+    values = [float(x) for x in range(count)]
+    timestamps = [start + x for x in range(count)]
+
+    client = make_client()
+    def per_sample():
+        for value in values:
+            client.telemetry_publish("property", value)
+        client.handler.handle_publish()
+    report("telemetry_publish", count, timed(per_sample))
+
+    client = make_client()
+    def bulk():
+        client.telemetry_publish_many("property", values, timestamps)
+        client.handler.handle_publish()
+    report("telemetry_publish_many", count, timed(bulk))
+
+
+def bench_codec(count):
+    """
+    Encode requests and decode replies of 500 commands with each installed
+    JSON backend
+    """
+
+    codec = device_cloud._core.codec
+    tr50 = device_cloud._core.tr50
+    batch = 500
+    commands = [tr50.create_property_publish("benchmark", "property", x * 0.5,
+                                             timestamp="2017-01-01T00:00:00."
+                                             "000000Z")
+                for x in range(batch)]
+    reply = json.dumps(dict((str(x + 1), {"success":True})
+                            for x in range(batch))).encode("utf-8")
+    rounds = max(count // batch, 1)
+
+    for backend in codec.available():
+        codec.use(backend)
+        def encode():
+            for _ in range(rounds):
+                tr50.generate_request(commands)
+        def decode():
+            for _ in range(rounds):
+                codec.loads(reply)
+        report("encode ({})".format(backend), rounds * batch, timed(encode))
+        report("decode ({})".format(backend), rounds * batch, timed(decode))
+    codec.use()
+
+
+def bench_encode(count):
+    """
+    Encode property publishes by creating command dicts, and from templates
+    """
+
+    codec = device_cloud._core.codec
+    tr50 = device_cloud._core.tr50
+    timestamp = "2017-01-01T00:00:00.000000Z"
+    values = [x * 0.5 for x in range(count)]
+
+    def create():
+        tr50.generate_request([tr50.create_property_publish(
+            "benchmark", "property", x, timestamp=timestamp) for x in values])
+    def encode():
+        tr50.generate_request([tr50.encode_property_publish(
+            "benchmark", "property", x, timestamp=timestamp) for x in values])
+
+    for backend in codec.available():
+        codec.use(backend)
+        report("create_property_publish ({})".format(backend), count,
+               timed(create))
+        report("encode_property_publish ({})".format(backend), count,
+               timed(encode))
+    codec.use()
+
+
+BENCHMARKS = {
+    "codec":bench_codec,
+    "encode":bench_encode,
+    "gateway":bench_gateway,
+    "telemetry_bulk":bench_telemetry_bulk
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run device_cloud "
+                                     "micro-benchmarks")
+    parser.add_argument("-n", "--samples", type=int, default=100000,
+                        help="Number of samples for each benchmark")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks to run ({})".format(
+                            ", ".join(sorted(BENCHMARKS))))
+    args = parser.parse_args(sys.argv[1:])
+
+    names = args.benchmarks or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark \"{}\"".format(name))
+            return 1
+    for name in names:
+        print("{}:".format(name))
+        BENCHMARKS[name](args.samples)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())